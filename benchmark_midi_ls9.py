@@ -0,0 +1,1276 @@
+#!../bin/python3
+####################################################################################################
+################################ Benchmarks for LS9 MIDI automations ###############################
+#### - Usage:
+####   > Run one benchmark:
+####       benchmark_midi_ls9.py <benchmark name> [options]
+####   > List all benchmarks:
+####       benchmark_midi_ls9.py --help
+####
+#### - Description:
+####   Micro-benchmarks for the hot paths of the automation code. These do not need a MIDI device,
+####   every benchmark generates synthetic LS9 traffic in memory.
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+
+import click
+from websockets.asyncio.server import serve
+from websockets.sync.client import connect as sync_connect
+from websockets.asyncio.client import connect as async_connect
+from websockets.exceptions import ConnectionClosed
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+from midi_nrpn import NrpnDecoder, NrpnEncoder, NrpnValueCache, NrpnCoalescer, RawMidiOut, FrameWatchdog
+from midi_nrpn import NRPN_FRAME_TIMEOUT, NRPN_CACHE_MAX_AGE, NRPN_COALESCE_MAX_RATE, MIDI_WIRE_RATE
+from yamaha_ls9_state import ConsoleState, MIRRORED_MAPPINGS, CTLR_SLOTS
+from yamaha_ls9_automations import AutomationEngine, load_automations, SERVER_AUTOMATIONS_FILE
+from midi_event_queue import MidiEventRing, MidiInputWorker, MidiLoopInput, OVERFLOW_POLICIES
+from midi_logging import setup_logging, LOG_FORMAT
+from midi_ws_sender import WebsocketSender
+from midi_ws_protocol import WS_SUBPROTOCOLS, WS_BINARY_SUBPROTOCOLS, WS_SUBPROTOCOL_STATE_V2, WS_BATCH_MAX, select_ws_subprotocol
+from midi_ws_protocol import encode_cc_batch, decode_cc_batch, encode_cc_csv, decode_cc_csv
+from yamaha_ls9_usb_cc import UsbCcRouter, FADER_LAWS
+from midi_ws_state import StatePublisher
+from midi_metrics import MetricsRegistry
+from midi_pipeline import MidiPipeline
+from yamaha_ls9_scenes import SceneRecaller, load_scenes
+from midi_output_scheduler import MidiOutputScheduler, LANE_CONTROL, LANE_CONTINUOUS, LANE_BULK, OUTPUT_BURST
+from midi_ports import find_midi_port
+
+
+#builds the 4 CC messages of one NRPN frame, in the same shape rtmidi hands them to the callback
+def nrpn_frame(controller, data):
+    return [[MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_1, (controller >> 7) & 0b1111111],
+            [MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_2, controller & 0b1111111],
+            [MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_3, (data >> 7) & 0b1111111],
+            [MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_4, data & 0b1111111]]
+
+#a fader sweep from -inf to +10dB on every input channel CH01-CH64, interleaved like a scene fade
+def fader_sweep_frames(steps=64):
+    channels = [f'CH{i:02d}' for i in range(1, 65)]
+    frames = []
+    for step in range(steps):
+        data = step * (MIDI_LS9.CH_ON_VALUE // (steps - 1))
+        for channel in channels:
+            frames.append(nrpn_frame(MIDI_LS9.FADER_CTLRS[channel], data))
+    return frames
+
+# in-memory stand-in for rtmidi.MidiOut, counts what would have been sent to the driver
+class FakeMidiOut:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def send_message(self, message):
+        self.messages += 1
+        self.bytes += len(message)
+
+    def close_port(self):
+        pass
+
+#runs func over every frame, repeat times, and returns the best ns per frame
+def time_per_frame(func, frames, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for frame in frames:
+            func(frame)
+        elapsed = time.perf_counter_ns() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(frames)
+
+
+#### Message classification: bidict inverse lookups vs. CTLR_DISPATCH table
+# the classification done per frame by process_midi_messages before the dispatch table existed
+def _legacy_combine_bytes(msb, lsb):
+    msb = int(msb); lsb = int(lsb)
+    return ((msb & 0b1111111) << 7) | (lsb & 0b1111111)
+
+def _legacy_get_nrpn_ctlr(msg):
+    return _legacy_combine_bytes(msg[0][2], msg[1][2])
+
+def _legacy_is_on_off_operation(msg):
+    return _legacy_get_nrpn_ctlr(msg) in MIDI_LS9.ON_OFF_CTLRS.inverse
+
+def _legacy_is_fade_operation(msg):
+    return _legacy_get_nrpn_ctlr(msg) in MIDI_LS9.FADER_CTLRS.inverse
+
+def _legacy_get_channel(msg):
+    if _legacy_is_fade_operation(msg):
+        return MIDI_LS9.FADER_CTLRS.inv[_legacy_get_nrpn_ctlr(msg)]
+    if _legacy_is_on_off_operation(msg):
+        return MIDI_LS9.ON_OFF_CTLRS.inv[_legacy_get_nrpn_ctlr(msg)]
+    return None
+
+def _legacy_classify(msg):
+    channel = _legacy_get_channel(msg)
+    is_fade = _legacy_is_fade_operation(msg)
+    is_on_off = _legacy_is_on_off_operation(msg)
+    return channel, is_fade, is_on_off
+
+# the same classification, done with one decode and one index into the dispatch table
+def _table_classify(msg):
+    return MIDI_LS9.classify_nrpn_ctlr(((msg[0][2] & 0b1111111) << 7) | (msg[1][2] & 0b1111111))
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('-r', '--repeat', default=5, show_default=True, type=int, help='Number of timed runs (best is kept)')
+@click.option('-s', '--steps', default=64, show_default=True, type=int, help='Fader positions per channel')
+def classify(repeat, steps):
+    '''Classification cost per message on a 64-channel fader sweep'''
+    frames = fader_sweep_frames(steps)
+    before = time_per_frame(_legacy_classify, frames, repeat)
+    after =  time_per_frame(_table_classify, frames, repeat)
+    click.echo(f'64-channel fader sweep: {len(frames)} NRPN frames')
+    click.echo(f'  bidict inverse lookups: {before:8.1f} ns/message')
+    click.echo(f'  CTLR_DISPATCH table:    {after:8.1f} ns/message')
+    click.echo(f'  speedup:                {before / after:8.2f}x')
+
+#### Idle cost: 5ms polling loop vs. FrameWatchdog
+#returns (cpu seconds, voluntary context switches) used by this process so far
+def _process_usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_nvcsw
+
+#sends one complete NRPN frame every 1/rate seconds through feed, until stop is set
+def _frame_feeder(feed, rate, stop):
+    frame = nrpn_frame(MIDI_LS9.FADER_CTLRS['CH01'], MIDI_LS9.FADE_0DB_VALUE)
+    while not stop.wait(1.0 / rate):
+        for message in frame:
+            feed(message)
+
+# the main loop of midi_yamaha_ls9.py before the watchdog: wake up every 5ms to count the timeout
+def _legacy_polling_loop(decoder, lock, stop, counters):
+    timeout_counter = 0
+    while not stop.is_set():
+        time.sleep(0.005)
+        counters['wakeups'] += 1
+        with lock:
+            if decoder.pending:
+                timeout_counter += 1
+            else:
+                timeout_counter = 0
+            if timeout_counter > 20:
+                decoder.clear_pending()
+                timeout_counter = 0
+
+def _measure_idle(seconds, rate, use_watchdog):
+    decoder = NrpnDecoder()
+    stop = threading.Event()
+    counters = {'wakeups': 0}
+    if use_watchdog:
+        watchdog = FrameWatchdog(NRPN_FRAME_TIMEOUT, decoder.clear_pending)
+        lock = watchdog.lock
+        def feed(message):
+            with lock:
+                decoder.feed(message)
+                if decoder.pending:
+                    watchdog.arm()
+                else:
+                    watchdog.disarm()
+    else:
+        lock = threading.Lock()
+        poller = threading.Thread(target=_legacy_polling_loop, args=(decoder, lock, stop, counters))
+        def feed(message):
+            with lock:
+                decoder.feed(message)
+
+    feeder = threading.Thread(target=_frame_feeder, args=(feed, rate, stop)) if rate > 0 else None
+    cpu_start, switches_start = _process_usage()
+    if not use_watchdog:
+        poller.start()
+    if feeder is not None:
+        feeder.start()
+    stop.wait(seconds)
+    stop.set()
+    if feeder is not None:
+        feeder.join()
+    if use_watchdog:
+        watchdog.stop()
+        counters['wakeups'] = watchdog.wakeups
+    else:
+        poller.join()
+    cpu_end, switches_end = _process_usage()
+    return counters['wakeups'], cpu_end - cpu_start, switches_end - switches_start
+
+@cli.command()
+@click.option('-s', '--seconds', default=5.0, show_default=True, type=float, help='Duration of each run')
+@click.option('-r', '--rate', default=0.0, show_default=True, type=float, help='NRPN frames/sec of background traffic (0 = fully idle)')
+def idle(seconds, rate):
+    '''Timeout handling cost: wakeups & CPU of the 5ms poll vs. the frame watchdog'''
+    click.echo(f'{seconds}s with {rate} NRPN frames/sec of traffic')
+    for name, use_watchdog in (('5ms polling loop', False), ('FrameWatchdog', True)):
+        wakeups, cpu, switches = _measure_idle(seconds, rate, use_watchdog)
+        click.echo(f'  {name:17s} {wakeups / seconds:8.1f} wakeups/s  {cpu / seconds * 1000:7.2f} ms CPU/s  '
+                   f'{switches / seconds:8.1f} context switches/s')
+
+#### Output encoding: bytes on wire per NRPN
+#(controller, data) pairs of typical automation output
+def _output_workloads():
+    fader_throw = [(MIDI_LS9.MIX1_SOF_CTLRS['CH01'], data) for data in range(0, MIDI_LS9.CH_ON_VALUE, 128)]
+    tabla_link = []
+    for data in range(4096, 12288, 64):
+        tabla_link += [(MIDI_LS9.TABLA1_PEQ1, data), (MIDI_LS9.TABLA2_PEQ1, data)]
+    button_storm = [(MIDI_LS9.ON_OFF_CTLRS[f'CH{i:02d}'], MIDI_LS9.CH_ON_VALUE * (i % 2)) for i in range(33, 43)] * 10
+    return {'single fader throw': fader_throw, 'CH18 tabla PEQ link': tabla_link, 'button storm': button_storm}
+
+@cli.command()
+@click.option('--resync', default=1.0, show_default=True, type=float, help='NrpnEncoder resync interval (s)')
+def wire(resync):
+    '''Bytes on wire & writes per NRPN frame with NrpnEncoder, vs. 4 separate CC messages'''
+    for name, workload in _output_workloads().items():
+        click.echo(f'{name}: {len(workload)} NRPN frames, {len(workload) * 12} bytes as 4 separate CCs')
+        for output_name, midi_out in (('rtmidi', FakeMidiOut()), ('rawmidi', RawMidiOut('/dev/null'))):
+            encoder = NrpnEncoder(midi_out, resync_interval=resync)
+            start = time.perf_counter_ns()
+            for controller, data in workload:
+                encoder.send_nrpn(controller, data)
+            elapsed = time.perf_counter_ns() - start
+            midi_out.close_port()
+            click.echo(f'  {output_name:8s} {encoder.bytes_sent / encoder.frames:5.2f} bytes/frame  '
+                       f'{encoder.writes / encoder.frames:4.2f} writes/frame  '
+                       f'{encoder.bytes_saved} bytes saved ({encoder.bytes_saved * 100 / (encoder.frames * 12):.0f}%)  '
+                       f'{elapsed / encoder.frames:7.0f} ns/frame')
+
+#### Console shadow state: memory & update cost
+@cli.command()
+@click.option('-r', '--repeat', default=5, show_default=True, type=int, help='Number of timed runs (best is kept)')
+def state(repeat):
+    '''Memory, update and query cost of the ConsoleState shadow model'''
+    events = [(((frame[0][2] << 7) | frame[1][2]), ((frame[2][2] << 7) | frame[3][2]))
+              for frame in fader_sweep_frames()]
+    console_state = ConsoleState()
+    # the same mirror as a plain dict, for comparison
+    mirrored = {controller for mapping in MIRRORED_MAPPINGS for controller in mapping.values()}
+    dict_state = dict.fromkeys(mirrored, 0)
+    def dict_update(controller, data):
+        if controller in mirrored:
+            dict_state[controller] = data
+    def time_updates(update):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for controller, data in events:
+                update(controller, data)
+            elapsed = time.perf_counter_ns() - start
+            best = elapsed if best is None or elapsed < best else best
+        return best / len(events)
+
+    dict_ns =  time_updates(dict_update)
+    state_ns = time_updates(console_state.update)
+    query_ns = time_per_frame(console_state.fader, ['CH01'] * 10000, repeat)
+    dict_bytes = sys.getsizeof(dict_state) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                                 for key, value in dict_state.items())
+    click.echo(f'{len(mirrored)} mirrored controllers, {len(events)} fader sweep updates')
+    click.echo(f'  ConsoleState: {console_state.memory_size() + CTLR_SLOTS.itemsize * len(CTLR_SLOTS):7d} bytes '
+               f'({console_state.memory_size()} per instance)  {state_ns:6.1f} ns/update')
+    click.echo(f'  dict mirror:  {dict_bytes:7d} bytes  {dict_ns:6.1f} ns/update')
+    click.echo(f'  ConsoleState.fader(name): {query_ns:6.1f} ns/query')
+
+#### CH18 -> tabla PEQ link: direct sends vs. NrpnCoalescer
+@cli.command()
+@click.option('--max-rate', default=100.0, show_default=True, type=float, help='Coalescer flush rate (Hz)')
+@click.option('--throw-time', default=0.5, show_default=True, type=float, help='Duration of the fader throw (s)')
+@click.option('--frames', default=500, show_default=True, type=int, help='NRPN frames sent by the LS9 during the throw')
+def coalesce(max_rate, throw_time, frames):
+    '''Outgoing CCs for a CH18 fader throw, with & without coalescing'''
+    def throw(out):
+        for i in range(frames):
+            data = i * MIDI_LS9.CH_ON_VALUE // (frames - 1)
+            mapped_data = int((data / 16383.0) * (12288 - 4096) + 4096)
+            out.send_nrpn(MIDI_LS9.TABLA1_PEQ1, mapped_data)
+            out.send_nrpn(MIDI_LS9.TABLA2_PEQ1, mapped_data)
+            time.sleep(throw_time / frames)
+        return mapped_data
+
+    direct_out = FakeMidiOut()
+    throw(NrpnEncoder(direct_out))
+    coalesced_out = FakeMidiOut()
+    coalescer = NrpnCoalescer(NrpnEncoder(coalesced_out), max_rate)
+    final = throw(coalescer)
+    coalescer.stop()
+    click.echo(f'CH18 fader throw: {frames} frames in {throw_time}s, final PEQ value {hex(final)}')
+    click.echo(f'  direct:    {direct_out.messages:6d} CCs out')
+    click.echo(f'  coalesced: {coalesced_out.messages:6d} CCs out  {coalescer.flushes} flushes  '
+               f'{coalescer.dropped} intermediate values dropped')
+
+#### Automations: if/elif chain vs. AutomationEngine
+# the process_nrpn() chain of midi_yamaha_ls9.py before the rules were moved to automations.json
+_legacy_channel_states = dict.fromkeys([f'CH{i:02d}' for i in range(1, 15)], 'OFF')
+
+def _legacy_on_off_state(data):
+    if data == MIDI_LS9.CH_ON_VALUE:
+        return True
+    if data == MIDI_LS9.CH_OFF_VALUE:
+        return False
+    return None
+
+def _legacy_send_nrpn(midi_output, controller, data, force=False):
+    return midi_output.send_nrpn(int(controller), int(data), force)
+
+def _legacy_process_nrpn(controller, value, midi_out, continuous_out=None):
+    kind, channel, handler = MIDI_LS9.classify_nrpn_ctlr(controller)
+    if kind == MIDI_LS9.CTLR_KIND_FADER:
+        data = value
+        if handler == MIDI_LS9.HANDLER_CHORUS:
+            lead_ch = MIDI_LS9.CHORUS_TO_LEAD_MAPPING[channel]
+            if data < MIDI_LS9.FADE_60DB_VALUE and _legacy_channel_states[channel] == 'ON':
+                _legacy_channel_states[channel] = 'OFF'
+                out_data = MIDI_LS9.FADE_NEGINF_VALUE
+                logging.debug(f'MIXER IN: {channel} fade below -60dB')
+                logging.info(f'MIDI OUT: {channel}, {lead_ch} Send to MIX1,2 @ -inf dB')
+                _legacy_send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel], out_data)
+                _legacy_send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[lead_ch], out_data)
+            elif data > MIDI_LS9.FADE_50DB_VALUE and _legacy_channel_states[channel] == 'OFF':
+                _legacy_channel_states[channel] = 'ON'
+                out_data = MIDI_LS9.FADE_0DB_VALUE
+                logging.debug(f'MIXER IN: {channel} fade above -50dB')
+                logging.info(f'MIDI OUT: {channel}, {lead_ch} Send to MIX1,2 @ 0 dB')
+                _legacy_send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel], out_data)
+                _legacy_send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[lead_ch], out_data)
+        elif channel == 'CH18':
+            mapped_data = ((data-0)/(16383.0)*(12288-4096)+4096)
+            if continuous_out is None:
+                continuous_out = midi_out
+            _legacy_send_nrpn(continuous_out, MIDI_LS9.TABLA1_PEQ1, mapped_data)
+            _legacy_send_nrpn(continuous_out, MIDI_LS9.TABLA2_PEQ1, mapped_data)
+    if kind == MIDI_LS9.CTLR_KIND_ON_OFF:
+        data = _legacy_on_off_state(value)
+        if handler == MIDI_LS9.HANDLER_CHORUS:
+            alt_channel = MIDI_LS9.CHORUS_TO_LEAD_MAPPING[channel]
+            if data is True:
+                out_data = MIDI_LS9.CH_OFF_VALUE
+                logging.debug(f'MIXER IN: {channel} switched ON')
+                logging.info(f'MIDI OUT: {alt_channel} OFF')
+            else:
+                out_data = MIDI_LS9.CH_ON_VALUE
+                logging.debug(f'MIXER IN: {channel} switched OFF')
+                logging.info(f'MIDI OUT: {alt_channel} ON')
+            _legacy_send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[alt_channel], out_data)
+        elif handler == MIDI_LS9.HANDLER_LEAD:
+            alt_channel = MIDI_LS9.CHORUS_TO_LEAD_MAPPING.inv[channel]
+            if data is True:
+                out_data = MIDI_LS9.CH_OFF_VALUE
+                logging.debug(f'MIXER IN: {channel} switched ON')
+                logging.info(f'MIDI OUT: {alt_channel} OFF')
+            else:
+                out_data = MIDI_LS9.CH_ON_VALUE
+                logging.debug(f'MIXER IN: {channel} switched OFF')
+                logging.info(f'MIDI OUT: {alt_channel} ON')
+            _legacy_send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[alt_channel], out_data)
+        elif channel == 'MIX1' or channel == 'MIX2' and data is True:
+            _legacy_send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['ST LR'], MIDI_LS9.CH_ON_VALUE)
+        elif channel == 'ST LR' and data is False:
+            _legacy_send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['MIX1'], MIDI_LS9.CH_OFF_VALUE)
+        elif channel == 'ST-IN2':
+            if data is True:
+                logging.info('MIDI OUT: PC IN2 -> BASMNT')
+                out_data_mix16 = MIDI_LS9.FADE_0DB_VALUE
+                out_data_mono =  MIDI_LS9.FADE_NEGINF_VALUE
+            else:
+                logging.info('MIDI OUT: STREAM -> BASMNT')
+                out_data_mix16 = MIDI_LS9.FADE_NEGINF_VALUE
+                out_data_mono =  MIDI_LS9.FADE_0DB_VALUE
+            _legacy_send_nrpn(midi_out, MIDI_LS9.MIX16_SEND_TO_MT1, out_data_mix16)
+            _legacy_send_nrpn(midi_out, MIDI_LS9.MONO_SEND_TO_MT1,  out_data_mono)
+        elif channel == 'ST-IN3':
+            if data is True:
+                logging.info('MIDI OUT: PC IN2 -> LOBBY')
+                out_data_mix16 = MIDI_LS9.FADE_0DB_VALUE
+                out_data_stlr =  MIDI_LS9.FADE_NEGINF_VALUE
+            else:
+                logging.info('MIDI OUT: ST L/R -> LOBBY')
+                out_data_mix16 = MIDI_LS9.FADE_NEGINF_VALUE
+                out_data_stlr =  MIDI_LS9.FADE_0DB_VALUE
+            _legacy_send_nrpn(midi_out, MIDI_LS9.MIX16_SEND_TO_MT2, MIDI_LS9.FADE_NEGINF_VALUE)
+            _legacy_send_nrpn(midi_out, MIDI_LS9.STLR_SEND_TO_MT2,  MIDI_LS9.FADE_0DB_VALUE)
+        elif channel == 'ST-IN1':
+            if data is True:
+                logging.info('MIDI OUT: MONO -> LOUNGE')
+                out_data_mono = MIDI_LS9.FADE_0DB_VALUE
+                out_data_stlr = MIDI_LS9.FADE_NEGINF_VALUE
+            else:
+                logging.info('MIDI OUT: ST L/R -> LOUNGE')
+                out_data_mono = MIDI_LS9.FADE_NEGINF_VALUE
+                out_data_stlr = MIDI_LS9.FADE_0DB_VALUE
+            _legacy_send_nrpn(midi_out, MIDI_LS9.MONO_SEND_TO_MT3,  out_data_mono)
+            _legacy_send_nrpn(midi_out, MIDI_LS9.ST_LR_SEND_TO_MT3, out_data_stlr)
+
+#a show-like mix of traffic: fader sweeps on every channel, with CHR/LEAD & ST-IN buttons pressed in between
+def _show_events(steps=64):
+    events = [(((frame[0][2] << 7) | frame[1][2]), ((frame[2][2] << 7) | frame[3][2]))
+              for frame in fader_sweep_frames(steps)]
+    buttons = ['CH01', 'CH33', 'CH05', 'ST-IN1', 'ST-IN2', 'ST-IN3', 'MIX1', 'ST LR']
+    for i in range(0, len(events), 16):
+        channel = buttons[(i // 16) % len(buttons)]
+        data = MIDI_LS9.CH_ON_VALUE if (i // 16 // len(buttons)) % 2 else MIDI_LS9.CH_OFF_VALUE
+        events.insert(i, (MIDI_LS9.ON_OFF_CTLRS[channel], data))
+    return events
+
+@cli.command()
+@click.option('-r', '--repeat', default=5, show_default=True, type=int, help='Number of timed runs (best is kept)')
+def dispatch(repeat):
+    '''Automation cost per NRPN frame: if/elif chain vs. compiled rules'''
+    # only the dispatch is measured, not the log output
+    logging.disable(logging.INFO)
+    events = _show_events()
+    engine = AutomationEngine(load_automations(), NrpnEncoder(FakeMidiOut()))
+    legacy_out = NrpnEncoder(FakeMidiOut())
+    def time_events(process):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for controller, data in events:
+                process(controller, data)
+            elapsed = time.perf_counter_ns() - start
+            best = elapsed if best is None or elapsed < best else best
+        return best / len(events)
+
+    before = time_events(lambda controller, data: _legacy_process_nrpn(controller, data, legacy_out))
+    after =  time_events(engine.process)
+    click.echo(f'{len(events)} NRPN frames, {len(engine.rules)} rules bound to '
+               f'{len(engine.bound_controllers())} controllers')
+    click.echo(f'  if/elif chain:    {before:8.1f} ns/frame')
+    click.echo(f'  AutomationEngine: {after:8.1f} ns/frame')
+    click.echo(f'  speedup:          {before / after:8.2f}x')
+
+#### Input thread: processing in the rtmidi callback vs. MidiEventRing + MidiInputWorker
+# a MidiOut whose driver takes a while per message, like a busy USB MIDI interface
+class SlowMidiOut(FakeMidiOut):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def send_message(self, message):
+        super().send_message(message)
+        time.sleep(self.delay)
+
+@cli.command()
+@click.option('--delay', default=0.0005, show_default=True, type=float, help='Time taken by the MIDI driver per CC sent (s)')
+@click.option('--queue-size', default=4096, show_default=True, type=int, help='MidiEventRing capacity')
+@click.option('--overflow', default='drop-oldest', show_default=True, type=click.Choice(OVERFLOW_POLICIES))
+def queue(delay, queue_size, overflow):
+    '''Time the rtmidi callback blocks the MIDI input, with & without the input queue'''
+    logging.disable(logging.INFO)
+    messages = [message for controller, data in _show_events(8) for message in nrpn_frame(controller, data)]
+
+    def run(queued):
+        engine = AutomationEngine(load_automations(), NrpnEncoder(SlowMidiOut(delay)))
+        decoder = NrpnDecoder()
+        def process(message, timestamp, arrival=None):
+            if decoder.feed(message):
+                engine.process(decoder.controller, decoder.data)
+        if queued:
+            ring = MidiEventRing(queue_size, overflow)
+            worker = MidiInputWorker(ring, process)
+            callback = ring.put
+        else:
+            callback = process
+        times = []
+        for message in messages:
+            start = time.perf_counter_ns()
+            callback(message, 0.0)
+            times.append(time.perf_counter_ns() - start)
+        if queued:
+            worker.stop()
+            click.echo(f'  {ring.summary()}')
+        times.sort()
+        return times[len(times) // 2], times[len(times) * 99 // 100], times[-1]
+
+    click.echo(f'{len(messages)} CC messages, {delay * 1e3:.2f} ms per CC sent')
+    for name, queued in (('in callback', False), ('queued', True)):
+        p50, p99, worst = run(queued)
+        click.echo(f'  {name:12s} callback p50 {p50 / 1e3:8.1f} us  p99 {p99 / 1e3:8.1f} us  max {worst / 1e3:8.1f} us')
+
+#### MIDI input processed on a worker thread vs. on the asyncio event loop
+@cli.command()
+@click.option('-n', '--messages', default=4000, show_default=True, type=int, help='CC messages received')
+@click.option('--rate', default=4000.0, show_default=True, type=float, help='CC messages/sec, i.e. a scene fade')
+@click.option('--busy', default=0.0002, show_default=True, type=float, help='CPU time of each websocket message handled by the loop (s)')
+def loopinput(messages, rate, busy):
+    '''Latency from the rtmidi callback to the processing of a CC, thread worker vs. event loop'''
+    logging.disable(logging.INFO)
+
+    # put times, in order. the ring is a FIFO, so the nth message processed is the nth put
+    async def run(mode, websocket_traffic):
+        loop = asyncio.get_running_loop()
+        put_times = []
+        latencies = []
+        decoder = NrpnDecoder()
+        def process(message, timestamp, arrival):
+            latencies.append(time.perf_counter() - put_times[len(latencies)])
+            decoder.feed(message)
+        ring = MidiEventRing(messages)
+        if mode == 'loop':
+            midi_input = MidiLoopInput(ring, loop, process)
+        else:
+            midi_input = MidiInputWorker(ring, process)
+        frames = [message for i in range(messages // 4) for message in nrpn_frame(MIDI_LS9.FADER_CTLRS['CH01'], i & 0x3FFF)]
+        def rtmidi_thread():
+            for message in frames:
+                put_times.append(time.perf_counter())
+                midi_input.put(message, 1 / rate)
+                time.sleep(1 / rate)
+        stop = False
+        async def websockets():
+            while not stop:
+                end = time.perf_counter() + busy
+                while time.perf_counter() < end:
+                    pass
+                await asyncio.sleep(0)
+        traffic = asyncio.create_task(websockets()) if websocket_traffic else None
+        producer = threading.Thread(target=rtmidi_thread)
+        producer.start()
+        while producer.is_alive() or len(latencies) < len(frames):
+            await asyncio.sleep(0.01)
+        stop = True
+        if traffic is not None:
+            await traffic
+        midi_input.stop()
+        producer.join()
+        return sorted(latencies), getattr(midi_input, 'wakeups', None)
+
+    click.echo(f'{messages} CC messages at {rate:.0f}/s')
+    for mode, websocket_traffic in (('thread', False), ('thread', True), ('loop', False), ('loop', True)):
+        latencies, wakeups = asyncio.run(run(mode, websocket_traffic))
+        traffic = f'busy loop ({busy * 1e6:.0f} us/message)' if websocket_traffic else 'idle loop'
+        click.echo(f'  {mode:6s} {traffic:28s} latency p50 {_percentile(latencies, 50) * 1e6:7.1f} us  '
+                   f'p99 {_percentile(latencies, 99) * 1e6:7.1f} us' +
+                   ('' if wakeups is None else f'  {wakeups} loop wakeups'))
+
+#### Automation outputs: one send_nrpn() per output vs. pre-encoded macros
+# hides the macro support of an NrpnEncoder, so the engine sends every output on its own, like the
+# rules did before the macros
+class _PerOutputEncoder:
+    def __init__(self, encoder):
+        self.send_nrpn = encoder.send_nrpn
+
+@cli.command()
+@click.option('-n', '--triggers', default=20000, show_default=True, type=int, help='Triggers of each macro')
+def macro(triggers):
+    '''Trigger to last byte written latency of the largest automation macros'''
+    logging.disable(logging.INFO)
+    # the WLTBK toggle of the server is the largest macro (6 NRPNs). ST-IN4 also updates the WLTBK
+    # state of the wireless interlocks, as on the server
+    cases = (('ST-IN3 routing toggle (2 NRPNs)', load_automations(), 'ST-IN3'),
+             ('ST-IN4 WLTBK toggle, server (6 NRPNs)', load_automations(SERVER_AUTOMATIONS_FILE), 'ST-IN4'))
+    for name, rules, channel in cases:
+        controller = MIDI_LS9.ON_OFF_CTLRS[channel]
+        click.echo(name)
+        for output_name, make_midi_out in (('rtmidi', FakeMidiOut), ('rawmidi', lambda: RawMidiOut('/dev/null'))):
+            for mode in ('per output', 'macro'):
+                encoder = NrpnEncoder(make_midi_out())
+                engine = AutomationEngine(rules, encoder if mode == 'macro' else _PerOutputEncoder(encoder))
+                times = []
+                for i in range(triggers):
+                    data = MIDI_LS9.CH_ON_VALUE if i & 1 else MIDI_LS9.CH_OFF_VALUE
+                    # the outputs are written before process() returns
+                    start = time.perf_counter_ns()
+                    engine.process(controller, data)
+                    times.append(time.perf_counter_ns() - start)
+                times.sort()
+                click.echo(f'  {output_name:7s} {mode:10s}: p50 {_percentile(times, 50) / 1e3:6.2f} us  '
+                           f'p99 {_percentile(times, 99) / 1e3:6.2f} us  {encoder.writes / triggers:4.1f} writes/trigger')
+                encoder.midi_out.close_port()
+
+#### Scenes: naive send loop vs. diffed & paced recall
+@cli.command()
+@click.option('--rate', default=MIDI_WIRE_RATE, show_default=True, type=float, help='Pacing of the recall (bytes/sec)')
+def scene(rate):
+    '''Scene recall: every value at once vs. only the changes, paced at the MIDI wire rate'''
+    logging.disable(logging.INFO)
+    scenes = load_scenes()
+    for output_name, make_midi_out in (('rtmidi', FakeMidiOut), ('rawmidi', lambda: RawMidiOut('/dev/null'))):
+        for scene in scenes:
+            click.echo(f'{scene.name} ({len(scene.outputs)} values), {output_name}')
+            # naive: a send_nrpn() loop over the whole scene, as fast as the output takes it
+            encoder = NrpnEncoder(make_midi_out())
+            start = time.perf_counter()
+            for controller, data in scene.outputs:
+                encoder.send_nrpn(controller, data)
+            elapsed = time.perf_counter() - start
+            click.echo(f'  send loop:       {len(scene.outputs):3d} sent, {encoder.bytes_sent:4d} bytes in '
+                       f'{elapsed * 1000:7.2f} ms ({encoder.bytes_sent / elapsed / MIDI_WIRE_RATE:5.0f}x the MIDI wire rate)')
+            encoder.midi_out.close_port()
+            # recall onto an unknown console, then onto one that already holds every other value
+            for known in ('unknown', 'half'):
+                state = ConsoleState()
+                if known == 'half':
+                    for controller, data in scene.outputs[::2]:
+                        state.update(controller, data)
+                encoder = NrpnEncoder(make_midi_out(), state=state)
+                transfer = SceneRecaller(scenes, encoder, state, rate).transfer(scene)
+                click.echo(f'  recall, {known:7s}: {transfer.sent:3d} sent, {transfer.bytes_sent:4d} bytes in '
+                           f'{transfer.seconds * 1000:7.2f} ms, {transfer.skipped} skipped')
+                encoder.midi_out.close_port()
+
+#### Output scheduler: on/off latency behind fader-linked traffic, single FIFO vs. priority lanes
+# decodes what is written, and stamps the time each watched controller goes out
+class _StampingMidiOut(FakeMidiOut):
+    def __init__(self, watched):
+        super().__init__()
+        self.watched = watched
+        self.written = {}
+        self.decoder = NrpnDecoder()
+
+    def send_message(self, message):
+        if self.decoder.feed(message) and self.decoder.controller in self.watched:
+            self.written.setdefault(self.decoder.controller, time.perf_counter())
+
+@cli.command()
+@click.option('--faders', default=8, show_default=True, type=int, help='Fader-linked parameters moving at the same time')
+@click.option('--rate', default=50.0, show_default=True, type=float, help='Updates/sec of each of them')
+@click.option('--presses', default=40, show_default=True, type=int, help='ON/OFF presses during the motion, 50ms apart')
+@click.option('--output-rate', default=MIDI_WIRE_RATE, show_default=True, type=float, help='MIDI output rate (bytes/sec)')
+def scheduler(faders, rate, presses, output_rate):
+    '''ON/OFF latency while fader-linked parameters saturate the MIDI link: one FIFO vs. priority lanes'''
+    logging.disable(logging.INFO)
+    continuous = list(MIDI_LS9.MIX1_SOF_CTLRS.values())[:faders]
+    switches = list(MIDI_LS9.ON_OFF_CTLRS.values())[:presses]
+    click.echo(f'{faders} parameters at {rate:g} Hz = {faders * rate * 12:.0f} bytes/s offered, '
+               f'output limited to {output_rate:g} bytes/s')
+    for mode in ('fifo', 'lanes'):
+        midi_out = _StampingMidiOut(set(switches))
+        output = MidiOutputScheduler(NrpnEncoder(midi_out), output_rate, OUTPUT_BURST)
+        # fifo: everything in the order it was sent, as the encoder alone would
+        control_lane = output.lane(LANE_BULK if mode == 'fifo' else LANE_CONTROL)
+        continuous_lane = output.lane(LANE_BULK if mode == 'fifo' else LANE_CONTINUOUS)
+        stop = threading.Event()
+
+        def motion():
+            value = 0
+            while not stop.wait(1 / rate):
+                value = (value + 1) % 1024
+                for controller in continuous:
+                    continuous_lane.send_nrpn(controller, value)
+
+        mover = threading.Thread(target=motion)
+        mover.start()
+        submitted = {}
+        time.sleep(0.2)
+        for controller in switches:
+            submitted[controller] = time.perf_counter()
+            control_lane.send_nrpn(controller, MIDI_LS9.CH_OFF_VALUE)
+            time.sleep(0.05)
+        stop.set()
+        mover.join()
+        output.stop()
+        delays = sorted((midi_out.written[controller] - submitted[controller]) * 1000 for controller in switches)
+        sent = sum(lane.sent for lane in output.lanes)
+        coalesced = sum(lane.coalesced for lane in output.lanes)
+        click.echo(f'  {mode:5s}: ON/OFF latency p50 {_percentile(delays, 50):7.2f} ms, p99 {_percentile(delays, 99):7.2f} ms, '
+                   f'max {delays[-1]:7.2f} ms; {sent} sent, {coalesced} coalesced, {output.throttled:.2f}s throttled')
+
+#### Metrics: cost of the instrumentation on the MIDI path
+@cli.command()
+@click.option('-r', '--repeat', default=9, show_default=True, type=int, help='Number of timed runs (best is kept)')
+def metrics(repeat):
+    '''Per-message cost of the Prometheus metrics on the automation path, and of a scrape'''
+    logging.disable(logging.INFO)
+    messages = [message for controller, data in _show_events(64) for message in nrpn_frame(controller, data)]
+
+    # queue + decode + automations + output, through the MidiPipeline of midi_yamaha_ls9.py. the
+    # output is not rate limited, every automation output is written inline
+    def run(instrumented):
+        ring = MidiEventRing(len(messages), arrivals=instrumented)
+        pipeline = MidiPipeline(FakeMidiOut(), load_automations(), output_rate=0, watchdog=None)
+        registry = MetricsRegistry()
+        if instrumented:
+            pipeline.register_metrics(registry, ring)
+        start = time.perf_counter_ns()
+        for message in messages:
+            ring.put(message, 0.0)
+        for _ in range(len(messages)):
+            pipeline.process_cc_message(*ring.get())
+        elapsed = time.perf_counter_ns() - start
+        pipeline.stop()
+        return elapsed, registry
+
+    # the runs alternate, so a change of CPU clock or load hits both sides alike
+    results = {False: [], True: []}
+    for _ in range(repeat):
+        for instrumented in (False, True):
+            results[instrumented].append(run(instrumented)[0] / len(messages))
+    results = {instrumented: min(times) for instrumented, times in results.items()}
+    click.echo(f'{len(messages)} CCs, per CC: {results[False]:7.0f} ns without metrics, '
+               f'{results[True]:7.0f} ns with metrics ({results[True] - results[False]:+.0f} ns)')
+    registry = run(True)[1]
+    start = time.perf_counter_ns()
+    for _ in range(100):
+        text = registry.render()
+    click.echo(f'scrape: {(time.perf_counter_ns() - start) / 100 / 1e3:.1f} us to render {len(text)} bytes '
+               f'({len(text.splitlines())} lines)')
+
+#### Logging: formatting & writing on the MIDI thread vs. midi_logging
+# a log sink that takes a while per line, like a slow terminal or a busy journald
+class SlowStream:
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text):
+        self.lines += text.count('\n')
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+@cli.command('logging')
+@click.option('--delay', default=0.0002, show_default=True, type=float, help='Time taken by the log sink per write (s)')
+@click.option('--timeouts', default=1000, show_default=True, type=int, help='Number of frame timeout warnings in the storm')
+def logging_(delay, timeouts):
+    '''Per-message callback cost with eager vs. queued, lazy & rate limited logging'''
+    messages = [message for controller, data in _show_events(8) for message in nrpn_frame(controller, data)]
+    root = logging.getLogger()
+
+    def run(eager, log_level):
+        sink = SlowStream(delay)
+        if eager:
+            handler = logging.StreamHandler(sink)
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            for old_handler in root.handlers[:]:
+                root.removeHandler(old_handler)
+            root.addHandler(handler)
+            root.setLevel(log_level)
+        else:
+            listener = setup_logging(log_level, stream=sink)
+        engine = AutomationEngine(load_automations(), NrpnEncoder(FakeMidiOut()))
+        decoder = NrpnDecoder()
+        times = []
+        for message in messages:
+            start = time.perf_counter_ns()
+            if eager:
+                logging.debug(f'Received CC command {message}')
+            else:
+                logging.debug('Received CC command %s', message)
+            if decoder.feed(message):
+                engine.process(decoder.controller, decoder.data)
+            times.append(time.perf_counter_ns() - start)
+        start = time.perf_counter_ns()
+        for _ in range(timeouts):
+            logging.warning('Timeout! Resetting MIDI input buffer')
+        storm = (time.perf_counter_ns() - start) / timeouts
+        if not eager:
+            listener.stop()
+        times.sort()
+        return sum(times) / len(times), times[len(times) * 99 // 100], storm, sink.lines
+
+    click.echo(f'{len(messages)} CC messages, log sink {delay * 1e3:.2f} ms per write')
+    for level_name, log_level in (('INFO', logging.INFO), ('DEBUG', logging.DEBUG)):
+        for name, eager in (('eager', True), ('queued', False)):
+            mean, p99, storm, lines = run(eager, log_level)
+            click.echo(f'  {level_name:5s} {name:6s} mean {mean / 1e3:7.1f} us  p99 {p99 / 1e3:7.1f} us/message  '
+                       f'timeout storm {storm / 1e3:7.1f} us/warning  {lines:5d} lines written')
+
+#### Automation suite: the full input -> automations -> output path on synthetic show traffic
+VOCAL_CHANNELS = [f'CH{i:02d}' for i in range(1, 11)] + [f'CH{i:02d}' for i in range(33, 43)]
+
+def _fader_sweep_workload():
+    return [(((frame[0][2] << 7) | frame[1][2]), ((frame[2][2] << 7) | frame[3][2]))
+            for frame in fader_sweep_frames()]
+
+#vocal faders wobbling around the -60dB/-50dB thresholds of the send mute hysteresis
+def _schmitt_workload(cycles=50):
+    levels = [MIDI_LS9.FADE_60DB_VALUE - 0x40, MIDI_LS9.FADE_60DB_VALUE + 0x40,
+              MIDI_LS9.FADE_50DB_VALUE - 0x40, MIDI_LS9.FADE_50DB_VALUE + 0x40, MIDI_LS9.FADE_0DB_VALUE,
+              MIDI_LS9.FADE_50DB_VALUE - 0x40, MIDI_LS9.FADE_60DB_VALUE + 0x40]
+    return [(MIDI_LS9.FADER_CTLRS[channel], level)
+            for _ in range(cycles) for level in levels for channel in VOCAL_CHANNELS[:10]]
+
+#every CHR & LEAD button mashed ON & OFF
+def _button_storm_workload(cycles=100):
+    events = []
+    for cycle in range(cycles):
+        data = MIDI_LS9.CH_ON_VALUE if cycle % 2 else MIDI_LS9.CH_OFF_VALUE
+        events += [(MIDI_LS9.ON_OFF_CTLRS[channel], data) for channel in VOCAL_CHANNELS]
+    return events
+
+#CH18 thrown up & down, as fast as the LS9 reports the fader
+def _ch18_throw_workload(throws=10, steps=256):
+    ramp = [i * MIDI_LS9.CH_ON_VALUE // (steps - 1) for i in range(steps)]
+    return [(MIDI_LS9.FADER_CTLRS['CH18'], data)
+            for throw in range(throws) for data in (ramp if throw % 2 == 0 else ramp[::-1])]
+
+SUITE_WORKLOADS = {
+    'fader_sweep':  _fader_sweep_workload,
+    'schmitt':      _schmitt_workload,
+    'button_storm': _button_storm_workload,
+    'ch18_throw':   _ch18_throw_workload,
+}
+
+#runs the events through the same pipeline as midi_yamaha_ls9.py: decoder, automations, output
+# cache, console state & coalescer, and returns the per-frame latencies (ns) and CCs sent
+def _run_pipeline(events, max_rate):
+    midi_out = FakeMidiOut()
+    nrpn_out = NrpnEncoder(midi_out, cache=NrpnValueCache(NRPN_CACHE_MAX_AGE), state=ConsoleState())
+    continuous_out = NrpnCoalescer(nrpn_out, max_rate)
+    engine = AutomationEngine(load_automations(), nrpn_out, continuous_out)
+    decoder = NrpnDecoder()
+    frames = [nrpn_frame(controller, data) for controller, data in events]
+    latencies = []
+    start = time.perf_counter_ns()
+    for frame in frames:
+        frame_start = time.perf_counter_ns()
+        for message in frame:
+            if decoder.feed(message):
+                nrpn_out.note_received(decoder.controller, decoder.data)
+                engine.process(decoder.controller, decoder.data)
+        latencies.append(time.perf_counter_ns() - frame_start)
+    elapsed = time.perf_counter_ns() - start
+    continuous_out.stop()
+    return latencies, elapsed, midi_out.messages
+
+def _percentile(values, percent):
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+@cli.command()
+@click.option('-w', '--workload', 'workloads', multiple=True, type=click.Choice(list(SUITE_WORKLOADS)), help='Workload to run (default: all)')
+@click.option('-r', '--repeat', default=3, show_default=True, type=int, help='Runs per workload (best throughput is kept)')
+@click.option('--max-rate', default=NRPN_COALESCE_MAX_RATE, show_default=True, type=float, help='Coalescer flush rate (Hz)')
+@click.option('-o', '--output', default=None, metavar='PATH', type=click.Path(dir_okay=False), help='Save the results as JSON')
+@click.option('--compare', default=None, metavar='PATH', type=click.Path(exists=True, dir_okay=False), help='JSON results of a previous run to compare with')
+def suite(workloads, repeat, max_rate, output, compare):
+    '''Throughput, output & latency of the automations on synthetic console traffic'''
+    logging.disable(logging.INFO)
+    baseline = None
+    if compare is not None:
+        with open(compare) as results_file:
+            baseline = json.load(results_file)['workloads']
+    results = {}
+    for name in workloads or SUITE_WORKLOADS:
+        events = SUITE_WORKLOADS[name]()
+        best = None
+        for _ in range(repeat):
+            run = _run_pipeline(events, max_rate)
+            if best is None or run[1] < best[1]:
+                best = run
+        latencies, elapsed, sent = best
+        latencies.sort()
+        results[name] = {
+            'frames':          len(events),
+            'frames_per_sec':  round(len(events) / (elapsed / 1e9)),
+            'out_per_frame':   round(sent / len(events), 3),
+            'p50_us':          round(_percentile(latencies, 50) / 1e3, 2),
+            'p99_us':          round(_percentile(latencies, 99) / 1e3, 2),
+        }
+
+    click.echo(f'{"workload":14s} {"frames":>7s} {"frames/s":>10s} {"CC out/frame":>13s} {"p50 us":>8s} {"p99 us":>8s}')
+    for name, result in results.items():
+        click.echo(f'{name:14s} {result["frames"]:7d} {result["frames_per_sec"]:10d} {result["out_per_frame"]:13.3f} '
+                   f'{result["p50_us"]:8.2f} {result["p99_us"]:8.2f}')
+        if baseline is not None and name in baseline:
+            before = baseline[name]
+            click.echo(f'{"  vs. baseline":14s} {"":7s} {result["frames_per_sec"] / before["frames_per_sec"]:9.2f}x '
+                       f'{result["out_per_frame"] - before["out_per_frame"]:+13.3f} '
+                       f'{result["p50_us"] - before["p50_us"]:+8.2f} {result["p99_us"] - before["p99_us"]:+8.2f}')
+    if output is not None:
+        with open(output, 'w') as results_file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'workloads': results}, results_file, indent=4)
+        click.echo(f'Results saved to {output}')
+
+#### Client: new websocket connection per CC vs. WebsocketSender
+@cli.command()
+@click.option('-n', '--messages', default=300, show_default=True, type=int, help='CCs sent by the knob')
+@click.option('--interval', default=0.002, show_default=True, type=float, help='Time between two CCs of the knob (s)')
+def websocket(messages, interval):
+    '''Per-CC send latency & callback time of the websocket client, before and after'''
+    logging.disable(logging.WARNING)
+
+    async def run():
+        received = [0]
+        async def listener(connection):
+            try:
+                async for _ in connection:
+                    received[0] += 1
+            # the sender is cancelled at the end, without a clean close
+            except ConnectionClosed:
+                pass
+        async with serve(listener, 'localhost', 0) as server:
+            uri = f'ws://localhost:{server.sockets[0].getsockname()[1]}'
+
+            # before: the rtmidi callback opened a connection for every CC
+            def knob_connect_per_cc():
+                times = []
+                for i in range(messages):
+                    start = time.perf_counter()
+                    with sync_connect(uri) as connection:
+                        connection.send(f'{i % 128},{i % 128}')
+                    times.append(time.perf_counter() - start)
+                    time.sleep(interval)
+                return times
+            before = await asyncio.to_thread(knob_connect_per_cc)
+
+            # after: the callback only submits the CC, the event loop sends it on an open connection
+            sender = WebsocketSender(uri, asyncio.get_running_loop(), queue_size=messages)
+            sender_task = asyncio.create_task(sender.run())
+            await sender.connected.wait()
+            def knob_submit():
+                times = []
+                for i in range(messages):
+                    start = time.perf_counter()
+                    sender.submit(i % 128, i % 128)
+                    times.append(time.perf_counter() - start)
+                    time.sleep(interval)
+                return times
+            callback = await asyncio.to_thread(knob_submit)
+            while sender.sent < messages:
+                await asyncio.sleep(0.01)
+            sender_task.cancel()
+            try:
+                await sender_task
+            except asyncio.CancelledError:
+                pass
+            return before, callback, sorted(sender.latencies), received[0]
+
+    before, callback, after, received = asyncio.run(run())
+    before.sort()
+    callback.sort()
+    click.echo(f'{messages} CCs, one every {interval * 1e3:.1f} ms, {received} received by the server')
+    click.echo(f'  connect per CC:  send p50 {_percentile(before, 50) * 1e3:7.3f} ms  p99 {_percentile(before, 99) * 1e3:7.3f} ms  '
+               f'(all of it in the rtmidi callback)')
+    click.echo(f'  WebsocketSender: send p50 {_percentile(after, 50) * 1e3:7.3f} ms  p99 {_percentile(after, 99) * 1e3:7.3f} ms  '
+               f'callback p99 {_percentile(callback, 99) * 1e6:6.1f} us')
+
+#### Websocket protocol: one CSV text frame per CC vs. binary batches
+@cli.command()
+@click.option('-n', '--messages', default=20000, show_default=True, type=int, help='CCs sent in the load test')
+@click.option('--burst', default=32, show_default=True, type=int, help='CCs submitted at once, i.e. knobs turned together')
+def protocol(messages, burst):
+    '''Server decode cost & load test of the CSV and binary websocket formats'''
+    logging.disable(logging.WARNING)
+    ccs = [(i % 120, i % 128) for i in range(messages)]
+
+    # decode only, as done by websocket_listener
+    csv_frames = [encode_cc_csv(controller, data) for controller, data in ccs]
+    start = time.perf_counter_ns()
+    for frame in csv_frames:
+        cc_controller, cc_data = decode_cc_csv(frame)
+    csv_ns = (time.perf_counter_ns() - start) / messages
+    click.echo(f'Server decode, {messages} CCs')
+    click.echo(f'  CSV:                  {csv_ns:7.1f} ns/CC')
+    for batch in (1, 16, WS_BATCH_MAX):
+        frames = [encode_cc_batch([(controller, data, 0.001) for controller, data in ccs[i:i + batch]])
+                  for i in range(0, messages, batch)]
+        start = time.perf_counter_ns()
+        for frame in frames:
+            for cc_controller, cc_data, _ in decode_cc_batch(frame):
+                pass
+        binary_ns = (time.perf_counter_ns() - start) / messages
+        click.echo(f'  binary, {batch:3d} CCs/frame: {binary_ns:7.1f} ns/CC')
+
+    async def load_test(subprotocols):
+        received = [0, 0]
+        async def listener(connection):
+            binary = connection.subprotocol in WS_BINARY_SUBPROTOCOLS
+            try:
+                async for frame in connection:
+                    received[0] += 1
+                    if binary:
+                        for cc_controller, cc_data, _ in decode_cc_batch(frame):
+                            received[1] += 1
+                    else:
+                        cc_controller, cc_data = decode_cc_csv(frame)
+                        received[1] += 1
+            except ConnectionClosed:
+                pass
+        async with serve(listener, 'localhost', 0, select_subprotocol=select_ws_subprotocol) as server:
+            uri = f'ws://localhost:{server.sockets[0].getsockname()[1]}'
+            sender = WebsocketSender(uri, asyncio.get_running_loop(), queue_size=messages, subprotocols=subprotocols)
+            sender_task = asyncio.create_task(sender.run())
+            await sender.connected.wait()
+            cpu_start = time.process_time()
+            start = time.perf_counter()
+            for i in range(0, messages, burst):
+                for controller, data in ccs[i:i + burst]:
+                    sender.submit(controller, data)
+                await asyncio.sleep(0)
+            while received[1] < messages:
+                await asyncio.sleep(0.001)
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            sender_task.cancel()
+            await asyncio.gather(sender_task, return_exceptions=True)
+        return received[0], elapsed, cpu
+
+    click.echo(f'Load test over localhost, {messages} CCs in bursts of {burst} (client & server CPU)')
+    for name, subprotocols in (('CSV', []), ('binary', WS_SUBPROTOCOLS)):
+        frames, elapsed, cpu = asyncio.run(load_test(subprotocols))
+        click.echo(f'  {name:6s} {frames:6d} frames  {frames / elapsed:8.0f} frames/s  {messages / elapsed:8.0f} CCs/s  '
+                   f'{cpu / messages * 1e6:6.1f} us CPU/CC')
+
+#### Client: every CC vs. coalesced knob sweeps
+@cli.command()
+@click.option('--knobs', default=4, show_default=True, type=int, help='Knobs turned at the same time')
+@click.option('--rate', default=60.0, show_default=True, type=float, help='CCs/sec sent by each knob during a sweep')
+@click.option('--seconds', default=1.0, show_default=True, type=float, help='Duration of the sweep')
+def knob(knobs, rate, seconds):
+    '''Frames & CCs sent by the client for knob sweeps, at several flush intervals'''
+    logging.disable(logging.WARNING)
+    steps = int(rate * seconds)
+
+    async def sweep(flush_interval):
+        received = {}
+        frames = [0]
+        async def listener(connection):
+            binary = connection.subprotocol in WS_BINARY_SUBPROTOCOLS
+            try:
+                async for frame in connection:
+                    frames[0] += 1
+                    if binary:
+                        for cc_controller, cc_data, _ in decode_cc_batch(frame):
+                            received[cc_controller] = cc_data
+                    else:
+                        cc_controller, cc_data = decode_cc_csv(frame)
+                        received[cc_controller] = cc_data
+            except ConnectionClosed:
+                pass
+        async with serve(listener, 'localhost', 0, select_subprotocol=select_ws_subprotocol) as server:
+            uri = f'ws://localhost:{server.sockets[0].getsockname()[1]}'
+            sender = WebsocketSender(uri, asyncio.get_running_loop(), flush_interval=flush_interval)
+            sender_task = asyncio.create_task(sender.run())
+            await sender.connected.wait()
+            for step in range(steps):
+                for knob in range(knobs):
+                    sender.submit(knob, step * 127 // (steps - 1))
+                await asyncio.sleep(1 / rate)
+            # the knobs stopped, wait for the last flush
+            await asyncio.sleep(flush_interval + 0.05)
+            sender_task.cancel()
+            await asyncio.gather(sender_task, return_exceptions=True)
+        exact = all(received.get(knob) == 127 for knob in range(knobs))
+        return sender, frames[0], exact
+
+    click.echo(f'{knobs} knobs swept 0 -> 127 in {seconds}s at {rate:.0f} CCs/s each')
+    for flush_interval in (0.0, 0.01, 0.02, 0.05, 0.1):
+        sender, frames, exact = asyncio.run(sweep(flush_interval))
+        click.echo(f'  flush {flush_interval * 1e3:5.0f} ms: {sender.submitted:5d} CCs in, {sender.sent:5d} CCs out '
+                   f'({sender.submitted / max(sender.sent, 1):5.1f}:1) in {frames:4d} frames, '
+                   f'final positions {"exact" if exact else "WRONG"}')
+
+#### USB keyboard CCs: bidict lookups + float scaling vs. precomputed tables
+#the CC handling of websocket_listener before the lookup tables, as it was in midi_server_websockets.py
+def _legacy_process_usb_cc(midi_output, cc_controller, cc_data):
+    logging.debug('cc_controller=%s\tcc_data=%s', cc_controller, cc_data)
+    data = int((cc_data / 127.0) * 0xFFFF)
+    if cc_controller in MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS:
+        mix_name = MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS[cc_controller]
+        if mix_name == 'MT5':
+            controller = MIDI_LS9.FADER_CTLRS['MT5']
+        else:
+            controller = MIDI_LS9.MT5_SOF_CTRLS[mix_name]
+        logging.info('MIDI OUT: %s Send to MT5 @ %#x dB', mix_name, data)
+        _legacy_send_nrpn(midi_output, controller, data)
+    elif cc_controller in MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS:
+        mix_name = MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS[cc_controller]
+        if mix_name == 'MT6':
+            controller = MIDI_LS9.FADER_CTLRS['MT6']
+        else:
+            controller = MIDI_LS9.MT6_SOF_CTRLS[mix_name]
+        logging.info('MIDI OUT: %s Send to MT6 @ %#x dB', mix_name, data)
+        _legacy_send_nrpn(midi_output, controller, data)
+    else:
+        logging.error('The CC command received from USB keyboard is invalid! cc_controller=%s', cc_controller)
+
+class _NullNrpnOut:
+    def send_nrpn(self, controller, data, force=False):
+        return True
+
+@cli.command()
+@click.option('-n', '--messages', default=100000, show_default=True, type=int, help='CCs sent through the listener')
+@click.option('--batch', default=16, show_default=True, type=int, help='CCs per binary frame')
+@click.option('--repeat', default=5, show_default=True, type=int, help='Runs per measurement, the best one is kept')
+def usbcc(messages, batch, repeat):
+    '''Messages/sec through websocket_listener (decode + CC -> NRPN), bidicts vs. lookup tables'''
+    # INFO is where the listener logs every CC, it is measured without the logging cost
+    logging.disable(logging.INFO)
+    usb_ccs = list(MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS) + list(MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS)
+    ccs = [(usb_ccs[i % len(usb_ccs)], (i * 7) % 128) for i in range(messages)]
+    csv_frames = [encode_cc_csv(controller, data) for controller, data in ccs]
+    binary_frames = [encode_cc_batch([(controller, data, 0.001) for controller, data in ccs[i:i + batch]])
+                     for i in range(0, messages, batch)]
+
+    # the body of websocket_listener, for both message formats
+    def run_csv(process):
+        for frame in csv_frames:
+            cc_controller, cc_data = decode_cc_csv(frame)
+            process(cc_controller, cc_data)
+    def run_binary(process):
+        for frame in binary_frames:
+            for cc_controller, cc_data, _ in decode_cc_batch(frame):
+                process(cc_controller, cc_data)
+
+    def best_rate(run, process):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(process)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return messages / best
+
+    for output_name, make_output in (('MIDI output to memory', lambda: NrpnEncoder(FakeMidiOut())),
+                                     ('no MIDI output, mapping only', _NullNrpnOut)):
+        click.echo(f'{messages} USB keyboard CCs through the listener, {output_name}')
+        for name, run in (('CSV', run_csv), (f'binary, {batch} CCs/frame', run_binary)):
+            legacy = best_rate(run, partial(_legacy_process_usb_cc, make_output()))
+            click.echo(f'  {name}')
+            click.echo(f'    bidicts + float math:  {legacy:10,.0f} CCs/s')
+            for fader_law in FADER_LAWS:
+                tables = best_rate(run, UsbCcRouter(make_output(), fader_law).process)
+                click.echo(f'    tables, {fader_law:6s} law:   {tables:10,.0f} CCs/s ({tables / legacy:.2f}x)')
+
+#### Server -> client state push under continuous fader motion
+@cli.command()
+@click.option('--clients', default=4, show_default=True, type=int, help='Subscribed clients')
+@click.option('--faders', default=8, show_default=True, type=int, help='MT5/MT6 sends & faders moving at the same time')
+@click.option('--rate', default=100.0, show_default=True, type=float, help='Updates/sec of each fader, i.e. the console sending a fader throw')
+@click.option('--seconds', default=2.0, show_default=True, type=float, help='Duration of the motion')
+def statepush(clients, faders, rate, seconds):
+    '''Bandwidth per client of the state push, at several tick intervals'''
+    logging.disable(logging.WARNING)
+    controllers = (list(MIDI_LS9.MT5_SOF_CTRLS.values()) + list(MIDI_LS9.MT6_SOF_CTRLS.values()))[:faders]
+    steps = int(rate * seconds)
+
+    async def motion(tick):
+        state = ConsoleState()
+        publisher = StatePublisher(state, tick)
+        async def listener(connection):
+            await publisher.subscribe(connection)
+            try:
+                async for _ in connection:
+                    pass
+            except ConnectionClosed:
+                pass
+            finally:
+                publisher.unsubscribe(connection)
+        received = [[0, 0] for _ in range(clients)]
+        async def client(i, uri):
+            async with async_connect(uri, subprotocols=[WS_SUBPROTOCOL_STATE_V2]) as websocket:
+                async for frame in websocket:
+                    received[i][0] += 1
+                    received[i][1] += len(frame)
+        async with serve(listener, 'localhost', 0, select_subprotocol=select_ws_subprotocol) as server:
+            uri = f'ws://localhost:{server.sockets[0].getsockname()[1]}'
+            tasks = [asyncio.create_task(client(i, uri)) for i in range(clients)]
+            while len(publisher.subscribers) < clients:
+                await asyncio.sleep(0.01)
+            publisher_task = asyncio.create_task(publisher.run())
+            for step in range(steps):
+                for controller in controllers:
+                    state.update(controller, step * MIDI_LS9.FADE_10DB_VALUE // max(steps - 1, 1))
+                await asyncio.sleep(1 / rate)
+            await asyncio.sleep(tick * 2 + 0.05)
+            publisher_task.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(publisher_task, *tasks, return_exceptions=True)
+        return received
+
+    updates = steps * len(controllers)
+    # one frame per update: kind byte + one record, plus the 2 bytes of websocket framing
+    unbatched = updates * (1 + 4 + 2) / seconds
+    click.echo(f'{len(controllers)} faders moving at {rate:.0f} updates/s for {seconds}s, {clients} clients')
+    click.echo(f'  every update pushed on its own: {unbatched / 1024:7.2f} KiB/s per client')
+    for tick in (0.01, 0.02, 0.05, 0.1):
+        received = asyncio.run(motion(tick))
+        frames = sum(frame_count for frame_count, _ in received) / clients
+        # payload + 2 bytes of websocket framing per frame (server frames are not masked)
+        wire = sum(size for _, size in received) / clients + 2 * frames
+        click.echo(f'  tick {tick * 1e3:4.0f} ms: {frames / seconds:6.1f} frames/s, {wire / seconds / 1024:7.2f} KiB/s per client '
+                   f'({unbatched / (wire / seconds):5.1f}x less)')
+
+#### Startup: process start to the first NRPN frame processed, on a virtual MIDI port
+STARTUP_PROGRAMS = {'automations': 'midi_yamaha_ls9.py', 'websockets': 'midi_server_websockets.py'}
+
+@cli.command()
+@click.option('-r', '--repeat', default=10, show_default=True, type=int, help='Starts of the program per port mode')
+@click.option('--program', default='automations', show_default=True, type=click.Choice(list(STARTUP_PROGRAMS)), help='Program to start')
+@click.option('--port-name', default='LS9 startup benchmark', show_default=True, help='Name of the virtual MIDI port')
+@click.option('--timeout', default=10.0, show_default=True, type=float, help='Seconds to wait for the first frame of a start')
+def startup(repeat, program, port_name, timeout):
+    '''Process start to first NRPN frame processed, on a virtual MIDI port (needs ALSA & python-rtmidi)'''
+    # only this benchmark needs a MIDI API, the others run anywhere
+    import rtmidi
+    logging.disable(logging.INFO)
+    # the program reads what to_program sends, and its automation output goes to from_program
+    to_program = rtmidi.MidiOut()
+    to_program.open_virtual_port(port_name)
+    from_program = rtmidi.MidiIn()
+    from_program.open_virtual_port(port_name)
+    decoder = NrpnDecoder()
+    answered = threading.Event()
+
+    def on_output(event, unused):
+        if decoder.feed(event[0]):
+            answered.set()
+    from_program.set_callback(on_output)
+    # CH01 ON, switches its LEAD channel OFF (automations.json)
+    frame = nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE)
+
+    # port lookup in this process: listing the ports vs. checking the cached number
+    probe = rtmidi.MidiIn()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache_path = os.path.join(cache_dir, 'ports.json')
+        find_midi_port(probe, port_name, cache_path)
+        for label, path in (('list the ports', None), ('cached number', cache_path)):
+            start = time.perf_counter_ns()
+            for _ in range(100):
+                find_midi_port(probe, port_name, path)
+            click.echo(f'Port lookup by name, {label:14s}: {(time.perf_counter_ns() - start) / 100 / 1000:8.1f} us')
+    number = str(find_midi_port(probe, port_name, None))
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), STARTUP_PROGRAMS[program])
+    timings = {'number': [], 'name': []}
+    for _ in range(repeat):
+        for mode, port in (('number', number), ('name', port_name)):
+            answered.clear()
+            decoder.clear_pending()
+            command = [sys.executable, script, '--port', port, '--metrics-port', '0']
+            start = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                # the frame is sent until the program answers, it goes nowhere until the port is open
+                while not answered.wait(0.001):
+                    if process.poll() is not None:
+                        raise click.ClickException(f'{" ".join(command)} exited with {process.returncode}')
+                    if time.perf_counter() - start > timeout:
+                        raise click.ClickException(f'No answer from {" ".join(command)} in {timeout:g}s')
+                    for message in frame:
+                        to_program.send_message(message)
+                timings[mode].append((time.perf_counter() - start) * 1000)
+            finally:
+                process.send_signal(signal.SIGINT)
+                try:
+                    process.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+    click.echo(f'{program}: process start -> first frame processed, {repeat} starts')
+    for mode, values in timings.items():
+        values.sort()
+        click.echo(f'  --port by {mode:6s}: median {_percentile(values, 50):7.1f} ms, min {values[0]:7.1f} ms, '
+                   f'max {values[-1]:7.1f} ms')
+    for midi_io in (probe, to_program, from_program):
+        midi_io.close_port()
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,226 @@
+#!../bin/python3
+####################################################################################################
+################################### MIDI capture & replay for LS9 ##################################
+#### - Usage:
+####   > Capture: run the console tool with --capture, every CC received is saved
+####       midi_yamaha_ls9.py --console NRPN --capture sunday.ls9cap
+####   > Replay a capture into the automations (no MIDI device needed), at 60x speed:
+####       midi_capture.py replay sunday.ls9cap --speed 60
+####   > Replay a capture out to a MIDI port, in real time:
+####       midi_capture.py replay sunday.ls9cap --to port --port 1
+####   > Profile the automations on a capture (see midi_profile.py):
+####       midi_capture.py replay sunday.ls9cap --speed 0 --quiet --profile replay.folded
+####   > Show what is in a capture:
+####       midi_capture.py info sunday.ls9cap
+####
+#### - Description:
+####   A capture file is a CAPTURE_MAGIC header followed by fixed size records, one per CC message:
+####   <delta time: float64 seconds> <status> <data1> <data2> <pad>, little endian (12 bytes).
+####   The delta time is the one rtmidi gives the callback, i.e. the time since the previous message.
+####   CaptureWriter writes the file from a background thread, so the rtmidi callback never waits on
+####   the disk. CaptureReader memory-maps the file, a capture of a whole service is read in place.
+####   A replay into the automations runs through the same MidiPipeline as midi_yamaha_ls9.py
+####   (scenes, output scheduler & rate included). Incomplete frames are timed out from the recorded
+####   delta times, so the replay drops the same frames whatever its speed.
+import logging
+import mmap
+import queue
+import struct
+import threading
+import time
+
+import click
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+from midi_nrpn import NrpnDecoder, MIDI_WIRE_RATE
+from midi_logging import setup_logging
+from midi_ports import open_midi_port
+from midi_pipeline import MidiPipeline
+from yamaha_ls9_automations import load_automations, DEFAULT_AUTOMATIONS_FILE
+from yamaha_ls9_scenes import load_scenes, DEFAULT_SCENES_FILE
+from midi_profile import SamplingProfiler, PROFILE_SECONDS
+
+CAPTURE_MAGIC = b'LS9CAP1\0'
+CAPTURE_RECORD = struct.Struct('<d3Bx')
+
+
+# Appends CC messages to a capture file. write() only queues the record, the file is written by
+# a background thread
+class CaptureWriter:
+    def __init__(self, path, name='midi-capture-writer'):
+        self.path = path
+        self.records = 0
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def write(self, message, delta_time):
+        self._queue.put(CAPTURE_RECORD.pack(delta_time, message[0], message[1], message[2]))
+        self.records += 1
+
+    # writes what is left in the queue & closes the file
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            self._file.write(record)
+
+
+# Reads a capture file in place. Iterating it gives ([status, data1, data2], delta_time) tuples
+class CaptureReader:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as capture_file:
+            try:
+                self._map = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                raise ValueError(f'{path}: not an LS9 MIDI capture') from None
+        if self._map[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            self._map.close()
+            raise ValueError(f'{path}: not an LS9 MIDI capture')
+        # a capture cut short (i.e. power loss) may end with a partial record, which is ignored
+        self._count = (len(self._map) - len(CAPTURE_MAGIC)) // CAPTURE_RECORD.size
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        unpack_from = CAPTURE_RECORD.unpack_from
+        for offset in range(len(CAPTURE_MAGIC),
+                            len(CAPTURE_MAGIC) + self._count * CAPTURE_RECORD.size, CAPTURE_RECORD.size):
+            delta_time, status, data1, data2 = unpack_from(self._map, offset)
+            yield [status, data1, data2], delta_time
+
+    # seconds from the first to the last message (the delta time of the first one is not counted)
+    def duration(self):
+        total = 0.0
+        for offset in range(len(CAPTURE_MAGIC) + CAPTURE_RECORD.size,
+                            len(CAPTURE_MAGIC) + self._count * CAPTURE_RECORD.size, CAPTURE_RECORD.size):
+            total += CAPTURE_RECORD.unpack_from(self._map, offset)[0]
+        return total
+
+    def close(self):
+        self._map.close()
+
+
+# Calls send(message, delta_time) for every message of the capture, spaced out like they were
+# received, speed times faster. speed=0 replays as fast as possible. The pacing follows the
+# timeline of the capture, so time spent in send() does not add up into drift.
+def replay(reader, send, speed=1.0, clock=time.perf_counter, sleep=time.sleep):
+    start = clock()
+    at = 0.0
+    for i, (message, delta_time) in enumerate(reader):
+        if speed > 0 and i > 0:
+            at += delta_time / speed
+            remaining = start + at - clock()
+            if remaining > 0:
+                sleep(remaining)
+        send(message, delta_time)
+
+
+# in-memory MIDI output used when replaying into the automations without a MIDI port
+class CountingMidiOut:
+    def __init__(self):
+        self.messages = 0
+
+    def send_message(self, message):
+        self.messages += 1
+
+    def close_port(self):
+        pass
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.argument('capture', type=click.Path(exists=True, dir_okay=False))
+def info(capture):
+    '''Number of messages, NRPN frames & duration of a capture'''
+    reader = CaptureReader(capture)
+    decoder = NrpnDecoder()
+    for message, _ in reader:
+        if message[0] == MIDI_LS9.CC_CMD_BYTE:
+            decoder.feed(message)
+    click.echo(f'{capture}: {len(reader)} CC messages, {decoder.frames} NRPN frames, {reader.duration():.1f}s')
+    reader.close()
+
+@cli.command('replay')
+@click.argument('capture', type=click.Path(exists=True, dir_okay=False))
+@click.option('-s', '--speed', default=1.0, show_default=True, type=float, help='Replay speed, 1 = real time, 0 = as fast as possible')
+@click.option('-t', '--to', 'target', default='engine', show_default=True, type=click.Choice(['engine', 'port']), help='Feed the automations, or send the CCs out to a MIDI port')
+@click.option('-p', '--port', default=None, metavar='PORT', help='MIDI output port number or part of its name (required with --to port; with --to engine, where the automation output goes)')
+@click.option('-a', '--automations', default=DEFAULT_AUTOMATIONS_FILE, metavar='PATH', show_default=True, type=click.Path(exists=True, dir_okay=False), help='Automation rules file')
+@click.option('--scenes', default=DEFAULT_SCENES_FILE, metavar='PATH', show_default=True, type=click.Path(exists=True, dir_okay=False), help='Scene file, for the scene_recall automations')
+@click.option('--output-rate', default=MIDI_WIRE_RATE, metavar='BYTES/S', show_default=True, type=click.FloatRange(min=0), help='Limit the automation output to this many bytes/sec, like the MIDI link (0 = no limit)')
+@click.option('-v', '--verbose', is_flag=True, default=False, help='Set logging level to DEBUG')
+@click.option('-q', '--quiet', is_flag=True, default=False, help='Do not log the automation output, i.e. when profiling')
+@click.option('--profile', default=None, metavar='PATH', type=click.Path(dir_okay=False), help='Profile the replay (--to engine), write the collapsed stacks (flamegraph) to PATH & a per-function summary to PATH.txt')
+@click.option('--profile-seconds', default=PROFILE_SECONDS, metavar='SECONDS', show_default=True, type=click.FloatRange(min=0, min_open=True), help='Length of the profiling window')
+def replay_command(capture, speed, target, port, automations, scenes, output_rate, verbose, quiet, profile, profile_seconds):
+    '''Replay a capture into the automations or out to a MIDI port'''
+    if quiet:
+        log_level = logging.WARNING
+    elif verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+    setup_logging(log_level)
+    reader = CaptureReader(capture)
+    midi_out = CountingMidiOut()
+    if port is not None:
+        # only needed when a MIDI port is used, replaying into the automations works without ALSA
+        import rtmidi
+        midi_out = rtmidi.MidiOut()
+        open_midi_port(midi_out, port)
+    elif target == 'port':
+        raise click.UsageError('--to port needs --port')
+
+    if target == 'port':
+        send = lambda message, delta_time: midi_out.send_message(message)
+    else:
+        # no watchdog: the time of the replay is not the one of the capture, the pipeline times the
+        # frames out from the recorded delta times instead
+        pipeline = MidiPipeline(midi_out, load_automations(automations), load_scenes(scenes),
+                                output_rate=output_rate, watchdog=None)
+        def send(message, delta_time):
+            if message[0] == MIDI_LS9.CC_CMD_BYTE:
+                pipeline.process_cc_message(message, delta_time)
+
+    click.echo(f'Replaying {len(reader)} CC messages ({reader.duration():.1f}s) from {capture} at '
+               f'{f"{speed}x" if speed > 0 else "max"} speed')
+    # the window is cut short if the replay ends first
+    profiler = SamplingProfiler(profile, profile_seconds).start() if profile is not None else None
+    start = time.perf_counter()
+    try:
+        replay(reader, send, speed)
+    except KeyboardInterrupt:
+        logging.warning('CTRL+C pressed. Replay stopped')
+    elapsed = time.perf_counter() - start
+    if profiler is not None:
+        profiler.stop()
+    if target == 'engine':
+        # the output still queued is sent at the output rate
+        pipeline.stop()
+        click.echo(f'{pipeline.decoder.frames} NRPN frames processed in {elapsed:.3f}s, '
+                   f'{pipeline.frame_timeouts.value} incomplete frames timed out')
+        for summary in pipeline.summaries():
+            click.echo(summary)
+    else:
+        click.echo(f'{len(reader)} CC messages sent in {elapsed:.3f}s')
+    midi_out.close_port()
+    reader.close()
+
+if __name__ == '__main__':
+    cli()
@@ -10,16 +10,17 @@
 ####   with CC (control change) knobs/faders. The usb midi device connects via USB to a raspberry pi
 ####   (or similar SFF SBC), and the pi connects to Wi-Fi. The pi via this code will create
 ####   a websockets connection to this code and send over any 3-byte CC commands as
-####   a csv formatted string to the websockets port.
+####   a csv formatted string to the websockets port, or in batches as binary frames if the server
+####   supports it (see midi_ws_protocol.py)
+####   The connection is opened once and kept open (and re-opened if it drops), see midi_ws_sender.py
 ####
 #### - pip Package Reference:
 ####     https://pypi.org/project/python-rtmidi/
 ####     https://pypi.org/project/websockets/
-####     https://pypi.org/project/bidict/
 ####     https://pypi.org/project/click/
 ####
 #### - Requirements:
-####   This code requires a python venv with packages python-rtmidi & bidict installed.
+####   This code requires a python venv with packages python-rtmidi, websockets & click installed.
 ####   Here are the steps
 ####       apt update
 ####       apt install python-venv -y
@@ -27,7 +28,7 @@
 ####       cd ls9-midi
 ####       git clone https://github.com/joewawaw/ls9-midi src
 ####       source bin/activate
-####       pip install python-rtmidi bidict websockets click
+####       pip install python-rtmidi websockets click
 ####       cd src
 ####       ./midi_server_websockets.py
 import logging
@@ -36,51 +37,58 @@ import sys
 
 import rtmidi
 import click
-from websockets.sync.client import connect
 
 # my constants
 import yamaha_ls9_constants as MIDI_LS9
+from midi_logging import setup_logging
+from midi_ports import open_midi_port
+from midi_ws_sender import WebsocketSender, WS_SEND_QUEUE_SIZE, WS_FLUSH_INTERVAL
+from midi_ws_protocol import WS_SUBPROTOCOLS
 
 # Click wrapper for the async main function
 @click.command()
 @click.option('-v', '--verbose', is_flag=True, default=False, help='Set logging level to DEBUG')
-@click.option('-p', '--port', default=0, metavar='PORT', show_default=True, type=int, help='Specify MIDI port number')
+@click.option('-p', '--port', default='0', metavar='PORT', show_default=True, help='Specify MIDI port number, or part of the port name (i.e. UM-ONE)')
 @click.option('--ip', default='localhost:8001', metavar='HOSTNAME:PORT', show_default=True, type=str, help='Specify hostname and port number')
-def main(port, ip, verbose):
-    asyncio.run(async_main(port, ip, verbose))
+@click.option('--queue-size', default=WS_SEND_QUEUE_SIZE, metavar='N', show_default=True, type=click.IntRange(min=1), help='CCs kept while the connection is down (the oldest are dropped)')
+@click.option('--csv', is_flag=True, default=False, help='Send one "ctrl,data" text message per CC, even if the server knows the binary protocol')
+@click.option('--flush-interval', default=WS_FLUSH_INTERVAL * 1000, metavar='MS', show_default=True, type=click.FloatRange(min=0), help='Send only the newest value of each knob, at most once every MS (0 = send every CC)')
+def main(port, ip, verbose, queue_size, csv, flush_interval):
+    asyncio.run(async_main(port, ip, verbose, queue_size, csv, flush_interval / 1000))
 
-async def async_main(midi_port, hostname_port, is_verbose):
-    def websockets_send(host, controller, data):
-        with connect(f'ws://{host}') as websocket:
-            websocket.send(f'{int(controller)},{int(data)}')
+async def async_main(midi_port, hostname_port, is_verbose, queue_size, csv, flush_interval):
+    subprotocols = [] if csv else WS_SUBPROTOCOLS
+    sender = WebsocketSender(f'ws://{hostname_port}', asyncio.get_running_loop(), queue_size,
+                             subprotocols=subprotocols, flush_interval=flush_interval)
 
+    # the CC is handed over to the event loop, which owns the websocket connection
     def midi_cc_callback(event, unused):
         message, timestamp = event
         if message[0] == MIDI_LS9.CC_CMD_BYTE:
-            logging.debug(f'CC Message    {message[0]}\t{message[1]}\t{message[2]}')
-            logging.info(f'Websocket Send "{message[1]},{message[2]}"')
-            websockets_send(hostname_port, message[1], message[2])
+            logging.debug('CC Message    %d\t%d\t%d', message[0], message[1], message[2])
+            sender.submit(message[1], message[2])
 
     if is_verbose:
         log_level = logging.DEBUG
     else:
         log_level = logging.INFO
-    logging.basicConfig(format='%(asctime)s %(message)s', level=log_level)
+    # records are written by a background thread, see midi_logging.py
+    setup_logging(log_level, '%(asctime)s %(message)s')
     logging.info('MIDI USB Keyboard to websockets Client')
     logging.info('Press CTRL+C to exit')
-    logging.info(f'Connecting to ws://{hostname_port} ...')
+    logging.info('Connecting to ws://%s ...', hostname_port)
 
     midi_in = rtmidi.MidiIn()
-    midi_in.open_port(midi_port)
+    open_midi_port(midi_in, midi_port)
     midi_in.set_callback(midi_cc_callback)
 
     try:
-        while True:
-            await asyncio.sleep(0.05)
-    except KeyboardInterrupt:
+        await sender.run()
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print('Exiting...')
     finally:
         midi_in.close_port()
+        logging.info(sender.summary())
         sys.exit()
 
 if __name__ == '__main__':
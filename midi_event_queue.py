@@ -0,0 +1,245 @@
+####################################################################################################
+################################ MIDI input queue & worker thread ##################################
+#### - Description:
+####   The rtmidi input callback runs on rtmidi's own thread. Anything slow done there (a log sink,
+####   a burst of output) stalls the input and overflows rtmidi's queue. Instead, the callback only
+####   pushes the raw CC messages into a MidiEventRing, and a MidiInputWorker thread pops them to
+####   decode the NRPN frames, run the automations & write the output.
+####
+####   What happens when the ring is full is set by its overflow policy:
+####   > block:       the callback waits for the worker to make room (nothing is lost)
+####   > drop-oldest: the oldest message in the ring is overwritten (the input never waits)
+####   > drop-newest: the new message is dropped (the input never waits)
+####   A dropped message leaves at most one NRPN frame incomplete, the decoder resyncs on the next one.
+####
+####   Programs that run an asyncio event loop (midi_server_websockets.py) can process the messages
+####   on the loop instead, with a MidiLoopInput: the callback wakes the loop up once per burst of
+####   messages, with call_soon_threadsafe(), and the loop drains the ring. MIDI, the NRPN frame
+####   timeout (LoopFrameWatchdog in midi_nrpn.py) & websocket traffic then share one scheduler.
+import logging
+import threading
+import time
+from array import array
+from collections import deque
+
+OVERFLOW_BLOCK =       'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_DROP_NEWEST = 'drop-newest'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST)
+
+# number of CC messages the ring holds (4 per NRPN frame), so about 1s of a 64-fader scene fade
+MIDI_QUEUE_SIZE = 4096
+# where the MIDI input is processed: on the asyncio event loop (MidiLoopInput) or on a
+# MidiInputWorker thread
+MIDI_INPUT_LOOP =   'loop'
+MIDI_INPUT_THREAD = 'thread'
+MIDI_INPUT_MODES = (MIDI_INPUT_LOOP, MIDI_INPUT_THREAD)
+# messages processed by MidiLoopInput before it lets the rest of the loop run
+MIDI_LOOP_BATCH = 64
+# number of callback -> loop latencies kept for the summary percentiles
+MIDI_LATENCY_SAMPLES = 4096
+
+
+# Bounded FIFO of 3 byte MIDI messages & their rtmidi timestamps, preallocated so that a push does
+# not allocate anything. Safe for one or more producers & consumers.
+# With arrivals=True, the time.perf_counter() of every put() is kept too, and returned by get() with
+# its message (i.e. for the latency metric, see midi_output_scheduler.py)
+class MidiEventRing:
+    def __init__(self, capacity=MIDI_QUEUE_SIZE, overflow=OVERFLOW_DROP_OLDEST, arrivals=False):
+        if capacity < 1:
+            raise ValueError(f'MidiEventRing capacity must be at least 1, got {capacity}')
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {overflow!r}, expected one of {", ".join(OVERFLOW_POLICIES)}')
+        self.capacity = capacity
+        self.overflow = overflow
+        self._bytes = array('B', bytes(3 * capacity))
+        self._times = array('d', bytes(8 * capacity))
+        self._arrivals = array('d', bytes(8 * capacity)) if arrivals else None
+        self._head = 0    # next slot to read
+        self._count = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full =  threading.Condition(self._lock)
+        self.pushed = 0
+        self.overflows = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def arrivals(self):
+        return self._arrivals is not None
+
+    # called from the rtmidi callback. returns False if the message was dropped (drop-newest or
+    # after close()). with drop-oldest, the message is always queued
+    def put(self, message, timestamp):
+        with self._lock:
+            if self._closed:
+                return False
+            if self._count == self.capacity:
+                self.overflows += 1
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    return False
+                if self.overflow == OVERFLOW_DROP_OLDEST:
+                    self._head = (self._head + 1) % self.capacity
+                    self._count -= 1
+                else:
+                    while self._count == self.capacity and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+            slot = (self._head + self._count) % self.capacity
+            self._bytes[3 * slot] =     message[0]
+            self._bytes[3 * slot + 1] = message[1]
+            self._bytes[3 * slot + 2] = message[2]
+            self._times[slot] = timestamp
+            if self._arrivals is not None:
+                self._arrivals[slot] = time.perf_counter()
+            self._count += 1
+            self.pushed += 1
+            if self._count > self.high_water:
+                self.high_water = self._count
+            self._not_empty.notify()
+            return True
+
+    # blocks until a message is available and returns ([status, data1, data2], timestamp, arrival),
+    # arrival is None without arrivals. returns None once the ring is closed and empty, or after
+    # timeout seconds without any message
+    def get(self, timeout=None):
+        with self._lock:
+            while self._count == 0:
+                if self._closed:
+                    return None
+                if not self._not_empty.wait(timeout):
+                    return None
+            slot = self._head
+            message = [self._bytes[3 * slot], self._bytes[3 * slot + 1], self._bytes[3 * slot + 2]]
+            timestamp = self._times[slot]
+            arrival = self._arrivals[slot] if self._arrivals is not None else None
+            self._head = (slot + 1) % self.capacity
+            self._count -= 1
+            self._not_full.notify()
+            return message, timestamp, arrival
+
+    # refuse new messages & wake up everyone waiting. messages already queued can still be read
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def summary(self):
+        return f'MIDI input queue: {self.pushed} messages queued, high-water mark ' \
+               f'{self.high_water}/{self.capacity}, {self.overflows} overflows ({self.overflow})'
+
+
+# Thread that pops the messages out of a MidiEventRing and hands them to
+# process(message, timestamp, arrival) in order. An exception in process() is logged and the worker
+# carries on with the next message.
+class MidiInputWorker:
+    def __init__(self, ring, process, name='midi-input-worker'):
+        self.ring = ring
+        self.processed = 0
+        self.errors = 0
+        self._process = process
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # called from the rtmidi callback, same as ring.put()
+    def put(self, message, timestamp):
+        return self.ring.put(message, timestamp)
+
+    # processes what is left in the ring, then returns
+    def stop(self):
+        self.ring.close()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            event = self.ring.get()
+            if event is None:
+                return
+            try:
+                self._process(*event)
+            # we will catch all exceptions to make this system a big more rugged.
+            except Exception as e:
+                self.errors += 1
+                logging.exception('Automation failed: %s', e)
+            self.processed += 1
+
+# Hands the messages of a MidiEventRing to process(message, timestamp, arrival) on an asyncio event
+# loop. The rtmidi callback calls put() instead of ring.put(). Only the first message of a burst
+# wakes the loop up, the ones that arrive before it ran are drained by the same wakeup.
+class MidiLoopInput:
+    def __init__(self, ring, loop, process, batch=MIDI_LOOP_BATCH):
+        self.ring = ring
+        self.loop = loop
+        self.batch = batch
+        self.processed = 0
+        self.errors = 0
+        self.wakeups = 0
+        # seconds from the callback that woke the loop up to the loop processing its message
+        self.latencies = deque(maxlen=MIDI_LATENCY_SAMPLES)
+        self._process = process
+        self._lock = threading.Lock()
+        self._wake_time = None
+
+    # called from the rtmidi callback
+    def put(self, message, timestamp):
+        if not self.ring.put(message, timestamp):
+            return False
+        with self._lock:
+            if self._wake_time is not None:
+                return True
+            self._wake_time = time.perf_counter()
+        self.loop.call_soon_threadsafe(self._drain)
+        return True
+
+    def _drain(self):
+        self.wakeups += 1
+        with self._lock:
+            self.latencies.append(time.perf_counter() - self._wake_time)
+            self._wake_time = None
+        # messages put from now on wake the loop up again, so none is left behind
+        for _ in range(self.batch):
+            if not self._process_next():
+                return
+        # more than a batch is queued, let the websockets run before the next one
+        if len(self.ring):
+            with self._lock:
+                if self._wake_time is not None:
+                    return
+                self._wake_time = time.perf_counter()
+            self.loop.call_soon(self._drain)
+
+    # returns False if the ring is empty
+    def _process_next(self):
+        event = self.ring.get(0)
+        if event is None:
+            return False
+        try:
+            self._process(*event)
+        # we will catch all exceptions to make this system a big more rugged.
+        except Exception as e:
+            self.errors += 1
+            logging.exception('Automation failed: %s', e)
+        self.processed += 1
+        return True
+
+    # refuses new messages & processes what is left in the ring. called on the loop
+    def stop(self):
+        self.ring.close()
+        while self._process_next():
+            pass
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        if latencies:
+            latency = f', callback -> loop latency p50 {latencies[len(latencies) // 2] * 1e6:.0f}us ' \
+                      f'p99 {latencies[len(latencies) * 99 // 100] * 1e6:.0f}us'
+        else:
+            latency = ''
+        return f'MIDI loop input: {self.processed} messages processed in {self.wakeups} wakeups, ' \
+               f'{self.errors} errors{latency}'
@@ -0,0 +1,97 @@
+####################################################################################################
+################################## Logging off the MIDI threads ####################################
+#### - Description:
+####   setup_logging() replaces logging.basicConfig() in the scripts. Log records are put in a queue
+####   by the thread that logs them (rtmidi callback, worker, watchdog...) and formatted & written by
+####   a background listener thread, so a slow terminal or journald never stalls MIDI processing.
+####
+####   Call sites use lazy %-style arguments, i.e. logging.debug('Received CC command %s', messages),
+####   so nothing is formatted for a disabled level, and the formatting that is needed happens on
+####   the listener thread. The arguments must therefore not be modified after the logging call.
+####
+####   Warnings & errors are rate limited per message (the format string, before its arguments are
+####   merged in): the same message is logged at most once every LOG_RATE_LIMIT_INTERVAL seconds.
+####   The next one logged after that says how many were suppressed in between.
+####   A call site can group different messages under one key with extra={'rate_limit_key': <key>}
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
+# seconds between two logs of the same warning/error message
+LOG_RATE_LIMIT_INTERVAL = 10.0
+
+
+# QueueHandler.prepare() formats the message on the logging thread, so that the record can be
+# pickled. Our queue never leaves the process, so the record is queued as is and formatted later.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Drops repeats of the same message (at or above min_level) logged within interval seconds
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=LOG_RATE_LIMIT_INTERVAL, min_level=logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.min_level = min_level
+        self.suppressed = 0
+        # key -> [time last logged, number suppressed since]
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.min_level:
+            return True
+        key = getattr(record, 'rate_limit_key', None) or (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                self._keys[key] = [now, 0]
+                return True
+            if now - entry[0] < self.interval:
+                entry[1] += 1
+                self.suppressed += 1
+                return False
+            suppressed = entry[1]
+            entry[0] = now
+            entry[1] = 0
+        if suppressed:
+            record.msg = f'{record.getMessage()} ({suppressed} similar messages suppressed)'
+            record.args = None
+        return True
+
+
+# QueueListener.stop() fails when called twice, i.e. once by the program & once at exit
+class LogListener(logging.handlers.QueueListener):
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+# Sends every log record of the process through a queue to a listener thread that writes them to
+# stream (stderr by default). Returns the listener, it is stopped (and the queue flushed) when the
+# program exits.
+def setup_logging(level=logging.INFO, format=LOG_FORMAT, rate_limit_interval=LOG_RATE_LIMIT_INTERVAL, stream=None):
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    if rate_limit_interval > 0:
+        queue_handler.addFilter(RateLimitFilter(rate_limit_interval))
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(format))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = LogListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,240 @@
+####################################################################################################
+################################ Local metrics endpoint (Prometheus) ###############################
+#### - Usage:
+####   > Scrape the running automations / websocket server:
+####       curl http://127.0.0.1:9109/metrics
+####
+#### - Description:
+####   A MetricsRegistry holds the metrics of one program, MetricsServer serves them over HTTP in
+####   the Prometheus text format (version 0.0.4) from a daemon thread.
+####   Most of the numbers are already counted by the objects that do the work (decoder, encoder,
+####   input ring, ...). Those are registered as functions, read only when the endpoint is scraped,
+####   so they cost nothing on the MIDI path. The few metrics that are counted for the endpoint are
+####   plain attribute increments, and the latency histogram is one bisect per automation output.
+####   Increments are not locked: with several threads a rare increment can be lost, which is fine
+####   for monitoring and keeps the hot paths lock free.
+####   http.server is only imported when a MetricsServer is started, which the programs do once their
+####   MIDI input is running: it is the slowest import of the service's startup.
+import logging
+import threading
+from bisect import bisect_left
+
+METRICS_HOST = '127.0.0.1'
+# midi_yamaha_ls9.py & midi_server_websockets.py can run on the same machine, each has its own port
+METRICS_PORT_AUTOMATIONS = 9109
+METRICS_PORT_WEBSOCKETS =  9110
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds, from 100us to 250ms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    __slots__ = ('value', '_children')
+
+    def __init__(self):
+        self.value = 0
+        self._children = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    # the child counter of one set of label values, i.e. messages.labels('10.0.0.2:51234').inc()
+    def labels(self, *values):
+        if self._children is None:
+            self._children = {}
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = Counter()
+        return child
+
+    def samples(self):
+        if self._children is None:
+            return [((), self.value)]
+        return [(values, child.value) for values, child in list(self._children.items())]
+
+
+# reads its value(s) from fn() when scraped. fn returns a number, or a {label values tuple: number}
+# dict for a metric with labels
+class FunctionMetric:
+    __slots__ = ('fn',)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            return list(value.items())
+        return [((), value)]
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # one more for the observations above the last bucket (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self, prefix='ls9_'):
+        self.prefix = prefix
+        # name -> (type, help, label names, metric), in the order they were registered
+        self._metrics = {}
+
+    def _register(self, name, kind, help, labels, metric):
+        name = self.prefix + name
+        if name in self._metrics:
+            raise ValueError(f'Metric {name} is already registered')
+        self._metrics[name] = (kind, help, tuple(labels), metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(name, 'counter', help, labels, Counter())
+
+    def counter_func(self, name, help, fn, labels=()):
+        return self._register(name, 'counter', help, labels, FunctionMetric(fn))
+
+    def gauge_func(self, name, help, fn, labels=()):
+        return self._register(name, 'gauge', help, labels, FunctionMetric(fn))
+
+    # histogram is one kept by another object, a new one otherwise
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, histogram=None):
+        return self._register(name, 'histogram', help, (), histogram if histogram is not None else Histogram(buckets))
+
+    # histograms kept by other objects, fn returns a {label values tuple: Histogram} dict
+    def histogram_func(self, name, help, fn, labels):
+        return self._register(name, 'histogram', help, labels, FunctionMetric(fn))
+
+    # the whole registry in the Prometheus text format
+    def render(self):
+        lines = []
+        for name, (kind, help, label_names, metric) in self._metrics.items():
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            if isinstance(metric, Histogram):
+                self._render_histogram(lines, name, '', metric)
+                continue
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logging.exception('Metric %s failed: %s', name, e)
+                continue
+            for values, value in samples:
+                if not isinstance(values, tuple):
+                    values = (values,)
+                if kind == 'histogram':
+                    self._render_histogram(lines, name, _labels(label_names, values)[1:-1] + ',', value)
+                else:
+                    lines.append(f'{name}{_labels(label_names, values)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    # labels is '' or the 'name="value",' of the histogram's labels, followed by le for the buckets
+    @staticmethod
+    def _render_histogram(lines, name, labels, histogram):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {cumulative + histogram.counts[-1]}')
+        other = '{' + labels[:-1] + '}' if labels else ''
+        lines.append(f'{name}_sum{other} {histogram.sum!r}')
+        lines.append(f'{name}_count{other} {histogram.count}')
+
+
+def _http_server(address):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # scrapes are not logged, the journal is for the MIDI traffic
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer(address, MetricsHandler)
+
+
+# Serves registry at http://host:port/metrics from a daemon thread. port 0 picks a free port, the
+# one used is in .port
+class MetricsServer:
+    def __init__(self, registry, host=METRICS_HOST, port=METRICS_PORT_AUTOMATIONS, name='metrics-server'):
+        self._server = _http_server((host, port))
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+# the metrics of the MIDI input -> automations -> MIDI output path, common to midi_yamaha_ls9.py &
+# midi_server_websockets.py. Returns the counter to increment for every frame dropped by timeout
+def register_midi_metrics(registry, midi_queue, decoder, nrpn_out, engine):
+    frame_timeouts = Counter()
+    registry.counter_func('midi_cc_in_total', 'CC messages received', lambda: midi_queue.pushed)
+    registry.counter_func('midi_queue_overflows_total', 'CC messages dropped or delayed because the input queue was full',
+                          lambda: midi_queue.overflows)
+    registry.gauge_func('midi_queue_depth', 'CC messages waiting in the input queue', lambda: len(midi_queue))
+    registry.counter_func('nrpn_frames_decoded_total', 'NRPN frames decoded from the input', lambda: decoder.frames)
+    registry.counter_func('nrpn_frames_dropped_total', 'Incomplete NRPN frames dropped, by reason',
+                          lambda: {('timeout',): frame_timeouts.value}, labels=('reason',))
+    # the decoder counts bytes, a frame whose address was lost drops both of its data bytes
+    registry.counter_func('nrpn_data_bytes_dropped_total', 'NRPN data bytes dropped without an address or data MSB',
+                          lambda: decoder.invalid)
+    registry.counter_func('automation_nrpn_sent_total', 'NRPN outputs of each automation rule',
+                          lambda: {(rule.name,): count for rule, count in zip(engine.rules, engine.outputs)},
+                          labels=('rule',))
+    registry.counter_func('nrpn_frames_sent_total', 'NRPN frames sent to the console', lambda: nrpn_out.frames)
+    registry.counter_func('midi_bytes_sent_total', 'MIDI bytes sent to the console', lambda: nrpn_out.bytes_sent)
+    return frame_timeouts
+
+# the lanes of a MidiOutputScheduler (midi_output_scheduler.py). With latency, also the time from
+# the input to the automation outputs written, measured by the scheduler (needs the arrival times
+# of the input ring)
+def register_output_metrics(registry, scheduler, latency=False):
+    lanes = scheduler.lanes
+    if latency:
+        registry.histogram('automation_latency_seconds',
+                           'Time from the last CC of a frame received to the writes of its automation outputs',
+                           histogram=scheduler.latency)
+    registry.histogram_func('midi_output_queue_delay_seconds', 'Time NRPN outputs waited for the MIDI link, by lane',
+                            lambda: {(lane.name,): lane.delay for lane in lanes}, labels=('lane',))
+    registry.gauge_func('midi_output_queue_depth', 'NRPN outputs waiting for the MIDI link, by lane',
+                        lambda: {(lane.name,): lane.depth for lane in lanes}, labels=('lane',))
+    registry.counter_func('midi_output_sent_total', 'NRPN outputs written, by lane',
+                          lambda: {(lane.name,): lane.sent for lane in lanes}, labels=('lane',))
+    registry.counter_func('midi_output_coalesced_total', 'NRPN outputs replaced by a newer value while waiting, by lane',
+                          lambda: {(lane.name,): lane.coalesced for lane in lanes}, labels=('lane',))
+    registry.counter_func('midi_output_throttled_seconds_total', 'Time the MIDI output waited for the rate limit',
+                          lambda: scheduler.throttled)
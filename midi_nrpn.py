@@ -0,0 +1,736 @@
+####################################################################################################
+############################## NRPN encoding/decoding for Yamaha LS9 ###############################
+#### - Description:
+####   Common MIDI NRPN code shared by midi_yamaha_ls9.py and midi_server_websockets.py
+####
+#### NPRN message structure for Yamaha LS9 (messages are 7 bits):
+#### CC cmd #   Byte 1   Byte 2   Byte 3
+####        1   0xB0     0x62     <CONTROLLER[0]>
+####        2   0xB0     0x63     <CONTROLLER[1]>
+####        3   0xB0     0x06     <DATA[0]>
+####        4   0xB0     0x26     <DATA[1]>
+import logging
+import threading
+import time
+from array import array
+from collections import deque
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+
+MIDI_CHANNELS = 16
+
+# Data increment/decrement & RPN select CC numbers. The LS9 does not send these, but other gear
+# (and some DAWs) do, and they must not be mistaken for a part of an NRPN frame
+DATA_INCREMENT = 0x60
+DATA_DECREMENT = 0x61
+RPN_BYTE_1 =     0x64
+RPN_BYTE_2 =     0x65
+
+NRPN_DATA_MAX = 0x3FFF
+
+# an incomplete NRPN frame is dropped once no CC has completed it for this long (seconds)
+NRPN_FRAME_TIMEOUT = 0.1
+
+# bytes of one NRPN frame sent as 4 separate CC messages, i.e. without any of the savings below
+NRPN_FRAME_BYTES = 12
+# bytes/sec of a DIN MIDI link: 31250 baud, 10 bits per byte (start, 8 data, stop)
+MIDI_WIRE_RATE = 3125
+# the NRPN address is re-sent at least this often (seconds) even if it has not changed, in case the
+# console lost it (power cycle, another device merged into its MIDI input, ...)
+NRPN_RESYNC_INTERVAL = 1.0
+# a cached console value is trusted for this long (seconds) before a send of the same value goes out
+# again. the LS9 does not transmit every change (i.e. scene recalls), so the cache must not live forever
+NRPN_CACHE_MAX_AGE = 5.0
+# continuous parameters (i.e. parameters linked to a fader) are sent at most this often (Hz)
+NRPN_COALESCE_MAX_RATE = 100.0
+# values an NrpnFanIn leaves waiting in its output lane, the next one is sent once the link took it
+NRPN_FAN_IN_MAX_DEPTH = 1
+
+
+# Streaming NRPN decoder. CC messages are fed one at a time, in the order they arrive, and the
+# decoder keeps the current NRPN address of every MIDI channel. Whenever a data byte completes a
+# value, feed() returns True and the decoded event is available in .channel, .controller & .data.
+# This means a data-only update (0x06/0x26 re-sent without 0x62/0x63, as the LS9 does during fader
+# moves) is decoded straight away.
+# An address is only taken from a 0x62 followed by its 0x63. A 0x62 invalidates the current address,
+# and a 0x63 without the 0x62 before it leaves the channel without one, so when either address byte
+# is lost, the data bytes that follow are dropped (and counted in .invalid) until the next full
+# address, instead of being decoded against half of the new address and half of the previous one.
+# All state is preallocated, so feeding a message does not allocate.
+class NrpnDecoder:
+    __slots__ = ('_ctlr_msb', '_ctlr', '_data_msb', '_data', '_partial',
+                 'channel', 'controller', 'data', 'frames', 'data_only_frames', 'invalid')
+
+    def __init__(self):
+        # -1 means "not received yet" in all of these
+        # 0x62 waiting for its 0x63, and the current address, built from both
+        self._ctlr_msb = array('h', [-1] * MIDI_CHANNELS)
+        self._ctlr =     array('h', [-1] * MIDI_CHANNELS)
+        self._data_msb = array('h', [-1] * MIDI_CHANNELS)
+        self._data =     array('h', [-1] * MIDI_CHANNELS)
+        # 1 while a channel has received part of a frame that has not completed yet
+        self._partial =  array('B', bytes(MIDI_CHANNELS))
+        self.channel = 0
+        self.controller = 0
+        self.data = 0
+        # number of decoded values, and how many of those reused the address of a previous frame
+        self.frames = 0
+        self.data_only_frames = 0
+        # data bytes dropped because they could not complete a value (no address, no data MSB)
+        self.invalid = 0
+
+    # True if any channel holds an incomplete frame (i.e. a timeout should be armed)
+    @property
+    def pending(self):
+        return any(self._partial)
+
+    # forget the incomplete frame of every channel. Complete addresses are kept, as they are still valid
+    def clear_pending(self):
+        for channel in range(MIDI_CHANNELS):
+            self._partial[channel] = 0
+            self._ctlr_msb[channel] = -1
+            self._data_msb[channel] = -1
+
+    # forget everything, including the current address of every channel
+    def reset(self):
+        for channel in range(MIDI_CHANNELS):
+            self._ctlr_msb[channel] = -1
+            self._ctlr[channel] = -1
+            self._data_msb[channel] = -1
+            self._data[channel] = -1
+            self._partial[channel] = 0
+
+    def _emit(self, channel, data):
+        self._data[channel] = data
+        self._partial[channel] = 0
+        self.channel = channel
+        self.controller = self._ctlr[channel]
+        self.data = data
+        self.frames += 1
+
+    # feed one MIDI message (a [status, byte1, byte2] list as given by rtmidi).
+    # returns True if the message completed an NRPN value
+    def feed(self, message):
+        status = message[0]
+        if status & 0xF0 != MIDI_LS9.CC_CMD_BYTE or len(message) < 3:
+            return False
+        channel = status & 0x0F
+        cc = message[1]
+        value = message[2] & 0b1111111
+
+        if cc == MIDI_LS9.NRPN_BYTE_1:
+            # a new address starts, the current one no longer applies even if the 0x63 is lost
+            self._ctlr_msb[channel] = value
+            self._ctlr[channel] = -1
+            self._data_msb[channel] = -1
+            self._data[channel] = -1
+            self._partial[channel] = 1
+        elif cc == MIDI_LS9.NRPN_BYTE_2:
+            ctlr_msb = self._ctlr_msb[channel]
+            # without its 0x62, the other half of the address is unknown
+            self._ctlr[channel] = -1 if ctlr_msb < 0 else (ctlr_msb << 7) | value
+            self._ctlr_msb[channel] = -1
+            self._data_msb[channel] = -1
+            self._data[channel] = -1
+            # an address-only update is complete
+            self._partial[channel] = 0
+        elif self._ctlr[channel] < 0:
+            # data without an address (or for an RPN) cannot be decoded
+            if cc == MIDI_LS9.NRPN_BYTE_3 or cc == MIDI_LS9.NRPN_BYTE_4:
+                self.invalid += 1
+            return False
+        elif cc == MIDI_LS9.NRPN_BYTE_3:
+            self._data_msb[channel] = value
+            self._partial[channel] = 1
+        elif cc == MIDI_LS9.NRPN_BYTE_4:
+            data_msb = self._data_msb[channel]
+            if data_msb < 0:
+                self.invalid += 1
+                return False
+            if self._data[channel] >= 0:
+                self.data_only_frames += 1
+            self._emit(channel, (data_msb << 7) | value)
+            return True
+        elif cc == DATA_INCREMENT or cc == DATA_DECREMENT:
+            data = self._data[channel]
+            if data < 0:
+                return False
+            data = min(data + 1, NRPN_DATA_MAX) if cc == DATA_INCREMENT else max(data - 1, 0)
+            self._data_msb[channel] = data >> 7
+            self.data_only_frames += 1
+            self._emit(channel, data)
+            return True
+        elif cc == RPN_BYTE_1 or cc == RPN_BYTE_2:
+            # the following data bytes belong to an RPN, so the NRPN address is no longer current
+            self._ctlr_msb[channel] = -1
+            self._ctlr[channel] = -1
+            self._data_msb[channel] = -1
+            self._data[channel] = -1
+            self._partial[channel] = 0
+        return False
+
+
+# One timer thread shared by everything that needs to give up on a partial NRPN frame. The thread
+# blocks on a condition variable and only wakes up while it is armed, i.e. while a frame is
+# pending: arm() on every CC that leaves a frame incomplete, disarm() once it completes.
+# on_timeout() is called from the timer thread with .lock held. Callers that hold the same lock
+# while feeding the decoder & arming can never race with the timeout.
+class FrameWatchdog:
+    def __init__(self, timeout, on_timeout, name='nrpn-frame-watchdog'):
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.wakeups = 0
+        self.timeouts = 0
+        self._on_timeout = on_timeout
+        self._condition = threading.Condition(self.lock)
+        self._deadline = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def arm(self):
+        with self._condition:
+            was_idle = self._deadline is None
+            self._deadline = time.monotonic() + self.timeout
+            # if the thread is already sleeping towards an older deadline, it re-checks it when
+            # it wakes up. no need to wake it up early
+            if was_idle:
+                self._condition.notify()
+
+    def disarm(self):
+        with self._condition:
+            self._deadline = None
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if self._deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._deadline = None
+                        self.timeouts += 1
+                        self._on_timeout()
+                    else:
+                        self._condition.wait(remaining)
+                self.wakeups += 1
+
+
+# Same as FrameWatchdog, on an asyncio event loop instead of its own thread: on_timeout() is called
+# by the loop. arm() & disarm() must be called from the loop too. Re-arming only moves the deadline,
+# the loop timer is re-scheduled when it fires early, so a CC costs no timer heap operation.
+class LoopFrameWatchdog:
+    def __init__(self, loop, timeout, on_timeout):
+        self.loop = loop
+        self.timeout = timeout
+        # everything runs on the loop, the lock only keeps the FrameWatchdog API
+        self.lock = threading.RLock()
+        self.wakeups = 0
+        self.timeouts = 0
+        self._on_timeout = on_timeout
+        self._deadline = None
+        self._handle = None
+
+    def arm(self):
+        self._deadline = self.loop.time() + self.timeout
+        if self._handle is None:
+            self._handle = self.loop.call_at(self._deadline, self._fire)
+
+    def disarm(self):
+        self._deadline = None
+
+    def stop(self):
+        self._deadline = None
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _fire(self):
+        self._handle = None
+        self.wakeups += 1
+        if self._deadline is None:
+            return
+        if self.loop.time() >= self._deadline:
+            self._deadline = None
+            self.timeouts += 1
+            with self.lock:
+                self._on_timeout()
+        else:
+            self._handle = self.loop.call_at(self._deadline, self._fire)
+
+
+# MIDI output straight to an ALSA rawmidi device (i.e. /dev/snd/midiC1D0). rtmidi only accepts one
+# MIDI message per send_message() call, a rawmidi device takes any byte stream, so NrpnEncoder can
+# write a whole running-status NRPN frame with a single write.
+class RawMidiOut:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb', buffering=0)
+
+    def send_message(self, message):
+        self._file.write(bytes(message))
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close_port(self):
+        self._file.close()
+
+
+# Last known value of every NRPN controller on the console, from the values we sent to it and the
+# values it sent to us. NrpnEncoder uses it to drop sends that would not change anything.
+class NrpnValueCache:
+    __slots__ = ('max_age', '_values', '_times', 'hits', 'misses')
+
+    def __init__(self, max_age=NRPN_CACHE_MAX_AGE):
+        self.max_age = max_age
+        # -1 means unknown
+        self._values = array('i', [-1] * MIDI_LS9.NRPN_CTLR_COUNT)
+        self._times =  array('d', bytes(8 * MIDI_LS9.NRPN_CTLR_COUNT))
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, controller):
+        if time.monotonic() - self._times[controller] >= self.max_age:
+            return None
+        value = self._values[controller]
+        return None if value < 0 else value
+
+    def update(self, controller, data):
+        self._values[controller] = data
+        self._times[controller] = time.monotonic()
+
+    # True (and counted as a hit) if the console is known to already hold data for controller
+    def is_current(self, controller, data):
+        if self._values[controller] == data and \
+           time.monotonic() - self._times[controller] < self.max_age:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    # forget one controller, or everything
+    def invalidate(self, controller=None):
+        if controller is None:
+            for i in range(MIDI_LS9.NRPN_CTLR_COUNT):
+                self._values[i] = -1
+                self._times[i] = 0.0
+        else:
+            self._values[controller] = -1
+            self._times[controller] = 0.0
+
+
+# NRPN output encoder. Sits in front of a MIDI output (rtmidi.MidiOut or RawMidiOut) and sends
+# NRPN frames with as few bytes as possible:
+#   - the NRPN address (0x62/0x63) is skipped if the previous frame used the same controller, unless
+#     it was last sent more than resync_interval seconds ago (resync_interval=0 always sends it)
+#   - on a RawMidiOut, the frame is packed into one write using running status:
+#         0xB0 62 xx 63 xx 06 xx 26 xx     or, with the address cached,   0xB0 06 xx 26 xx
+#   - on rtmidi, each CC is a separate 3 byte message (rtmidi does not allow more per call)
+# If a NrpnValueCache is given, a send of the value the console already holds is dropped, unless
+# force=True. send_nrpn() returns False for a dropped send.
+# If a ConsoleState (yamaha_ls9_state.py) is given, it is updated with every value sent & received.
+# Frames are sent under a lock, so callers on different threads cannot interleave their CCs.
+class NrpnEncoder:
+    def __init__(self, midi_out, resync_interval=NRPN_RESYNC_INTERVAL, channel=0, cache=None, state=None):
+        self.midi_out = midi_out
+        self.resync_interval = resync_interval
+        self.channel = channel
+        self.cache = cache
+        self.state = state
+        self._raw = isinstance(midi_out, RawMidiOut)
+        self._lock = threading.Lock()
+        self._address = -1
+        self._address_time = 0.0
+        status = MIDI_LS9.CC_CMD_BYTE | channel
+        # preallocated output buffers. only the data bytes change from one frame to the next
+        self._address_frame = bytearray([status, MIDI_LS9.NRPN_BYTE_1, 0, MIDI_LS9.NRPN_BYTE_2, 0,
+                                                 MIDI_LS9.NRPN_BYTE_3, 0, MIDI_LS9.NRPN_BYTE_4, 0])
+        self._data_frame = bytearray([status, MIDI_LS9.NRPN_BYTE_3, 0, MIDI_LS9.NRPN_BYTE_4, 0])
+        self._messages = ([status, MIDI_LS9.NRPN_BYTE_1, 0], [status, MIDI_LS9.NRPN_BYTE_2, 0],
+                          [status, MIDI_LS9.NRPN_BYTE_3, 0], [status, MIDI_LS9.NRPN_BYTE_4, 0])
+        self.frames = 0
+        self.writes = 0
+        self.bytes_sent = 0
+
+    # bytes saved compared to sending every frame as 4 full CC messages
+    @property
+    def bytes_saved(self):
+        return self.frames * NRPN_FRAME_BYTES - self.bytes_sent
+
+    # force the address to be sent with the next frame
+    def resync(self):
+        with self._lock:
+            self._address = -1
+
+    # pass any other MIDI message through, untouched. the console's address is unknown afterwards
+    def send_message(self, message):
+        with self._lock:
+            self._address = -1
+            self.midi_out.send_message(message)
+            self.writes += 1
+            self.bytes_sent += len(message)
+
+    # record a value received from the console, so that sending it back is known to be redundant
+    # (and so that the ConsoleState follows the console)
+    def note_received(self, controller, data):
+        if self.cache is not None:
+            self.cache.update(controller, data)
+        if self.state is not None:
+            self.state.update(controller, data)
+
+    def send_nrpn(self, controller, data, force=False):
+        cache = self.cache
+        if cache is not None and not force and cache.is_current(controller, data):
+            return False
+        controller_msb = (controller >> 7) & 0b1111111
+        controller_lsb = controller & 0b1111111
+        data_msb = (data >> 7) & 0b1111111
+        data_lsb = data & 0b1111111
+        with self._lock:
+            now = time.monotonic()
+            send_address = controller != self._address or \
+                           now - self._address_time >= self.resync_interval
+            if send_address:
+                self._address = controller
+                self._address_time = now
+            try:
+                if self._raw:
+                    if send_address:
+                        frame = self._address_frame
+                        frame[2] = controller_msb
+                        frame[4] = controller_lsb
+                        frame[6] = data_msb
+                        frame[8] = data_lsb
+                    else:
+                        frame = self._data_frame
+                        frame[2] = data_msb
+                        frame[4] = data_lsb
+                    self.midi_out.write(frame)
+                    self.writes += 1
+                    self.bytes_sent += len(frame)
+                else:
+                    messages = self._messages
+                    if send_address:
+                        messages[0][2] = controller_msb
+                        messages[1][2] = controller_lsb
+                        self.midi_out.send_message(messages[0])
+                        self.midi_out.send_message(messages[1])
+                    messages[2][2] = data_msb
+                    messages[3][2] = data_lsb
+                    self.midi_out.send_message(messages[2])
+                    self.midi_out.send_message(messages[3])
+                    self.writes += 4 if send_address else 2
+                    self.bytes_sent += 12 if send_address else 6
+            except Exception:
+                self._write_failed((controller,))
+                raise
+            self.frames += 1
+            # only a value that was written is known to be on the console
+            self._sent(controller, data)
+        return True
+
+    def _sent(self, controller, data):
+        if self.cache is not None:
+            self.cache.update(controller, data)
+        if self.state is not None:
+            self.state.update(controller, data)
+
+    # the console may hold part of the frame: its address & the value of controllers are unknown
+    def _write_failed(self, controllers):
+        self._address = -1
+        if self.cache is not None:
+            for controller in controllers:
+                self.cache.invalidate(controller)
+
+    def compile_macro(self, outputs):
+        return NrpnMacro(outputs, self.channel)
+
+    # sends every output of an NrpnMacro in a single write (rawmidi), or back to back under the
+    # encoder's lock (rtmidi). the macro is skipped only if the console already holds all of it
+    def send_macro(self, macro, force=False):
+        cache = self.cache
+        if cache is not None and not force and \
+           all(cache.is_current(controller, data) for controller, data in macro.outputs):
+            return False
+        with self._lock:
+            try:
+                if self._raw:
+                    self.midi_out.write(macro.frame)
+                    self.writes += 1
+                    self.bytes_sent += len(macro.frame)
+                else:
+                    send_message = self.midi_out.send_message
+                    for message in macro.messages:
+                        send_message(message)
+                    self.writes += len(macro.messages)
+                    self.bytes_sent += 3 * len(macro.messages)
+            except Exception:
+                self._write_failed([controller for controller, _ in macro.outputs])
+                raise
+            self._address = macro.outputs[-1][0]
+            self._address_time = time.monotonic()
+            self.frames += len(macro.outputs)
+            for controller, data in macro.outputs:
+                self._sent(controller, data)
+        return True
+
+    def summary(self):
+        return f'NRPN out: {self.frames} frames in {self.writes} writes, {self.bytes_sent} bytes on wire, ' \
+               f'{self.bytes_saved} bytes saved' + \
+               ('' if self.cache is None else
+                f', {self.cache.hits} redundant sends dropped ({self.cache.misses} cache misses)')
+
+
+# A fixed set of NRPN outputs (i.e. what an automation sends when a channel is switched ON),
+# encoded once: .frame is the whole set as one running-status byte string for a rawmidi device,
+# .messages the same as 3 byte CC messages for rtmidi. Both are immutable, sending the macro only
+# writes them out. Build them with NrpnEncoder.compile_macro(), so the MIDI channel matches.
+class NrpnMacro:
+    __slots__ = ('outputs', 'frame', 'messages')
+
+    def __init__(self, outputs, channel=0):
+        self.outputs = tuple((int(controller), int(data)) for controller, data in outputs)
+        if not self.outputs:
+            raise ValueError('An NRPN macro needs at least one output')
+        status = MIDI_LS9.CC_CMD_BYTE | channel
+        frame = bytearray([status])
+        messages = []
+        for controller, data in self.outputs:
+            if not 0 <= controller <= NRPN_DATA_MAX or not 0 <= data <= NRPN_DATA_MAX:
+                raise ValueError(f'NRPN output out of range: controller {controller:#x}, data {data:#x}')
+            nrpn = ((MIDI_LS9.NRPN_BYTE_1, controller >> 7), (MIDI_LS9.NRPN_BYTE_2, controller & 0b1111111),
+                    (MIDI_LS9.NRPN_BYTE_3, data >> 7),       (MIDI_LS9.NRPN_BYTE_4, data & 0b1111111))
+            for cc, value in nrpn:
+                frame += bytes((cc, value))
+                messages.append((status, cc, value))
+        self.frame = bytes(frame)
+        self.messages = tuple(messages)
+
+    def __len__(self):
+        return len(self.outputs)
+
+
+# Coalescing output stage for continuous parameters. Only the latest value submitted for each
+# controller is kept, and pending values are flushed to the encoder at most max_rate times per
+# second by a background thread. The last value submitted is always sent (it stays pending until
+# the next flush), the intermediate values it replaced are counted in .dropped.
+# Has the same send_nrpn() as NrpnEncoder, so it can be used in its place.
+class NrpnCoalescer:
+    def __init__(self, encoder, max_rate=NRPN_COALESCE_MAX_RATE, name='nrpn-coalescer'):
+        self.encoder = encoder
+        self.interval = 1.0 / max_rate
+        self.submitted = 0
+        self.dropped = 0
+        self.flushes = 0
+        # controller -> latest value, in the order the controllers were first submitted
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._last_flush = 0.0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # force is accepted for compatibility with NrpnEncoder.send_nrpn(), values are always queued
+    def send_nrpn(self, controller, data, force=False):
+        with self._condition:
+            if controller in self._pending:
+                self.dropped += 1
+            elif not self._pending:
+                self._condition.notify()
+            self._pending[controller] = data
+            self.submitted += 1
+        return True
+
+    # send everything still pending and stop the flush thread
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _flush(self):
+        pending = self._pending
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self.flushes += 1
+        # send outside of the lock, so that submitting never waits for MIDI output
+        self._condition.release()
+        try:
+            for controller, data in pending.items():
+                self.encoder.send_nrpn(controller, data)
+        finally:
+            self._condition.acquire()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                remaining = self._last_flush + self.interval - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                else:
+                    self._flush()
+            if self._pending:
+                self._flush()
+
+    def summary(self):
+        return f'Coalesced out: {self.submitted} values submitted, {self.dropped} intermediate values dropped ' \
+               f'in {self.flushes} flushes'
+
+
+# Single writer for several producers, i.e. the websocket clients of midi_server_websockets.py.
+# Every producer gets a NrpnFanInClient, which has the same send_nrpn() as NrpnEncoder but only
+# queues the value and returns at once, so the event loop never waits on MIDI output. A background
+# thread sends the queued values to the encoder one frame at a time, taking turns between the
+# clients that have something queued (round-robin), so a client sweeping 8 knobs cannot hold back
+# another one. Only the latest value of every controller is kept: a value queued by any client
+# replaces the one still waiting for the same controller (last writer wins).
+# When encoder is a lane of a MidiOutputScheduler, which never blocks, the turns only matter if the
+# values wait here rather than in the lane: with max_depth, the thread waits while the lane holds
+# max_depth values or more before sending the next one (see OutputLane.wait_below).
+class NrpnFanIn:
+    def __init__(self, encoder, name='nrpn-writer', max_depth=None):
+        self.encoder = encoder
+        self.max_depth = max_depth
+        # connected clients, for the metrics
+        self.clients = []
+        self.frames = 0
+        self.errors = 0
+        # clients with values queued, in turn order
+        self._ready = deque()
+        # controller -> client whose queue holds its value
+        self._owners = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def client(self, name):
+        client = NrpnFanInClient(self, name)
+        with self._condition:
+            self.clients.append(client)
+        return client
+
+    def _submit(self, client, controller, data):
+        with self._condition:
+            client.submitted += 1
+            owner = self._owners.get(controller)
+            if owner is not None:
+                owner.coalesced += 1
+                # the client's own value keeps its place in its queue, another client's is taken over
+                if owner is not client:
+                    del owner._pending[controller]
+            client._pending[controller] = data
+            self._owners[controller] = client
+            if len(client._pending) > client.high_water:
+                client.high_water = len(client._pending)
+            if not client._queued:
+                client._queued = True
+                self._ready.append(client)
+                self._condition.notify()
+        return True
+
+    def _remove(self, client):
+        with self._condition:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    # send everything still queued and stop the writer thread
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if not self._ready:
+                    if self._stopped:
+                        return
+                    self._condition.wait()
+                    continue
+                if self.max_depth is not None:
+                    # the values keep coalescing & taking turns here while the link is busy
+                    self._condition.release()
+                    try:
+                        self.encoder.wait_below(self.max_depth)
+                    finally:
+                        self._condition.acquire()
+                client = self._ready.popleft()
+                if not client._pending:
+                    # its values were all taken over by other clients
+                    client._queued = False
+                    continue
+                # the oldest value of this client, then it goes to the back of the line
+                controller = next(iter(client._pending))
+                data = client._pending.pop(controller)
+                del self._owners[controller]
+                if client._pending:
+                    self._ready.append(client)
+                else:
+                    client._queued = False
+                # send outside of the lock, so that submitting never waits for MIDI output. the
+                # encoder writes the whole frame under its own lock
+                self._condition.release()
+                try:
+                    self.encoder.send_nrpn(controller, data)
+                    sent = True
+                except Exception as e:
+                    sent = False
+                    logging.exception('MIDI write failed: %s', e)
+                finally:
+                    self._condition.acquire()
+                if sent:
+                    client.sent += 1
+                    self.frames += 1
+                else:
+                    self.errors += 1
+
+    def summary(self):
+        return f'MIDI writer: {self.frames} frames sent, {sum(client.depth for client in self.clients)} queued, ' \
+               f'{len(self.clients)} clients connected, {self.errors} errors'
+
+
+# One producer of a NrpnFanIn
+class NrpnFanInClient:
+    def __init__(self, fan_in, name):
+        self.fan_in = fan_in
+        self.name = name
+        self.submitted = 0
+        self.sent = 0
+        # values replaced before they were sent, by this client or another one
+        self.coalesced = 0
+        # largest number of values queued at once
+        self.high_water = 0
+        # controller -> latest value, oldest first
+        self._pending = {}
+        self._queued = False
+
+    # number of values queued
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    # force is accepted for compatibility with NrpnEncoder.send_nrpn(), values are always queued
+    def send_nrpn(self, controller, data, force=False):
+        return self.fan_in._submit(self, controller, data)
+
+    # the values still queued are sent anyway
+    def close(self):
+        self.fan_in._remove(self)
+
+    def summary(self):
+        return f'{self.name}: {self.submitted} values submitted, {self.sent} sent, {self.coalesced} coalesced, ' \
+               f'queue depth {self.depth} (max {self.high_water})'
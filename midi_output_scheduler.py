@@ -0,0 +1,272 @@
+####################################################################################################
+############################ Priority MIDI output scheduler for the LS9 ############################
+#### - Description:
+####   Every NRPN sent to the console goes through one MidiOutputScheduler, in front of the
+####   NrpnEncoder. Producers send through one of its lanes, highest priority first:
+####   > control:    on/off switches & interlocks of the automations. FIFO, never coalesced
+####   > continuous: parameters following a fader (linear links) & the MT5/MT6 sends of the
+####                 websocket clients. Only the latest value of every controller is kept
+####   > bulk:       scene recalls. FIFO
+####   The output is limited by a token bucket sized to the physical MIDI link: rate bytes/sec
+####   (31.25 kbaud by default), with at most burst bytes sent back to back. When the link is busy,
+####   values wait in their lane, and the next one sent is always taken from the highest priority
+####   lane that has one, so a mute swap goes out ahead of a queue of fader updates.
+####   While nothing is queued and the bucket has room, a value is written by the thread that sends
+####   it, as before. Otherwise the scheduler's own thread writes it once the bucket allows.
+####   Values are scheduled before they are encoded: the encoder leaves the NRPN address out of a
+####   frame to the same controller as the previous one, so reordering encoded frames would send
+####   data to the wrong controller.
+####   The time every value waits in its lane is measured per lane (see .delay & midi_metrics.py).
+####   The input path calls received(arrival) around the automations of every NRPN frame, with the
+####   time.perf_counter() its last CC arrived at. The values that thread sends meanwhile carry that
+####   arrival, and .latency gets the time from it to the value written, once it is.
+import logging
+import threading
+import time
+from collections import deque
+
+from midi_nrpn import NRPN_FRAME_BYTES, MIDI_WIRE_RATE
+from midi_metrics import Histogram
+
+LANE_CONTROL =    'control'
+LANE_CONTINUOUS = 'continuous'
+LANE_BULK =       'bulk'
+# highest priority first
+OUTPUT_LANES = (LANE_CONTROL, LANE_CONTINUOUS, LANE_BULK)
+# bytes sent back to back before the rate applies, 8 full NRPN frames (~30ms of wire time)
+OUTPUT_BURST = 8 * NRPN_FRAME_BYTES
+
+
+# One lane of a MidiOutputScheduler. Has the send_nrpn(), compile_macro() & send_macro() of an
+# NrpnEncoder, which only queue the value(s) when the link is busy
+class OutputLane:
+    def __init__(self, scheduler, name, coalesce):
+        self.scheduler = scheduler
+        self.name = name
+        self.coalesce = coalesce
+        self.submitted = 0
+        self.sent = 0
+        # values replaced by a newer one before they were sent (continuous lane)
+        self.coalesced = 0
+        self.high_water = 0
+        # seconds from submitted to written, of every value
+        self.delay = Histogram()
+        self.max_delay = 0.0
+        # FIFO lanes: (queued at, controller, data, macro, force, arrival). coalescing lane:
+        # controller -> [queued at, data, force, arrival], oldest first
+        self._queue = {} if coalesce else deque()
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def send_nrpn(self, controller, data, force=False):
+        return self.scheduler._submit(self, controller, data, None, force)
+
+    def compile_macro(self, outputs):
+        return self.scheduler.encoder.compile_macro(outputs)
+
+    def send_macro(self, macro, force=False):
+        return self.scheduler._submit(self, None, None, macro, force)
+
+    # blocks until fewer than depth values are queued in the lane, or the scheduler is stopped. For
+    # a producer with its own queue (i.e. NrpnFanIn): its values wait there until the link is about
+    # to take them, instead of in the lane
+    def wait_below(self, depth):
+        scheduler = self.scheduler
+        with scheduler._condition:
+            while len(self._queue) >= depth and not scheduler._stopped:
+                scheduler._condition.wait()
+
+    # under the scheduler's lock. returns the number of items added to the queue, 0 if the value
+    # replaced one already queued
+    def _push(self, now, controller, data, macro, force, arrival):
+        if self.coalesce and macro is None:
+            pending = self._queue.get(controller)
+            if pending is not None:
+                # the value keeps its place in the queue, and the time it has been waiting. the
+                # latency is the one of the frame the new value comes from
+                pending[1] = data
+                pending[2] = pending[2] or force
+                pending[3] = arrival
+                self.coalesced += 1
+                return 0
+            self._queue[controller] = [now, data, force, arrival]
+        elif self.coalesce:
+            # a macro on the coalescing lane is queued as its separate values
+            return sum(self._push(now, output_controller, output_data, None, force, arrival)
+                       for output_controller, output_data in macro.outputs)
+        else:
+            self._queue.append((now, controller, data, macro, force, arrival))
+        if len(self._queue) > self.high_water:
+            self.high_water = len(self._queue)
+        return 1
+
+    # under the scheduler's lock
+    def _peek_cost(self):
+        if self.coalesce:
+            return NRPN_FRAME_BYTES
+        macro = self._queue[0][3]
+        return NRPN_FRAME_BYTES * (1 if macro is None else len(macro))
+
+    def _pop(self):
+        if self.coalesce:
+            controller = next(iter(self._queue))
+            queued_at, data, force, arrival = self._queue.pop(controller)
+            return queued_at, controller, data, None, force, arrival
+        return self._queue.popleft()
+
+    def _observe(self, delay, count):
+        self.sent += count
+        self.delay.observe(delay)
+        if delay > self.max_delay:
+            self.max_delay = delay
+
+    def summary(self):
+        mean = self.delay.sum / self.delay.count if self.delay.count else 0.0
+        return f'{self.name} lane: {self.submitted} values submitted, {self.sent} sent, {self.coalesced} coalesced, ' \
+               f'queue delay mean {mean * 1000:.2f}ms max {self.max_delay * 1000:.2f}ms, high water {self.high_water}'
+
+
+# Schedules the output of encoder (an NrpnEncoder) over OUTPUT_LANES. rate is in bytes/sec,
+# 0 = no limit (the lanes still set the order when the output falls behind)
+class MidiOutputScheduler:
+    def __init__(self, encoder, rate=MIDI_WIRE_RATE, burst=OUTPUT_BURST, name='midi-output'):
+        if rate < 0 or burst < NRPN_FRAME_BYTES:
+            raise ValueError(f'Invalid output rate {rate} / burst {burst}, the burst must hold a full NRPN frame')
+        self.encoder = encoder
+        self.rate = rate
+        self.burst = burst
+        self.lanes = tuple(OutputLane(self, lane, lane == LANE_CONTINUOUS) for lane in OUTPUT_LANES)
+        # values written by the thread that sent them, and seconds the output waited for tokens
+        self.inline = 0
+        self.throttled = 0.0
+        self.errors = 0
+        # seconds from the last CC of a received frame to each of the values it triggered written
+        self.latency = Histogram()
+        self._frame = threading.local()
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._queued = 0
+        self._sending = False
+        self._stopped = False
+        # set once the thread drained the lanes & returned, after stop()
+        self._drained = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def lane(self, name):
+        if name not in OUTPUT_LANES:
+            raise ValueError(f'Unknown output lane {name!r}, expected one of {", ".join(OUTPUT_LANES)}')
+        return self.lanes[OUTPUT_LANES.index(name)]
+
+    # the values sent by this thread from now on were triggered by a frame whose last CC arrived at
+    # arrival (time.perf_counter()). None once the frame is processed, or when it is not known
+    def received(self, arrival):
+        self._frame.arrival = arrival
+
+    # under the lock. True (and the tokens taken) if cost bytes can be written now
+    def _take(self, cost, now):
+        if self.rate <= 0:
+            return True
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        # a macro larger than the burst goes out once the bucket is full, and leaves it in debt
+        if self._tokens < min(cost, self.burst):
+            return False
+        self._tokens -= cost
+        return True
+
+    def _submit(self, lane, controller, data, macro, force):
+        cost = NRPN_FRAME_BYTES * (1 if macro is None else len(macro))
+        arrival = getattr(self._frame, 'arrival', None)
+        with self._condition:
+            lane.submitted += 1 if macro is None else len(macro)
+            now = time.monotonic()
+            if self._drained:
+                # nothing drains the lanes any more: written right away, without rate limit, one
+                # writer at a time
+                while self._sending:
+                    self._condition.wait()
+                self._sending = True
+                self.inline += 1
+                self._write(lane, (now, controller, data, macro, force, arrival), cost)
+                return True
+            if self._sending or self._queued or self._stopped or not self._take(cost, now):
+                added = lane._push(now, controller, data, macro, force, arrival)
+                if added:
+                    self._queued += added
+                    self._condition.notify_all()
+                return True
+            self._sending = True
+            self.inline += 1
+        self._write(lane, (now, controller, data, macro, force, arrival), cost)
+        return True
+
+    # writes one queued item, outside of the lock
+    def _write(self, lane, item, cost):
+        queued_at, controller, data, macro, force, arrival = item
+        bytes_sent = self.encoder.bytes_sent
+        try:
+            if macro is None:
+                self.encoder.send_nrpn(controller, data, force)
+            else:
+                self.encoder.send_macro(macro, force)
+            failed = False
+        except Exception as e:
+            failed = True
+            logging.exception('MIDI write failed: %s', e)
+        now = time.monotonic()
+        with self._condition:
+            self._sending = False
+            if failed:
+                self.errors += 1
+            else:
+                # only what went on the wire is charged: data-only frames are shorter, sends of
+                # values the console holds are dropped by the encoder
+                self._tokens = min(self.burst, self._tokens + cost - (self.encoder.bytes_sent - bytes_sent))
+                lane._observe(now - queued_at, 1 if macro is None else len(macro))
+                if arrival is not None:
+                    self.latency.observe(time.perf_counter() - arrival)
+            # the scheduler's thread, and the producers waiting in wait_below()
+            self._condition.notify_all()
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if self._sending or not self._queued:
+                    if self._stopped and not self._queued:
+                        self._drained = True
+                        return
+                    self._condition.wait()
+                    continue
+                # the highest priority lane with something queued, checked again after every wait
+                lane = next(lane for lane in self.lanes if lane._queue)
+                cost = lane._peek_cost()
+                now = time.monotonic()
+                if not self._take(cost, now):
+                    wait = (min(cost, self.burst) - self._tokens) / self.rate
+                    self._condition.wait(wait)
+                    self.throttled += time.monotonic() - now
+                    continue
+                item = lane._pop()
+                self._queued -= 1
+                self._sending = True
+                self._condition.release()
+                try:
+                    self._write(lane, item, cost)
+                finally:
+                    self._condition.acquire()
+
+    # sends everything still queued (at the output rate) and stops the scheduler's thread. Values
+    # sent afterwards are written at once, by the thread that sends them
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def summary(self):
+        return f'MIDI output: {self.inline} written inline, {self.throttled:.3f}s throttled at {self.rate:g} bytes/s, ' \
+               f'{self.errors} errors; ' + '; '.join(lane.summary() for lane in self.lanes)
@@ -0,0 +1,116 @@
+####################################################################################################
+################################# MIDI automation pipeline for LS9 #################################
+#### - Description:
+####   MidiPipeline builds everything between the MIDI input and the MIDI output of the
+####   automations, the same way for midi_yamaha_ls9.py, midi_server_websockets.py & the replay of
+####   midi_capture.py:
+####     CC messages -> NrpnDecoder -> AutomationEngine -> MidiOutputScheduler lanes -> NrpnEncoder
+####   > the control lane gets the on/off switches & interlocks of the automations
+####   > the continuous lane gets the fader-linked parameters, through an NrpnCoalescer
+####   > the bulk lane gets the scene recalls (scenes=None: no scenes, the scene rules are disabled)
+####   console_state is the shadow copy of the console, kept up to date by nrpn_out.
+####   process_cc_message() is called for every CC message received, in order, by one thread at a
+####   time (i.e. a MidiInputWorker, a MidiLoopInput or the replay). A frame left incomplete for
+####   NRPN_FRAME_TIMEOUT is dropped by frame_watchdog, made by watchdog(timeout, on_timeout), or
+####   only on the next message when watchdog is None (i.e. a replay, whose time is not real).
+import logging
+import threading
+
+from midi_nrpn import NrpnDecoder, NrpnEncoder, NrpnValueCache, NrpnCoalescer, FrameWatchdog
+from midi_nrpn import NRPN_FRAME_TIMEOUT, NRPN_RESYNC_INTERVAL, NRPN_CACHE_MAX_AGE, NRPN_COALESCE_MAX_RATE, MIDI_WIRE_RATE
+from midi_metrics import Counter, register_midi_metrics, register_output_metrics
+from midi_output_scheduler import MidiOutputScheduler, LANE_CONTROL, LANE_CONTINUOUS, LANE_BULK, OUTPUT_BURST
+from yamaha_ls9_automations import AutomationEngine
+from yamaha_ls9_scenes import SceneRecaller
+from yamaha_ls9_state import ConsoleState
+
+
+class MidiPipeline:
+    # a cache_max_age of 0 disables the cache, every automation output is sent
+    def __init__(self, midi_out, rules, scenes=None, resync_interval=NRPN_RESYNC_INTERVAL,
+                 cache_max_age=NRPN_CACHE_MAX_AGE, max_rate=NRPN_COALESCE_MAX_RATE, output_rate=MIDI_WIRE_RATE,
+                 output_burst=OUTPUT_BURST, scene_rate=MIDI_WIRE_RATE, watchdog=FrameWatchdog):
+        self.midi_out = midi_out
+        self.console_state = ConsoleState()
+        cache = NrpnValueCache(cache_max_age) if cache_max_age > 0 else None
+        self.nrpn_out = NrpnEncoder(midi_out, resync_interval=resync_interval, cache=cache, state=self.console_state)
+        # everything sent to the console is scheduled by priority & limited to the MIDI link's rate
+        self.output = MidiOutputScheduler(self.nrpn_out, output_rate, output_burst)
+        # parameters linked to a fader are rate limited, so a fader throw cannot flood the console
+        self.continuous_out = NrpnCoalescer(self.output.lane(LANE_CONTINUOUS), max_rate)
+        # scenes are diffed against console_state, which nrpn_out keeps up to date
+        self.scene_recaller = None
+        if scenes is not None:
+            self.scene_recaller = SceneRecaller(scenes, self.output.lane(LANE_BULK), self.console_state, scene_rate)
+        self.engine = AutomationEngine(rules, self.output.lane(LANE_CONTROL), self.continuous_out, self.scene_recaller)
+        self.decoder = NrpnDecoder()
+        # replaced by the metric of register_metrics()
+        self.frame_timeouts = Counter()
+        self.frame_watchdog = None
+        if watchdog is not None:
+            self.frame_watchdog = watchdog(NRPN_FRAME_TIMEOUT, self.on_frame_timeout)
+        self._lock = self.frame_watchdog.lock if self.frame_watchdog is not None else threading.RLock()
+
+    # midi_queue is the MidiEventRing feeding process_cc_message()
+    def register_metrics(self, registry, midi_queue):
+        self.frame_timeouts = register_midi_metrics(registry, midi_queue, self.decoder, self.nrpn_out, self.engine)
+        registry.counter_func('nrpn_coalesced_total', 'Updates of parameters linked to a fader dropped by rate limiting',
+                              lambda: self.continuous_out.dropped)
+        register_output_metrics(registry, self.output, latency=midi_queue.arrivals)
+        if self.scene_recaller is not None:
+            scene_recaller = self.scene_recaller
+            registry.counter_func('scene_recalls_total', 'Scenes recalled', lambda: scene_recaller.recalls)
+            registry.counter_func('scene_values_total', 'Values of the recalled scenes, by outcome',
+                                  lambda: {('sent',): scene_recaller.sent, ('skipped',): scene_recaller.skipped},
+                                  labels=('outcome',))
+
+    # called by the watchdog once a partial frame has been pending for NRPN_FRAME_TIMEOUT
+    def on_frame_timeout(self):
+        if self.decoder.pending:
+            self.decoder.clear_pending()
+            self.frame_timeouts.inc()
+            logging.warning('Timeout! Resetting MIDI input buffer')
+
+    # for every CC message in the order they were received. timestamp is the delta time since the
+    # previous message, as rtmidi gives it. arrival is the time.perf_counter() it was received at,
+    # for the latency of the automation outputs (None: not measured)
+    def process_cc_message(self, messages, timestamp, arrival=None):
+        logging.debug('Received CC command %s', messages)
+        decoder = self.decoder
+        with self._lock:
+            # if a frame was left incomplete for longer than the timeout, drop it even if the
+            # watchdog has not fired yet
+            if decoder.pending and timestamp > NRPN_FRAME_TIMEOUT:
+                self.on_frame_timeout()
+            # Once the CC messages complete an NRPN value, process it
+            if decoder.feed(messages):
+                self.nrpn_out.note_received(decoder.controller, decoder.data)
+                # the outputs are measured when the scheduler writes them, not when they are queued
+                self.output.received(arrival)
+                try:
+                    self.engine.process(decoder.controller, decoder.data)
+                # we will catch all exceptions to make this system a big more rugged.
+                except Exception as e:
+                    logging.exception('Automation failed: %s', e)
+                self.output.received(None)
+            if self.frame_watchdog is not None:
+                if decoder.pending:
+                    self.frame_watchdog.arm()
+                else:
+                    self.frame_watchdog.disarm()
+
+    # once the input is stopped: sends what is still queued, then stops the threads
+    def stop(self):
+        if self.frame_watchdog is not None:
+            self.frame_watchdog.stop()
+        if self.scene_recaller is not None:
+            self.scene_recaller.stop()
+        self.continuous_out.stop()
+        self.output.stop()
+
+    def summaries(self):
+        summaries = [self.nrpn_out.summary(), self.continuous_out.summary()]
+        if self.scene_recaller is not None:
+            summaries.append(self.scene_recaller.summary())
+        summaries.append(self.output.summary())
+        return summaries
@@ -0,0 +1,73 @@
+####################################################################################################
+########################################## MIDI ports by name ######################################
+#### - Usage:
+####   > Open the first port with "UM-ONE" in its name (case insensitive), instead of port 1:
+####       midi_yamaha_ls9.py --port UM-ONE
+####
+#### - Description:
+####   --port takes the number of a MIDI port, or part of its name. Port numbers change when the USB
+####   MIDI interfaces are plugged in another order, the names do not.
+####   Finding a port by name lists every port of the MIDI API, the slowest part of opening one on
+####   ALSA. The number the name was found at is cached in MIDI_PORT_CACHE, so on the next start
+####   (i.e. a restart of the service) only the name of that one port is checked. The ports are only
+####   listed again if it does not match anymore.
+####   Works with the rtmidi.MidiIn & rtmidi.MidiOut of python-rtmidi, which is not imported here.
+import json
+import logging
+import os
+
+MIDI_PORT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'ls9-midi', 'ports.json')
+
+
+def _matches(port_name, name):
+    return port_name is not None and name.lower() in port_name.lower()
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _write_cache(cache_path, cache):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # written to a temporary file first, two programs starting together do not corrupt it
+        tmp_path = f'{cache_path}.{os.getpid()}'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.debug('Could not cache the MIDI port numbers in %s: %s', cache_path, e)
+
+# number of the port of midi_io given by port, a port number or part of a port name (str). With
+# cache_path None, the ports are always listed. Raises ValueError if no port matches the name
+def find_midi_port(midi_io, port, cache_path=MIDI_PORT_CACHE):
+    if isinstance(port, int):
+        return port
+    if port.isdigit():
+        return int(port)
+    # MidiIn & MidiOut number their ports separately
+    key = f'{type(midi_io).__name__}:{port}'
+    cache = {} if cache_path is None else _read_cache(cache_path)
+    number = cache.get(key)
+    if isinstance(number, int) and 0 <= number < midi_io.get_port_count() and \
+       _matches(midi_io.get_port_name(number), port):
+        return number
+    port_names = midi_io.get_ports()
+    for number, port_name in enumerate(port_names):
+        if _matches(port_name, port):
+            break
+    else:
+        raise ValueError(f'No MIDI port named like {port!r}, the ports are: {", ".join(port_names) or "none"}')
+    if cache_path is not None:
+        cache[key] = number
+        _write_cache(cache_path, cache)
+    return number
+
+def open_midi_port(midi_io, port, cache_path=MIDI_PORT_CACHE):
+    number = find_midi_port(midi_io, port, cache_path)
+    midi_io.open_port(number)
+    logging.debug('Opened MIDI port %d (%s)', number, port)
+    return number
@@ -0,0 +1,153 @@
+####################################################################################################
+################################ Sampling profiler of the MIDI path ################################
+#### - Usage:
+####   > Profile the first 60s of the automations (or of the websocket server):
+####       midi_yamaha_ls9.py --profile sunday.folded --profile-seconds 60
+####   > Profile the automations replaying a capture, as fast as possible:
+####       midi_capture.py replay sunday.ls9cap --speed 0 --quiet --profile replay.folded
+####   > Draw the flamegraph (FlameGraph's flamegraph.pl, or drop the file on speedscope.app):
+####       flamegraph.pl sunday.folded > sunday.svg
+####
+#### - Description:
+####   The MIDI path runs on several threads (rtmidi callback, input worker, event loop, MIDI
+####   writer...), which cProfile cannot follow, and a deterministic profiler slows every call of
+####   the path down. SamplingProfiler instead looks at the stacks of all threads every interval
+####   seconds, from its own thread, for a bounded window. The code being profiled is not touched.
+####   Only the samples with one of the focus functions (PROFILE_FOCUS) on the stack are kept, from
+####   the outermost focus function down, so the threads waiting for MIDI and the callers of the
+####   MIDI path (click, asyncio...) do not fill the profile. With focus=None every sample is kept.
+####   The sampler only runs when it gets the GIL, i.e. at most every sys.getswitchinterval() (5ms)
+####   while a MIDI thread is busy: the summary gives the time actually covered by one sample.
+####
+####   When the window ends (or on stop()), the samples are written to PATH in the collapsed stack
+####   format, one '<thread>;<caller>;...;<function> <samples>' line per stack, and a per-function
+####   summary (self & total time, estimated from the samples) to PATH.txt and the log.
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# seconds between two samples. The sampler needs the GIL to look at the stacks, so a shorter
+# interval takes more time away from the MIDI threads
+PROFILE_INTERVAL = 0.001
+PROFILE_SECONDS = 60.0
+# the entry points of the MIDI path in midi_yamaha_ls9.py, midi_server_websockets.py, midi_pipeline.py & midi_capture.py
+PROFILE_FOCUS = ('main_midi_callback', 'process_cc_message', 'send_nrpn', 'websocket_listener')
+# frames kept per stack, from the thread's entry point down
+PROFILE_MAX_DEPTH = 64
+# functions listed in the summary, by total time
+PROFILE_SUMMARY_TOP = 25
+
+
+# 'file.py:Class.function', the name of a frame in the stacks & summary
+def _frame_name(code):
+    return f'{os.path.basename(code.co_filename)}:{getattr(code, "co_qualname", code.co_name)}'
+
+
+class SamplingProfiler:
+    def __init__(self, path, seconds=PROFILE_SECONDS, interval=PROFILE_INTERVAL, focus=PROFILE_FOCUS):
+        self.path = path
+        self.seconds = seconds
+        self.interval = interval
+        self.focus = frozenset(focus) if focus is not None else None
+        # (thread name, stack of frame names, outermost first) -> samples
+        self.stacks = Counter()
+        # number of times the threads were looked at, and samples dropped for being out of focus
+        self.ticks = 0
+        self.idle = 0
+        self.elapsed = 0.0
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        logging.info('Profiling the MIDI path for %.0fs, every %.1fms, to %s', self.seconds, self.interval * 1000,
+                     self.path)
+        self._thread.start()
+        return self
+
+    # ends the window early, and waits for the output to be written
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        start = time.perf_counter()
+        deadline = start + self.seconds
+        while not self._stop.wait(self.interval):
+            self.sample()
+            if time.perf_counter() >= deadline:
+                break
+        self.elapsed = time.perf_counter() - start
+        try:
+            self.write()
+        except OSError as e:
+            logging.error('Could not write the profile to %s: %s', self.path, e)
+
+    # one look at the stacks of all the other threads
+    def sample(self):
+        self.ticks += 1
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            # innermost frame first. root is the outermost focus function, the stack is cut there
+            stack = []
+            root = -1
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                name = self._names.get(code)
+                if name is None:
+                    name = self._names[code] = _frame_name(code)
+                if self.focus is None or code.co_name in self.focus:
+                    root = len(stack)
+                stack.append(name)
+                frame = frame.f_back
+            if root < 0:
+                self.idle += 1
+                continue
+            if self.focus is None:
+                root = len(stack) - 1
+            self.stacks[(names.get(ident, f'thread-{ident}'), tuple(stack[root::-1]))] += 1
+
+    # collapsed stacks, i.e. for flamegraph.pl & speedscope
+    def collapsed(self):
+        return [f'{thread};{";".join(stack)} {count}' for (thread, stack), count in sorted(self.stacks.items())]
+
+    # (function, self samples, total samples), by total then self samples
+    def functions(self):
+        own = Counter()
+        total = Counter()
+        for (_, stack), count in self.stacks.items():
+            own[stack[-1]] += count
+            # a recursive function is counted once per sample
+            for name in set(stack):
+                total[name] += count
+        return sorted(((name, own[name], count) for name, count in total.items()), key=lambda f: (-f[2], -f[1], f[0]))
+
+    def summary(self, top=PROFILE_SUMMARY_TOP):
+        samples = sum(self.stacks.values())
+        # time represented by one sample of one thread
+        period = self.elapsed / self.ticks if self.ticks else self.interval
+        lines = [f'Profile: {samples} samples on the MIDI path, {self.idle} idle, {self.ticks} ticks in '
+                 f'{self.elapsed:.1f}s ({period * 1000:.2f}ms per sample)',
+                 f'{"self ms":>9s} {"self %":>6s} {"total ms":>9s} {"total %":>7s}  function']
+        samples = max(samples, 1)
+        for name, own, total in self.functions()[:top]:
+            lines.append(f'{own * period * 1000:9.1f} {100 * own / samples:6.1f} {total * period * 1000:9.1f} '
+                         f'{100 * total / samples:7.1f}  {name}')
+        return lines
+
+    def write(self):
+        with open(self.path, 'w') as f:
+            f.writelines(line + '\n' for line in self.collapsed())
+        summary = self.summary()
+        with open(self.path + '.txt', 'w') as f:
+            f.writelines(line + '\n' for line in summary)
+        for line in summary:
+            logging.info('%s', line)
+        logging.info('Profile written to %s (collapsed stacks) and %s.txt', self.path, self.path)
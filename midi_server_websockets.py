@@ -10,16 +10,23 @@
 ####   with CC (control change) knobs/faders. The usb midi device connects via USB to a raspberry pi
 ####   (or similar SFF SBC), and the pi connects to Wi-Fi. the pi will create a websockets
 ####   connection to this code and send over any 2-byte CC commands as a csv formatted string
-####   to the websockets port.
+####   to the websockets port, or in batches as binary frames (see midi_ws_protocol.py).
+####   Several clients can be connected at once, the NRPNs of all of them are sent by a single MIDI
+####   writer thread that takes turns between the clients (see NrpnFanIn in midi_nrpn.py).
+####   The clients are sent the MT5/MT6 levels set from the console or by other clients, see
+####   midi_ws_state.py
+####   NRPN messages received from the console run the automations through the same engine as
+####   midi_yamaha_ls9.py, from the rules in automations_server.json (see yamaha_ls9_automations.py
+####   for the format): on this console, ST-IN1/ST-IN2 route PC IN2 to BASMNT/LOBBY, and ST-IN4
+####   toggles WLTBK3 & WLTBK4, which holds wireless mics 3 & 4 OFF while it is ON
 ####
 #### - pip Package Reference:
 ####     https://pypi.org/project/python-rtmidi/
 ####     https://pypi.org/project/websockets/
-####     https://pypi.org/project/bidict/
 ####     https://pypi.org/project/click/
 ####
 #### - Requirements:
-####   This code requires a python venv with packages python-rtmidi & bidict installed.
+####   This code requires a python venv with packages python-rtmidi, websockets & click installed.
 ####   Here are the steps
 ####       apt update
 ####       apt install python-venv -y
@@ -27,7 +34,7 @@
 ####       cd ls9-midi
 ####       git clone https://github.com/joewawaw/ls9-midi src
 ####       source bin/activate
-####       pip install python-rtmidi bidict websockets click
+####       pip install python-rtmidi websockets click
 ####       cd src
 ####       ./midi_server_websockets.py
 
@@ -44,406 +51,173 @@
 ## move midi console into tools/test? folder
 ## unit tests!
 
-import time
 import logging
-import traceback
 import asyncio
 import sys
 from functools import partial
 
-from bidict import bidict
 import rtmidi
 import click
 from websockets.asyncio.server import serve
 
 #my constants
 import yamaha_ls9_constants as MIDI_LS9
+from midi_nrpn import NrpnDecoder, NrpnFanIn, RawMidiOut, FrameWatchdog, LoopFrameWatchdog
+from midi_nrpn import NRPN_FAN_IN_MAX_DEPTH, NRPN_RESYNC_INTERVAL, NRPN_CACHE_MAX_AGE, NRPN_COALESCE_MAX_RATE, NRPN_FRAME_BYTES, MIDI_WIRE_RATE
+from midi_pipeline import MidiPipeline
+from midi_logging import setup_logging
+from midi_ports import open_midi_port
+from midi_ws_protocol import WS_BINARY_SUBPROTOCOLS, WS_SUBPROTOCOL_STATE_V2, select_ws_subprotocol, decode_cc_batch, decode_cc_csv
+from midi_event_queue import MidiEventRing, MidiInputWorker, MidiLoopInput, MIDI_QUEUE_SIZE, OVERFLOW_DROP_OLDEST, OVERFLOW_POLICIES
+from midi_event_queue import MIDI_INPUT_LOOP, MIDI_INPUT_MODES
+from yamaha_ls9_automations import load_automations, SERVER_AUTOMATIONS_FILE
+from yamaha_ls9_usb_cc import UsbCcRouter, FADER_LAWS, DEFAULT_FADER_LAW
+from midi_ws_state import StatePublisher
+from midi_metrics import MetricsRegistry, MetricsServer, METRICS_PORT_WEBSOCKETS
+from midi_profile import SamplingProfiler, PROFILE_SECONDS
+from midi_output_scheduler import LANE_CONTINUOUS, OUTPUT_BURST
+
+
+# this is a small tool to echo any NRPN-formatted CC commands. with capture, every CC received is
+# also saved to that file, to be replayed later with midi_capture.py
+async def midi_console(midi_port, console, capture=None):
+    loop = asyncio.get_running_loop()
+    decoder = NrpnDecoder()
+    # timeout is set to 250ms
+    def on_frame_timeout():
+        if decoder.pending:
+            logging.warning('Timeout on midi input buffer! Incomplete NRPN frame dropped')
+            decoder.clear_pending()
+    # the messages, the timeouts & the blank lines are all handled by the event loop
+    frame_watchdog = LoopFrameWatchdog(loop, 0.25, on_frame_timeout)
+    # print a blank line after 1s without any message, to separate bursts of messages
+    idle_watchdog = LoopFrameWatchdog(loop, 1.0, print)
+
+    # console mode only, not imported by the server
+    from midi_capture import CaptureWriter
+    capture_writer = None if capture is None else CaptureWriter(capture)
+
+    def process_nrpn(message, timestamp, arrival):
+        # timestamp is the delta time since the previous message
+        if decoder.pending and timestamp > frame_watchdog.timeout:
+            on_frame_timeout()
+        if decoder.feed(message):
+            logging.info('NRPN Message    Controller  %#x\tData  %#x', decoder.controller, decoder.data)
+        if decoder.pending:
+            frame_watchdog.arm()
+        else:
+            frame_watchdog.disarm()
+        idle_watchdog.arm()
 
+    def process_cc(message, timestamp, arrival):
+        logging.info('CC Message    %d\t%d\t%d', message[0], message[1], message[2])
+        idle_watchdog.arm()
 
-def is_valid_nrpn_message(msg):
-    if int(msg[0][1]) != MIDI_LS9.NRPN_BYTE_1 or int(msg[1][1]) != MIDI_LS9.NRPN_BYTE_2 or \
-       int(msg[2][1]) != MIDI_LS9.NRPN_BYTE_3 or int(msg[3][1]) != MIDI_LS9.NRPN_BYTE_4:
-        raise ValueError(f'Invalid NRPN MIDI data sequence! MIDI Message Dump: {msg}')
-    return True
-
-def is_on_off_operation(msg):
-    # Since the bidict below contains all of the on/off channels, we can take message and check
-    #   if it matches a value in the ON_OFF_CONTROLLERS mapping to find out if this
-    #   message is an on/off operation.
-    # We use inverse() as the mapping is <ch_name> -> <controller_number> (we want to find ch_name)
-    if get_nrpn_ctlr(msg) in MIDI_LS9.ON_OFF_CTLRS.inverse:
-        return True
-    return False
-
-def is_fade_operation(msg):
-    if get_nrpn_ctlr(msg) in MIDI_LS9.FADER_CTLRS.inverse:
-        return True
-    return False
-
-#returns a string corresponding to the channel (or mix/mt) of the message
-def get_channel(msg):
-    if is_fade_operation(msg):
-        return MIDI_LS9.FADER_CTLRS.inv[get_nrpn_ctlr(msg)]
-
-    if is_on_off_operation(msg):
-        return MIDI_LS9.ON_OFF_CTLRS.inv[get_nrpn_ctlr(msg)]
-    return None
-
-#we need these in the midi message interpretation
-def combine_bytes(msb, lsb):
-    msb = int(msb); lsb = int(lsb)
-    # & 0b1111111 to mask out the 8th bit (MIDI data is 7 bits)
-    return ((msb & 0b1111111) << 7) | (lsb & 0b1111111)
-
-#returns multiple values!
-def split_bytes(combined):
-    combined = int(combined)
-    msb = (combined >> 7) & 0b1111111
-    lsb = combined & 0b1111111
-    return msb, lsb
-
-#this returns the nrpn controller. this is passed through one of the bidicts to return a string
-def get_nrpn_ctlr(msg):
-    return combine_bytes(msg[0][2], msg[1][2])
-
-#return midi NRPN data
-def get_nrpn_data(msg):
-    return combine_bytes(msg[2][2], msg[3][2])
-
-#returns the state on the on/off button press, True = OFF->ON, False = ON->OFF
-def get_on_off_data(msg):
-    if not is_on_off_operation(msg):
-        raise ValueError('Message is not an ON/OFF operation!')
-
-    data = get_nrpn_data(msg)
-    if data == MIDI_LS9.CH_OFF_VALUE:
-        return False
-    if data == MIDI_LS9.CH_ON_VALUE:
-        return True
-
-def send_nrpn(midi_output, controller, data):
-    controller1, controller2 = split_bytes(controller)
-    data1, data2 = split_bytes(data)
-
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_1,  controller1])
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_2,  controller2])
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_3,  data1])
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_4,  data2])
-
-#these global vars holds the first 14 channel's on/off state (based on fader level)
-#it is needed for fader muting/unmuting
-channel_states = {
-    'CH01': 'OFF',  'CH02': 'OFF',  'CH03': 'OFF',  'CH04': 'OFF',  'CH05': 'OFF',
-    'CH06': 'OFF',  'CH07': 'OFF',  'CH08': 'OFF',  'CH09': 'OFF',  'CH10': 'OFF',
-    'CH11': 'OFF',  'CH12': 'OFF',  'CH13': 'OFF',  'CH14': 'OFF'
-}
-wltbk_state = 'OFF'
-
-# Process the 4 collected CC messages
-def process_midi_messages(messages, midi_out):
-    global channel_states
-    global wltbk_state
-    channel = get_channel(messages) #i.e. the NRPN controller
-    # Processing for Fade operations
-    if is_fade_operation(messages):
-        data = get_nrpn_data(messages)
-        # Mute the send of a vocal mic to MIX1,2 (for lead and chorus) if fader drops below -60dB
-        # we also use the channel_states dict to keep track of which channels have already been
-        # lowered (else we would have multiple triggers when the fader moves in b/w -inf to -60dB)
-        if channel in MIDI_LS9.CHORUS_TO_LEAD_MAPPING:
-            lead_ch = MIDI_LS9.CHORUS_TO_LEAD_MAPPING[channel]
-            if data < MIDI_LS9.FADE_60DB_VALUE and channel_states[channel] == 'ON':
-                channel_states[channel] = 'OFF'
-                out_data = MIDI_LS9.FADE_0DB_VALUE
-                logging.debug(f'MIXER IN: {channel} fade above -50dB')
-                logging.info(f'MIDI OUT: {channel}, {lead_ch} Send to MIX1,2 @ 0 dB')
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel], out_data)
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[lead_ch], out_data)
-            #fade back up to 0dB only if above -50dB, hence it is a software schmitt trigger
-            elif data > MIDI_LS9.FADE_50DB_VALUE and channel_states[channel] == 'OFF':
-                channel_states[channel] = 'ON'
-                out_data = MIDI_LS9.FADE_NEGINF_VALUE
-                logging.debug(f'MIXER IN: {channel} fade below -60dB')
-                logging.info(f'MIDI OUT: {channel}, {lead_ch} Send to MIX1,2 @ -inf dB')
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel], out_data)
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[lead_ch], out_data)
-
-#! this section is actually not needed
-        elif channel in MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING and channel_states[channel] == 'ON':
-            channel_states[channel] = 'OFF'
-            wl_chr_ch =  MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING[channel]
-            wl_lead_ch = MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING[channel]
-            if data < MIDI_LS9.FADE_60DB_VALUE:
-                out_data = MIDI_LS9.FADE_NEGINF_VALUE
-                logging.debug(f'MIXER IN: {channel} fade below -60dB')
-                logging.info(f'MIDI OUT: {channel}, {wl_chr_ch}, {wl_lead_ch} Send to MIX1,2 @ -inf dB')
-            elif data > MIDI_LS9.FADE_50DB_VALUE:
-                out_data = MIDI_LS9.FADE_0DB_VALUE
-                logging.debug(f'MIXER IN: {channel} fade above -50dB')
-                logging.info(f'MIDI OUT: {channel}, {wl_chr_ch}, {wl_lead_ch} Send to MIX1,2 @ 0dB')
-            send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel],    out_data)
-            send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[wl_chr_ch],  out_data)
-            send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[wl_lead_ch], out_data)
-
-    # Processing for ON/OFF message operations
-    if is_on_off_operation(messages):
-        data = get_on_off_data(messages)
-        if data is True:
-        #### Automation for CH01-CH10 switched ON/OFF (switch OFF/ON alt_channel)
-            # if the channel is in the forward values of this mapping, it's one of the original channels
-            if channel in MIDI_LS9.CHORUS_TO_LEAD_MAPPING:
-                alt_channel = MIDI_LS9.CHORUS_TO_LEAD_MAPPING[channel]
-                if data is True:
-                    out_data = MIDI_LS9.CH_OFF_VALUE
-                    logging.debug(f'MIXER IN: {channel} switched ON')
-                    logging.info(f'MIDI OUT: {alt_channel} OFF')
-                else:
-                    out_data = MIDI_LS9.CH_ON_VALUE
-                    logging.debug(f'MIXER IN: {channel} switched OFF')
-                    logging.info(f'MIDI OUT: {alt_channel} ON')
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[alt_channel], out_data)
-
-            #if the channel is part of the inverse bidict, it is a duplicate channel (i.e. CH33-CH42)
-            elif channel in MIDI_LS9.CHORUS_TO_LEAD_MAPPING.inv:
-                alt_channel = MIDI_LS9.CHORUS_TO_LEAD_MAPPING.inv[channel]
-                if data is True:
-                    out_data = MIDI_LS9.CH_OFF_VALUE
-                    logging.debug(f'MIXER IN: {channel} switched ON')
-                    logging.info(f'MIDI OUT: {alt_channel} OFF')
-                else:
-                    out_data - MIDI_LS9.CH_ON_VALUE
-                    logging.debug(f'MIXER IN: {channel} switched OFF')
-                    logging.info(f'MIDI OUT: {alt_channel} ON')
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[alt_channel], out_data)
-
-        #### Automation for Wireless Mics switched ON/OFF
-            elif channel in MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING:
-                # If Wireless MC CH N switched ON, then turn off WLCHR N & LEADWL N
-                if data is True:
-                    #we disable toggling if wltbk_state is ON and the current channel is 13 or 14
-                    if wltbk_state == 'OFF' or (wltbk_state=='ON' and channel!='CH13' and channel!='CH14'):
-                        chr_channel =  MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING[channel]
-                        lead_channel = MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING[channel]
-                        logging.info(f'MIDI OUT: {lead_channel} OFF & CH {chr_channel} OFF')
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel],  MIDI_LS9.CH_OFF_VALUE)
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_OFF_VALUE)
-                    #if a channel that is WLTBK is switched ON while in WLTBK mode,
-                    # we need to turn it back off.
-                    else:
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[channel],  MIDI_LS9.CH_OFF_VALUE)
-                else:
-                    chr_channel =  MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING[channel]
-                    lead_channel = MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING[channel]
-                    logging.info(f'MIDI OUT: {chr_channel} ON & CH {lead_channel} OFF')
-                    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel],  MIDI_LS9.CH_ON_VALUE)
-                    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_OFF_VALUE)
-
-            elif channel in MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING.inv:
-                # If LEADWL CH N switched ON, then turn off WLCHR N & WLMC N
-                if data is True:
-                    if wltbk_state == 'OFF' or (wltbk_state=='ON' and channel!='CH45' and channel!='CH46'):
-                        mc_channel =  MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING.inv[channel]
-                        chr_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING.inv[channel]
-                        logging.info(f'MIDI OUT: {chr_channel} OFF & CH {mc_channel} OFF')
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel], MIDI_LS9.CH_OFF_VALUE)
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],  MIDI_LS9.CH_OFF_VALUE)
-                    else:
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[channel],  MIDI_LS9.CH_OFF_VALUE)
-                else:
-                    mc_channel =  MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING.inv[channel]
-                    chr_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING.inv[channel]
-                    logging.info(f'MIDI OUT: {chr_channel} ON & CH {mc_channel} OFF')
-                    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel], MIDI_LS9.CH_ON_VALUE)
-                    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],  MIDI_LS9.CH_OFF_VALUE)
-
-            elif channel in MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING:
-                # If WLCHR CH N switched ON, then turn off LEADWL N & WLMC N
-                if data is True:
-                    if wltbk_state == 'OFF' or (wltbk_state=='ON' and channel!='CH49' and channel!='CH50'):
-                        mc_channel =   MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING.inv[channel]
-                        lead_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING[channel]
-                        logging.info(f'MIDI OUT: {mc_channel} OFF & CH {lead_channel} OFF')
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],   MIDI_LS9.CH_OFF_VALUE)
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_OFF_VALUE)
-                    else:
-                        send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[channel],  MIDI_LS9.CH_OFF_VALUE)
-                else:
-                    mc_channel =   MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING.inv[channel]
-                    lead_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING[channel]
-                    logging.info(f'MIDI OUT: {lead_channel} ON & CH {mc_channel} OFF')
-                    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_ON_VALUE)
-                    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],   MIDI_LS9.CH_OFF_VALUE)
-
-        #### Automation for MIX1 or MIX2 switched ON (switch ON ST LR)
-            elif channel == 'MIX1' or channel == 'MIX2' and data is True:
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['ST LR'], MIDI_LS9.CH_ON_VALUE)
-        #### Automation for ST L/R switched OFF (switch OFF MIX1 as well)
-            elif channel == 'ST LR' and data is False:
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['MIX1'], MIDI_LS9.CH_OFF_VALUE)
-
-        #### Automation for PC IN2 routing to BASMNT
-            elif channel == 'ST-IN1':
-                if data is True:
-                    logging.info('MIDI OUT: PC IN2 -> BASMNT')
-                    out_data_mix16 = MIDI_LS9.FADE_0DB_VALUE
-                    out_data_mono =  MIDI_LS9.FADE_NEGINF_VALUE
-                else:
-                    logging.info('MIDI OUT: STREAM -> BASMNT')
-                    out_data_mix16 = MIDI_LS9.FADE_NEGINF_VALUE
-                    out_data_mono =  MIDI_LS9.FADE_0DB_VALUE
-                send_nrpn(midi_out, MIDI_LS9.MIX16_SEND_TO_MT1, out_data_mix16)
-                send_nrpn(midi_out, MIDI_LS9.MONO_SEND_TO_MT1,  out_data_mono)
-
-        #### Automation for PC IN2 routing to LOBBY
-            elif channel == 'ST-IN2':
-                if data is True:
-                    logging.info('MIDI OUT: PC IN2 -> LOBBY')
-                    out_data_mix16 = MIDI_LS9.FADE_0DB_VALUE
-                    out_data_stlr =  MIDI_LS9.FADE_NEGINF_VALUE
-                else:
-                    logging.info('MIDI OUT: ST L/R -> LOBBY')
-                    out_data_mix16 = MIDI_LS9.FADE_NEGINF_VALUE
-                    out_data_stlr =  MIDI_LS9.FADE_0DB_VALUE
-                send_nrpn(midi_out, MIDI_LS9.MIX16_SEND_TO_MT2, MIDI_LS9.FADE_NEGINF_VALUE)
-                send_nrpn(midi_out, MIDI_LS9.STLR_SEND_TO_MT2,  MIDI_LS9.FADE_0DB_VALUE)
-
-        #### Automation for LOUNGE toggle between MONO and ST LR (ST-IN3 switched ON)
-            elif channel == 'ST-IN3':
-                # if ON, route MONO to LOUNGE
-                if data is True:
-                    logging.info('MIDI OUT: MONO -> LOUNGE')
-                    out_data_mono = MIDI_LS9.FADE_0DB_VALUE
-                    out_data_stlr = MIDI_LS9.FADE_NEGINF_VALUE
-                # if OFF, route ST LR to LOUNGE
-                else:
-                    logging.info('MIDI OUT: ST L/R -> LOUNGE')
-                    out_data_mono = MIDI_LS9.FADE_NEGINF_VALUE
-                    out_data_stlr = MIDI_LS9.FADE_0DB_VALUE
-                send_nrpn(midi_out, MIDI_LS9.MONO_SEND_TO_MT3,  out_data_mono)
-                send_nrpn(midi_out, MIDI_LS9.ST_LR_SEND_TO_MT3, out_data_stlr)
-
-        #### Automation for toggling WLTBK 3 & 4 ON/OFF
-            elif channel == 'ST-IN4':
-                if data is True:
-                    logging.info('MIDI OUT: WLTBK3 & WLTBK4 ON')
-                    wltbk_state = 'ON' # we need this global var to disable WL MC/CHR/LEAD toggling
-                    out_data_ch13 = MIDI_LS9.CH_OFF_VALUE
-                    out_data_ch14 = MIDI_LS9.CH_OFF_VALUE
-                else:
-                    logging.info('MIDI OUT: WLTBK3 & WLTBK4 OFF')
-                    wltbk_state = 'OFF'
-                    #turn on only MC channels (and turn off all alt channels below)
-                    out_data_ch13 = MIDI_LS9.CH_ON_VALUE
-                    out_data_ch14 = MIDI_LS9.CH_ON_VALUE
-
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH13'], out_data_ch13)
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH14'], out_data_ch14)
-                #turn off all alt channels for wireless mics 3 & 4; as they all route to ST L/R
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH46'], MIDI_LS9.CH_OFF_VALUE)
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH47'], MIDI_LS9.CH_OFF_VALUE)
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH49'], MIDI_LS9.CH_OFF_VALUE)
-                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH50'], MIDI_LS9.CH_OFF_VALUE)
-
-
-# this is a small tool to echo any NRPN-formatted CC commands
-async def midi_console(midi_port, console):
-    midi_nrpn_console_messages = []
-    # using a list because lists are mutable, and so their values will change in the parent function
-    # if changed in a child function.
-    timeout_counter = [0]
-    def midi_nrpn_callback(event, unused):
-        message, timestamp = event
-
-        if message[0] == MIDI_LS9.CC_CMD_BYTE:
-            midi_nrpn_console_messages.append(message)
-        if len(midi_nrpn_console_messages) == 4:
-            controller = get_nrpn_ctlr(midi_nrpn_console_messages)
-            data =       get_nrpn_data(midi_nrpn_console_messages)
-            logging.info(f'NRPN Message    Controller  {hex(controller)}\tData  {hex(data)}')
-            midi_nrpn_console_messages.clear()
-            timeout_counter[0] = 0
-
-    def midi_cc_callback(event, unused):
+    console_input = MidiLoopInput(MidiEventRing(), loop, process_cc if console == 'CC' else process_nrpn)
+    def midi_console_callback(event, unused):
         message, timestamp = event
         if message[0] == MIDI_LS9.CC_CMD_BYTE:
-            logging.info(f'CC Message    {message[0]}\t{message[1]}\t{message[2]}')
-            timeout_counter[0] = 0
+            if capture_writer is not None:
+                capture_writer.write(message, timestamp)
+            console_input.put(message, timestamp)
 
-    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    setup_logging(logging.INFO, '%(asctime)s %(message)s')
     midi_in = rtmidi.MidiIn()
-    midi_in.open_port(midi_port)
+    open_midi_port(midi_in, midi_port)
 
     if console == 'CC':
         logging.info('MIDI CC Console. Echoing all incoming MIDI CC messages (3 byte packets)')
         logging.info('Press CTRL+C to exit')
-        midi_in.set_callback(midi_cc_callback)
     elif console == 'NRPN':
         logging.info('MIDI NRPN Console. Echoing all incoming MIDI NRPN messages (controller+data)')
         logging.info('Press CTRL+C to exit')
-        midi_in.set_callback(midi_nrpn_callback)
+    midi_in.set_callback(midi_console_callback)
+    if capture_writer is not None:
+        logging.info('Saving every CC message received to %s', capture)
 
     try:
-        while True:
-            await asyncio.sleep(0.05)
-            timeout_counter[0] += 1
-            # every 1s print a blank line
-            if timeout_counter[0] == 20:
-                print()
-                timeout_counter[0] = 0
-            #if timeout_counter overflows, check if input buffer data is incomplete (>0, <4) & reset
-            #timeout is set to 250ms
-            if timeout_counter[0] > 5:
-                if len(midi_nrpn_console_messages) > 0 and len(midi_nrpn_console_messages) < 4:
-                    logging.warning(f'Timeout on midi input buffer! data: {midi_nrpn_console_messages}')
-                    midi_nrpn_console_messages.clear()
-                    timeout_counter[0] = 0
-    except KeyboardInterrupt:
+        # nothing to do here, console_input & the watchdogs do all of the work on the event loop
+        await loop.create_future()
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print('Exiting...')
     finally:
         midi_in.close_port()
+        console_input.stop()
+        frame_watchdog.stop()
+        idle_watchdog.stop()
+        if capture_writer is not None:
+            capture_writer.close()
+            logging.info('%d CC messages saved to %s', capture_writer.records, capture)
         sys.exit()
 
 
-async def websocket_listener(websocket, arg1):
-    async for message in websocket:
-        cc_controller, cc_data = message.split(',')
-        logging.debug(f'{cc_controller=}\t{cc_data=}')
-        # we assume casting wont fail
-        cc_controller = int(cc_controller)
-        cc_data = int(cc_data)
-        data = int((cc_data / 127.0) * MIDI_LS9.FADE_10DB_VALUE)
-        #get the right MT SoF controller by checking which bidict cc_controller is an element
-        if cc_controller in MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS:
-            mix_name = MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS[cc_controller]
-            if mix_name == 'MT5':
-                controller = MIDI_LS9.FADER_CTLRS['MT5']
-            else:
-                controller = MIDI_LS9.MT5_SOF_CTRLS[mix_name]
-            logging.info(f'MIDI OUT: {mix_name} Send to MT5 @ {hex(data)} dB')
-            send_nrpn(arg1, controller, data)
-        elif cc_controller in MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS:
-            mix_name = MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS[cc_controller]
-            if mix_name == 'MT6':
-                controller = MIDI_LS9.FADER_CTLRS['MT6']
-            else:
-                controller = MIDI_LS9.MT6_SOF_CTRLS[mix_name]
-            logging.info(f'MIDI OUT: {mix_name} Send to MT6 @ {hex(data)} dB')
-            send_nrpn(arg1, controller, data)
-        else:
-            logging.error(f'The CC command received from USB keyboard is invalid! {cc_controller=}')
+# the message format was negotiated when the client connected, see midi_ws_protocol.py
+# usb_cc is the UsbCcRouter of the MT5/MT6 monitor mixes, see yamaha_ls9_usb_cc.py. Every client
+# gets its own queue in midi_writer, which sends the NRPNs of all clients from a single thread.
+# The clients that asked for it are kept up to date with the mixer state by state_push.
+# ws_messages is the metric counting the messages of every client
+async def websocket_listener(websocket, usb_cc, midi_writer, state_push, ws_messages):
+    binary = websocket.subprotocol in WS_BINARY_SUBPROTOCOLS
+    name = '%s:%s' % websocket.remote_address[:2]
+    # the port changes on every reconnect, the metric is kept by client host only
+    host = websocket.remote_address[0]
+    logging.info('Client %s connected (%s protocol%s)', name, 'binary' if binary else 'CSV',
+                 ', state push' if websocket.subprotocol == WS_SUBPROTOCOL_STATE_V2 else '')
+    client = midi_writer.client(name)
+    router = usb_cc.for_output(client)
+    messages = ws_messages.labels(host)
+    subscriber = None
+    try:
+        if websocket.subprotocol == WS_SUBPROTOCOL_STATE_V2:
+            subscriber = await state_push.subscribe(websocket)
+        async for message in websocket:
+            messages.inc()
+            try:
+                if binary:
+                    for cc_controller, cc_data, _ in decode_cc_batch(message):
+                        router.process(cc_controller, cc_data)
+                else:
+                    cc_controller, cc_data = decode_cc_csv(message)
+                    router.process(cc_controller, cc_data)
+            except ValueError as e:
+                logging.error('Invalid message from client %s: %s', name, e)
+    finally:
+        client.close()
+        logging.info('Client disconnected. %s', client.summary())
+        if router.out_of_range:
+            logging.warning('%d CCs out of range dropped from client %s', router.out_of_range, name)
+        if subscriber is not None:
+            state_push.unsubscribe(websocket)
+            logging.info('State push to %s: %d values in %d frames, %d bytes', name, subscriber.values_sent,
+                         subscriber.frames, subscriber.bytes_sent)
 
 # Click wrapper for the async main function
 @click.command()
 @click.option('-v', '--verbose', is_flag=True, default=False, help='Set logging level to DEBUG')
 @click.option('-c', '--console', default=None, type=click.Choice(['CC', 'NRPN'], case_sensitive=False), help='Run in console mode')
-@click.option('-p', '--port', default=0, metavar='PORT', show_default=True, type=int, help='Specify MIDI port number')
-def main(port, console, verbose):
-    asyncio.run(async_main(port, console, verbose))
-
-async def async_main(port, console, verbose):
+@click.option('--capture', default=None, metavar='PATH', type=click.Path(dir_okay=False), help='Console mode: also save every CC received to a capture file (replay it with midi_capture.py)')
+@click.option('-p', '--port', default='0', metavar='PORT', show_default=True, help='Specify MIDI port number, or part of the port name (i.e. UM-ONE)')
+@click.option('--rawmidi', default=None, metavar='DEVICE', type=click.Path(), help='Send MIDI output to an ALSA rawmidi device (i.e. /dev/snd/midiC1D0) instead of PORT, one write per NRPN')
+@click.option('--resync', default=NRPN_RESYNC_INTERVAL, metavar='SECONDS', show_default=True, type=float, help='Re-send an unchanged NRPN address at least this often (0 = always)')
+@click.option('--cache-max-age', default=NRPN_CACHE_MAX_AGE, metavar='SECONDS', show_default=True, type=float, help='Drop sends of values the console held less than this long ago (0 = never drop)')
+@click.option('--max-rate', default=NRPN_COALESCE_MAX_RATE, metavar='HZ', show_default=True, type=float, help='Max update rate of parameters linked to a fader (i.e. CH18 -> tabla PEQ)')
+@click.option('-a', '--automations', default=SERVER_AUTOMATIONS_FILE, metavar='PATH', show_default=True, type=click.Path(exists=True, dir_okay=False), help='Automation rules file')
+@click.option('--queue-size', default=MIDI_QUEUE_SIZE, metavar='N', show_default=True, type=click.IntRange(min=1), help='Number of incoming CC messages buffered for the automations')
+@click.option('--overflow', default=OVERFLOW_DROP_OLDEST, show_default=True, type=click.Choice(OVERFLOW_POLICIES), help='What to do with incoming MIDI when the buffer is full')
+@click.option('--midi-input', default=MIDI_INPUT_LOOP, show_default=True, type=click.Choice(MIDI_INPUT_MODES), help='Process incoming MIDI on the event loop, next to the websockets, or on its own thread')
+@click.option('--fader-law', default=DEFAULT_FADER_LAW, show_default=True, type=click.Choice(list(FADER_LAWS)), help='USB keyboard knob -> MT5/MT6 level curve (unity = 0dB at 3/4 of the knob)')
+@click.option('--metrics-port', default=METRICS_PORT_WEBSOCKETS, metavar='PORT', show_default=True, type=click.IntRange(min=0, max=65535), help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (0 = disabled)')
+@click.option('--profile', default=None, metavar='PATH', type=click.Path(dir_okay=False), help='Profile the MIDI path, write the collapsed stacks (flamegraph) to PATH & a per-function summary to PATH.txt')
+@click.option('--profile-seconds', default=PROFILE_SECONDS, metavar='SECONDS', show_default=True, type=click.FloatRange(min=0, min_open=True), help='Length of the profiling window')
+@click.option('--output-rate', default=MIDI_WIRE_RATE, metavar='BYTES/S', show_default=True, type=click.FloatRange(min=0), help='Limit the MIDI output to this many bytes/sec (31.25 kbaud MIDI, 0 = no limit); on/off switches go out ahead of fader-linked updates')
+@click.option('--output-burst', default=OUTPUT_BURST, metavar='BYTES', show_default=True, type=click.IntRange(min=NRPN_FRAME_BYTES), help='Bytes sent back to back before --output-rate applies')
+def main(port, console, capture, verbose, rawmidi, resync, cache_max_age, max_rate, automations, queue_size, overflow, midi_input, fader_law, metrics_port, profile, profile_seconds, output_rate, output_burst):
+    asyncio.run(async_main(port, console, capture, verbose, rawmidi, resync, cache_max_age, max_rate, automations, queue_size, overflow, midi_input, fader_law, metrics_port, profile, profile_seconds, output_rate, output_burst))
+
+async def async_main(port, console, capture, verbose, rawmidi, resync, cache_max_age, max_rate, automations, queue_size, overflow, midi_input, fader_law, metrics_port, profile, profile_seconds, output_rate, output_burst):
     #if the console flag was passed, run one of the mini-tools instead of the main program (automations)
-    if console is not None:
-        await midi_console(port, console)
+    if console is not None or capture is not None:
+        await midi_console(port, console or 'NRPN', capture)
         return
 
     if verbose is True:
@@ -456,62 +230,97 @@ async def async_main(port, console, verbose):
     logger.setLevel(logging.WARNING)
 
     # time is given in ISO8601 date format
-    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=log_level)
+    # records are written by a background thread, see midi_logging.py
+    setup_logging(log_level)
+    # the rules are loaded before opening any port, so a broken rules file fails right away
+    rules = load_automations(automations)
+    logging.info('Loaded %d automations from %s', len(rules), automations)
     logging.info('MIDI LS9 Automations. Waiting for incoming MIDI NRPN messages...')
 
     # Setup the MIDI input & output
     midi_in =  rtmidi.MidiIn()
-    midi_in.open_port(port)
-    midi_out = rtmidi.MidiOut()
-    midi_out.open_port(port)
-
-    midi_messages = []
-    timeout_counter = [0]
+    open_midi_port(midi_in, port)
+    if rawmidi is None:
+        midi_out = rtmidi.MidiOut()
+        open_midi_port(midi_out, port)
+    else:
+        midi_out = RawMidiOut(rawmidi)
+    loop = asyncio.get_running_loop()
+    # decoder -> automations -> output scheduler -> encoder, see midi_pipeline.py. Partial frames are
+    # timed out on the same loop (or thread) as the one processing the input
+    watchdog = partial(LoopFrameWatchdog, loop) if midi_input == MIDI_INPUT_LOOP else FrameWatchdog
+    pipeline = MidiPipeline(midi_out, rules, resync_interval=resync, cache_max_age=cache_max_age, max_rate=max_rate,
+                            output_rate=output_rate, output_burst=output_burst, watchdog=watchdog)
+    # the USB keyboard CC -> NRPN tables are built once, here. the routers of the clients share them
+    usb_cc = UsbCcRouter(pipeline.nrpn_out, fader_law)
+    # the MT5/MT6 sends of the clients are continuous too: only their latest values are sent. they
+    # wait in midi_writer, taking turns between the clients, until the lane is about to send them
+    midi_writer = NrpnFanIn(pipeline.output.lane(LANE_CONTINUOUS), max_depth=NRPN_FAN_IN_MAX_DEPTH)
+    # console_state follows everything sent to & received from the console
+    state_push = StatePublisher(pipeline.console_state)
+
+    # the rtmidi thread only queues the message, decoding, automations & output run on the event
+    # loop, next to the websockets (or on the midi_worker thread). the arrival times of the
+    # messages are only taken for the latency metric
+    midi_queue = MidiEventRing(queue_size, overflow, arrivals=metrics_port > 0)
+    metrics = MetricsRegistry()
+    pipeline.register_metrics(metrics, midi_queue)
+    ws_messages = metrics.counter('websocket_messages_total', 'Websocket messages received, by client host', labels=('client',))
+    metrics.gauge_func('websocket_clients', 'Connected websocket clients', lambda: len(midi_writer.clients))
+    metrics.gauge_func('midi_writer_queue_depth', 'NRPNs of each client waiting for the MIDI writer',
+                       lambda: {(client.name,): client.depth for client in list(midi_writer.clients)}, labels=('client',))
+    metrics.counter_func('midi_writer_coalesced_total', 'NRPNs of the clients replaced by a newer value before being sent',
+                         lambda: {(client.name,): client.coalesced for client in list(midi_writer.clients)}, labels=('client',))
+
+    if midi_input == MIDI_INPUT_LOOP:
+        midi_worker = MidiLoopInput(midi_queue, loop, pipeline.process_cc_message)
+    else:
+        midi_worker = MidiInputWorker(midi_queue, pipeline.process_cc_message)
     def main_midi_callback(event, unused):
         messages, timestamp = event
         # Filter out everything but CC (Control Change) commands
         if messages[0] == MIDI_LS9.CC_CMD_BYTE:
-            midi_messages.append(messages)
-            logging.debug(f'Received CC command {messages}')
-        # Once we have 4 CC messages, process them
-        if len(midi_messages) == 4:
-            try:
-                process_midi_messages(midi_messages, midi_out)
-            # we will catch all exceptions to make this system a big more rugged.
-            except Exception as e:
-                error_message = traceback.format_exc()
-                logging.error(error_message)
-                logging.error(str(e))
-            finally:
-                midi_messages.clear()  # Clear the list for the next batch of 4 messages
-                timeout_counter[0] = 0
+            midi_worker.put(messages, timestamp)
 
     #set_callback needs to be after the function above, and the callback function needs to know
     # about midi_out, so place it here in the code.
     midi_in.set_callback(main_midi_callback)
+    metrics_server = None
+    if metrics_port > 0:
+        metrics_server = MetricsServer(metrics, port=metrics_port)
+        logging.info('Serving metrics on http://127.0.0.1:%d/metrics', metrics_server.port)
+    # samples the threads of the MIDI path for profile_seconds, see midi_profile.py
+    profiler = SamplingProfiler(profile, profile_seconds).start() if profile is not None else None
 
-    while True:
-        try:
-            #start websocket listener and attach callback websocket_listener() to serve()
-            listener_with_args = partial(websocket_listener, arg1=midi_out)
-            async with serve(listener_with_args, "localhost", 8001):
-                await asyncio.get_running_loop().create_future()  # run forever
-
-            #delay is necessary to not overload the CPU or RAM
-            await asyncio.sleep(0.005)
-            # if there is an incomplete packet in the buffer, increase the timeout
-            if len(midi_messages) > 0:
-                timeout_counter[0] += 1
-            #if counter exceeds 0.005 * 20 = 100ms
-            if timeout_counter[0] > 20:
-                midi_messages.clear()
-                timeout_counter[0] = 0
-                logging.warning('Timeout! Resetting MIDI input buffer')
-        except KeyboardInterrupt:
-            logging.warning('CTRL+C pressed. Exiting...')
-            midi_in.close_port()
-            midi_out.close_port()
-            sys.exit()
+    try:
+        #start websocket listener and attach callback websocket_listener() to serve()
+        # partial NRPN frames are timed out by the watchdog of the pipeline, so this coroutine
+        # only pushes the mixer state to the clients
+        listener_with_args = partial(websocket_listener, usb_cc=usb_cc, midi_writer=midi_writer, state_push=state_push,
+                                     ws_messages=ws_messages)
+        async with serve(listener_with_args, "localhost", 8001, select_subprotocol=select_ws_subprotocol):
+            await state_push.run()  # run forever
+    # under asyncio.run(), CTRL+C cancels this coroutine: it arrives as CancelledError
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logging.warning('CTRL+C pressed. Exiting...')
+    finally:
+        midi_in.close_port()
+        if profiler is not None:
+            profiler.stop()
+        midi_worker.stop()
+        midi_writer.stop()
+        pipeline.stop()
+        midi_out.close_port()
+        if metrics_server is not None:
+            metrics_server.stop()
+        logging.info(midi_queue.summary())
+        if midi_input == MIDI_INPUT_LOOP:
+            logging.info(midi_worker.summary())
+        logging.info(midi_writer.summary())
+        logging.info(state_push.summary())
+        for summary in pipeline.summaries():
+            logging.info(summary)
+        sys.exit()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,93 @@
+####################################################################################################
+############################## Client -> server websocket CC protocol ##############################
+#### - Description:
+####   The format is negotiated with the websocket subprotocol when the client connects:
+####   > 'ls9-cc.v1' (binary): one binary frame carries a batch of CCs
+####         <version: u8 = 1> then for every CC: <controller: u8> <data: u8> <delta: u16 LE>
+####         delta is the time since the previous CC in 0.1ms units (saturated at 6.5535s)
+####   > no subprotocol (CSV): one text frame per CC, "<controller>,<data>". This is what clients
+####         older than the binary protocol send, and what the client falls back to when the server
+####         does not know the binary protocol
+####   > 'ls9-cc.v2' (binary + state push): the client sends the same frames as 'ls9-cc.v1', and the
+####         server pushes the MT5/MT6 levels & faders to the client (see midi_ws_state.py):
+####         <kind: u8> then for every value: <NRPN controller: u16 LE> <NRPN data: u16 LE>
+####         kind is WS_STATE_SNAPSHOT for every known value, sent once on connect, then
+####         WS_STATE_DELTA for the values changed since the previous frame
+####   Both sides list the subprotocols they know in WS_SUBPROTOCOLS, best first.
+import struct
+
+WS_SUBPROTOCOL_BINARY_V1 = 'ls9-cc.v1'
+WS_SUBPROTOCOL_STATE_V2 = 'ls9-cc.v2'
+WS_SUBPROTOCOLS = [WS_SUBPROTOCOL_STATE_V2, WS_SUBPROTOCOL_BINARY_V1]
+# subprotocols where the client sends binary CC batches
+WS_BINARY_SUBPROTOCOLS = (WS_SUBPROTOCOL_STATE_V2, WS_SUBPROTOCOL_BINARY_V1)
+
+WS_BINARY_VERSION = 1
+WS_CC_RECORD = struct.Struct('<BBH')
+# CCs per binary frame
+WS_BATCH_MAX = 256
+# unit of the delta time in a binary frame (seconds)
+WS_DELTA_UNIT = 0.0001
+WS_DELTA_MAX = 0xFFFF
+
+WS_STATE_SNAPSHOT = 1
+WS_STATE_DELTA = 2
+WS_STATE_RECORD = struct.Struct('<HH')
+
+_VERSION_BYTE = bytes([WS_BINARY_VERSION])
+
+
+# select_subprotocol hook of the websockets server. the default one rejects the clients that do not
+# offer any subprotocol, i.e. the CSV ones, this one accepts them without a subprotocol
+def select_ws_subprotocol(connection, subprotocols):
+    for subprotocol in WS_SUBPROTOCOLS:
+        if subprotocol in subprotocols:
+            return subprotocol
+    return None
+
+
+# items are (controller, data, delta seconds) tuples
+def encode_cc_batch(items):
+    frame = bytearray(_VERSION_BYTE)
+    for controller, data, delta in items:
+        frame += WS_CC_RECORD.pack(controller & 0x7F, data & 0x7F, min(int(delta / WS_DELTA_UNIT), WS_DELTA_MAX))
+    return bytes(frame)
+
+# returns an iterator of (controller, data, delta in 0.1ms units) tuples
+def decode_cc_batch(frame):
+    if not isinstance(frame, (bytes, bytearray)):
+        raise ValueError('Expected a binary frame')
+    if not frame or frame[0] != WS_BINARY_VERSION:
+        raise ValueError(f'Unsupported binary frame version {frame[0] if frame else None}')
+    if (len(frame) - 1) % WS_CC_RECORD.size:
+        raise ValueError(f'Truncated binary frame of {len(frame)} bytes')
+    return WS_CC_RECORD.iter_unpack(memoryview(frame)[1:])
+
+def encode_cc_csv(controller, data):
+    return f'{int(controller)},{int(data)}'
+
+def decode_cc_csv(message):
+    if not isinstance(message, str):
+        raise ValueError('Expected a text frame')
+    cc_controller, cc_data = message.split(',')
+    cc_controller, cc_data = int(cc_controller), int(cc_data)
+    if not 0 <= cc_controller <= 0x7F or not 0 <= cc_data <= 0x7F:
+        raise ValueError(f'CC out of range: {message!r}')
+    return cc_controller, cc_data
+
+# items are (NRPN controller, NRPN data) tuples
+def encode_state_frame(kind, items):
+    frame = bytearray([kind])
+    for controller, data in items:
+        frame += WS_STATE_RECORD.pack(controller, data)
+    return bytes(frame)
+
+# returns kind, and an iterator of (NRPN controller, NRPN data) tuples
+def decode_state_frame(frame):
+    if not isinstance(frame, (bytes, bytearray)):
+        raise ValueError('Expected a binary frame')
+    if not frame or frame[0] not in (WS_STATE_SNAPSHOT, WS_STATE_DELTA):
+        raise ValueError(f'Unsupported state frame kind {frame[0] if frame else None}')
+    if (len(frame) - 1) % WS_STATE_RECORD.size:
+        raise ValueError(f'Truncated state frame of {len(frame)} bytes')
+    return frame[0], WS_STATE_RECORD.iter_unpack(memoryview(frame)[1:])
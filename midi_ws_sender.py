@@ -0,0 +1,217 @@
+####################################################################################################
+############################## Persistent websocket link to the server #############################
+#### - Description:
+####   Used by midi_client_websockets.py. One websocket connection to midi_server_websockets.py is
+####   kept open by the client's asyncio event loop, instead of a new connection (TCP + HTTP upgrade)
+####   for every CC. The rtmidi callback hands CCs over with submit(), which is thread safe and never
+####   waits on the network. If the connection drops, it is re-opened with exponential backoff, and
+####   the CCs received in the meantime are sent once it is back (the oldest are dropped if more than
+####   queue_size pile up, only the latest knob positions matter).
+####   If the server speaks the binary protocol (see midi_ws_protocol.py), every CC waiting in the
+####   queue goes out in one frame, otherwise each CC is sent as its own "ctrl,data" text frame.
+####   With a flush_interval, only the newest value of every CC number is kept (a knob sweep sends
+####   dozens of CCs per second, only the last position matters). The first CC after a pause is
+####   sent at once, then at most one flush every flush_interval while the knob keeps moving. Once
+####   no newer value has come for quiet_gap, the knob has stopped and its final position is sent
+####   right away, without waiting for the rest of the interval.
+####   If the server pushes the mixer state ('ls9-cc.v2', see midi_ws_state.py), the latest levels
+####   of the MT5/MT6 sends & faders are kept in mixer_state (NRPN controller -> NRPN data).
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
+
+from midi_ws_protocol import WS_SUBPROTOCOLS, WS_BINARY_SUBPROTOCOLS, WS_SUBPROTOCOL_STATE_V2, WS_BATCH_MAX
+from midi_ws_protocol import WS_STATE_SNAPSHOT, encode_cc_batch, encode_cc_csv, decode_state_frame
+
+# CCs waiting to be sent while the connection is down
+WS_SEND_QUEUE_SIZE = 256
+# delay before reconnecting (seconds), doubled after every failed attempt up to the max
+WS_RECONNECT_MIN_DELAY = 0.25
+WS_RECONNECT_MAX_DELAY = 10.0
+# number of send latencies kept for the summary percentiles
+WS_LATENCY_SAMPLES = 4096
+# time between two flushes of the coalesced CCs (seconds), 0 sends every CC
+WS_FLUSH_INTERVAL = 0.02
+# no new CC for this long (seconds) flushes before the end of the flush interval. longer than the
+# time between two CCs of a knob being turned
+WS_FLUSH_QUIET_GAP = 0.005
+
+
+class WebsocketSender:
+    # subprotocols=[] forces the CSV format
+    def __init__(self, uri, loop, queue_size=WS_SEND_QUEUE_SIZE,
+                 min_delay=WS_RECONNECT_MIN_DELAY, max_delay=WS_RECONNECT_MAX_DELAY, subprotocols=WS_SUBPROTOCOLS,
+                 flush_interval=0.0, quiet_gap=WS_FLUSH_QUIET_GAP):
+        self.uri = uri
+        self.loop = loop
+        self.subprotocols = subprotocols
+        self.flush_interval = flush_interval
+        self.quiet_gap = quiet_gap
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.connected = asyncio.Event()
+        self.submitted = 0
+        self.sent = 0
+        self.frames = 0
+        self.dropped = 0
+        # values replaced by a newer one of the same CC before they were sent
+        self.coalesced = 0
+        self.connects = 0
+        # seconds from submit() to the CC written to the socket
+        self.latencies = deque(maxlen=WS_LATENCY_SAMPLES)
+        # NRPN controller -> data, as pushed by the server
+        self.mixer_state = {}
+        self.state_frames = 0
+        self._queue = asyncio.Queue(queue_size)
+        # CC number -> newest (controller, data, submit time) when coalescing
+        self._pending = {}
+        self._pending_set = asyncio.Event()
+        self._last_flush = 0.0
+        # CCs taken from the queue whose send failed, they go first after reconnecting
+        self._retry = []
+        # submit() time of the last CC sent, for the delta times of the binary protocol
+        self._last_submitted = None
+
+    # called from the rtmidi thread
+    def submit(self, controller, data):
+        self.loop.call_soon_threadsafe(self._enqueue, (controller, data, time.perf_counter()))
+
+    def _enqueue(self, item):
+        self.submitted += 1
+        if self.flush_interval > 0:
+            if item[0] in self._pending:
+                self.coalesced += 1
+            self._pending[item[0]] = item
+            self._pending_set.set()
+            return
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(item)
+
+    # runs until cancelled
+    async def run(self):
+        delay = self.min_delay
+        while True:
+            try:
+                async with connect(self.uri, subprotocols=self.subprotocols or None) as websocket:
+                    self.connects += 1
+                    delay = self.min_delay
+                    binary = websocket.subprotocol in WS_BINARY_SUBPROTOCOLS
+                    logging.info('Connected to %s (%s protocol)', self.uri, 'binary' if binary else 'CSV')
+                    self.connected.set()
+                    if websocket.subprotocol == WS_SUBPROTOCOL_STATE_V2:
+                        receiver = asyncio.create_task(self._receive_state(websocket))
+                    else:
+                        receiver = None
+                    try:
+                        if binary:
+                            await self._send_batches(websocket)
+                        else:
+                            await self._send_csv(websocket)
+                    finally:
+                        if receiver is not None:
+                            receiver.cancel()
+            except (OSError, ConnectionClosed, InvalidHandshake, asyncio.TimeoutError) as e:
+                self.connected.clear()
+                # the jitter keeps several clients from reconnecting in lockstep after a server restart
+                wait = delay * random.uniform(0.8, 1.2)
+                logging.warning('Websocket connection to %s lost (%s), reconnecting in %.1fs', self.uri, e, wait,
+                                extra={'rate_limit_key': 'websocket-reconnect'})
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_delay)
+
+    async def _receive_state(self, websocket):
+        try:
+            async for frame in websocket:
+                try:
+                    kind, items = decode_state_frame(frame)
+                except ValueError as e:
+                    logging.error('Invalid state frame from %s: %s', self.uri, e)
+                    continue
+                if kind == WS_STATE_SNAPSHOT:
+                    self.mixer_state.clear()
+                self.mixer_state.update(items)
+                self.state_frames += 1
+                logging.debug('Mixer state from %s: %d values known', self.uri, len(self.mixer_state))
+        except ConnectionClosed:
+            # the send loop notices it too, and reconnects
+            pass
+
+    # waits for a CC, then takes every other CC already queued, up to WS_BATCH_MAX
+    async def _next_batch(self):
+        if self._retry:
+            return self._retry
+        if self.flush_interval > 0:
+            await self._pending_set.wait()
+            deadline = self._last_flush + self.flush_interval
+            wait = deadline - self.loop.time()
+            while wait > 0:
+                # wait for the end of the interval, or for the knob to stop moving
+                self._pending_set.clear()
+                try:
+                    await asyncio.wait_for(self._pending_set.wait(), min(wait, self.quiet_gap))
+                except asyncio.TimeoutError:
+                    break
+                wait = deadline - self.loop.time()
+            self._pending_set.clear()
+            # there are at most 128 CC numbers, so they always fit in one batch
+            self._retry = list(self._pending.values())
+            self._pending.clear()
+            self._last_flush = self.loop.time()
+        else:
+            self._retry.append(await self._queue.get())
+            while len(self._retry) < WS_BATCH_MAX and not self._queue.empty():
+                self._retry.append(self._queue.get_nowait())
+        return self._retry
+
+    def _sent(self, batch):
+        now = time.perf_counter()
+        for controller, data, submitted in batch:
+            self.latencies.append(now - submitted)
+            logging.info('Websocket Send "%d,%d"', controller, data)
+        self.sent += len(batch)
+        self.frames += 1
+        self._last_submitted = batch[-1][2]
+
+    async def _send_csv(self, websocket):
+        while True:
+            batch = await self._next_batch()
+            # one frame per CC. the CCs not sent yet stay in the batch if the connection drops
+            while batch:
+                controller, data, _ = batch[0]
+                await websocket.send(encode_cc_csv(controller, data))
+                self._sent(batch[:1])
+                del batch[0]
+
+    async def _send_batches(self, websocket):
+        while True:
+            batch = await self._next_batch()
+            previous = batch[0][2] if self._last_submitted is None else self._last_submitted
+            items = []
+            for controller, data, submitted in batch:
+                items.append((controller, data, max(submitted - previous, 0.0)))
+                previous = submitted
+            await websocket.send(encode_cc_batch(items))
+            self._sent(batch)
+            self._retry = []
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        if latencies:
+            p50 = latencies[len(latencies) // 2] * 1e3
+            p99 = latencies[len(latencies) * 99 // 100] * 1e3
+            latency = f', send latency p50 {p50:.2f}ms p99 {p99:.2f}ms'
+        else:
+            latency = ''
+        if self.flush_interval > 0 and self.sent:
+            coalescing = f', {self.coalesced} coalesced ({self.submitted / self.sent:.1f} CCs received per CC sent)'
+        else:
+            coalescing = ''
+        return f'Websocket: {self.sent} CCs sent in {self.frames} frames over {self.connects} connections, ' \
+               f'{self.dropped} dropped{coalescing}{latency}'
@@ -0,0 +1,124 @@
+####################################################################################################
+############################# Server -> client push of the mixer state #############################
+#### - Description:
+####   Clients of midi_server_websockets.py that negotiate the 'ls9-cc.v2' subprotocol (see
+####   midi_ws_protocol.py) are sent the levels they mix with: the sends to MT5 & MT6 and every
+####   fader, as known by the server's ConsoleState, i.e. set from the console or by any client.
+####   On connect, a client gets a snapshot of every known value. After that, the state is checked
+####   every tick, and each client gets one frame with the values that changed since the last frame
+####   it was sent, so a fader throw of a second sends at most 1/tick updates of that fader.
+####   A client whose previous frame is still being sent is skipped for the tick. It catches up on
+####   the next one, with everything that changed in between merged into a single frame.
+import asyncio
+import logging
+from array import array
+
+from websockets.exceptions import ConnectionClosed
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+from midi_ws_protocol import WS_STATE_SNAPSHOT, WS_STATE_DELTA, encode_state_frame
+
+# time between two delta frames (seconds)
+WS_STATE_TICK = 0.05
+
+# controllers pushed to the clients, in frame order
+def _build_pushed_controllers():
+    controllers = []
+    for mapping in (MIDI_LS9.MT5_SOF_CTRLS, MIDI_LS9.MT6_SOF_CTRLS, MIDI_LS9.FADER_CTLRS):
+        for controller in mapping.values():
+            if controller not in controllers:
+                controllers.append(controller)
+    return tuple(controllers)
+
+WS_STATE_CONTROLLERS = _build_pushed_controllers()
+
+
+# a client subscribed to the state push, with the values it was last sent
+class StateSubscriber:
+    __slots__ = ('websocket', 'values', 'known', 'updates_seen', 'sending', 'frames', 'values_sent', 'bytes_sent')
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.values = array('H', bytes(2 * len(WS_STATE_CONTROLLERS)))
+        self.known = array('B', bytes(len(WS_STATE_CONTROLLERS)))
+        # ConsoleState.updates when the client was last brought up to date
+        self.updates_seen = -1
+        self.sending = False
+        self.frames = 0
+        self.values_sent = 0
+        self.bytes_sent = 0
+
+
+# Pushes the values of WS_STATE_CONTROLLERS in state (a ConsoleState) to the subscribed clients.
+# Runs on the event loop of the websocket server
+class StatePublisher:
+    def __init__(self, state, tick=WS_STATE_TICK):
+        self.state = state
+        self.tick_interval = tick
+        self.subscribers = {}
+        self.ticks = 0
+
+    # sends the snapshot, the client gets the delta frames from the next tick on
+    async def subscribe(self, websocket):
+        subscriber = StateSubscriber(websocket)
+        subscriber.updates_seen = self.state.updates
+        items = self._changes(subscriber)
+        self.subscribers[websocket] = subscriber
+        subscriber.sending = True
+        await self._send(subscriber, encode_state_frame(WS_STATE_SNAPSHOT, items), len(items))
+        return subscriber
+
+    def unsubscribe(self, websocket):
+        return self.subscribers.pop(websocket, None)
+
+    # values that changed since they were last sent to subscriber, marked as sent
+    def _changes(self, subscriber):
+        get = self.state.get
+        values = subscriber.values
+        known = subscriber.known
+        items = []
+        for i, controller in enumerate(WS_STATE_CONTROLLERS):
+            data = get(controller)
+            if data is not None and (not known[i] or values[i] != data):
+                values[i] = data
+                known[i] = 1
+                items.append((controller, data))
+        return items
+
+    # one delta frame to every subscriber that is behind & not busy sending the previous one
+    def tick(self):
+        self.ticks += 1
+        updates = self.state.updates
+        for subscriber in list(self.subscribers.values()):
+            if subscriber.sending or subscriber.updates_seen == updates:
+                continue
+            subscriber.updates_seen = updates
+            items = self._changes(subscriber)
+            if items:
+                subscriber.sending = True
+                asyncio.create_task(self._send(subscriber, encode_state_frame(WS_STATE_DELTA, items), len(items)))
+
+    async def _send(self, subscriber, frame, count):
+        try:
+            await subscriber.websocket.send(frame)
+        except ConnectionClosed:
+            # the listener of the connection unsubscribes it
+            return
+        finally:
+            subscriber.sending = False
+        subscriber.frames += 1
+        subscriber.values_sent += count
+        subscriber.bytes_sent += len(frame)
+
+    # runs until cancelled
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            try:
+                self.tick()
+            except Exception as e:
+                logging.exception('State push failed: %s', e)
+
+    def summary(self):
+        return f'State push: {len(self.subscribers)} subscribers, {self.ticks} ticks'
@@ -6,6 +6,8 @@
 ####       midi_yamaha_ls9.py [verbose]
 ####   > Run in console mode: program will echo any NRPN msgs received with controller+data values
 ####       midi_yamaha_ls9.py console
+####   > Open the MIDI port by (part of) its name rather than its number, see midi_ports.py
+####       midi_yamaha_ls9.py --port UM-ONE
 ####
 #### - Description:
 ####   This code automates some functions in the Yamaha LS-9 Mixer for the Ottawa Sai Centre
@@ -26,15 +28,18 @@
 ####            And so, to prevent the case of Mains OFF / Musician ON,
 ####            we turn OFF MONITR when ST LR is pressed OFF
 ####            and we turn ON ST LR when MONITR is pressed ON (it may already be on, that is fine)
+####   The automations are rules in automations.json (see yamaha_ls9_automations.py for the format),
+####   use --automations to load another rules file
+####   Scenes (presets of mutes, faders & sends) are in scenes.json, see yamaha_ls9_scenes.py. They
+####   are recalled by the scene_recall automations, or on startup with --scene NAME
 ####
 #### - pip Package Reference:
 ####     https://pypi.org/project/python-rtmidi/
-####     https://pypi.org/project/bidict/
 ####     https://click.palletsprojects.com/en/stable/
 #### - Requirements:
 ####   1. Disable Dummy MIDI device
 ####          echo "blacklist snd_seq_dummy" > /etc/modprobe.d/blacklist.conf
-####   2. This code requires a python venv with packages python-rtmidi & bidict installed.
+####   2. This code requires a python venv with packages python-rtmidi & click installed.
 ####      Here are the steps
 ####          apt update
 ####          apt install python-venv -y
@@ -42,7 +47,7 @@
 ####          cd ls9-midi
 ####          git clone https://github.com/joewawaw/ls9-midi src
 ####          source bin/activate
-####          pip install python-rtmidi bidict click
+####          pip install python-rtmidi click
 ####          cd src
 ####          ./midi_yamaha_ls9.py
 ####   3. Run on Startup (install as a systemd service):
@@ -86,336 +91,74 @@ systemctl start  midi_ls9.service
 #        3   0xB0     0x06     <DATA[0]>
 #        4   0xB0     0x26     <DATA[1]>
 
-import time
 import logging
-import traceback
+import threading
 import sys
 
-from bidict import bidict
 import rtmidi
 import click
 
 #my constants
 import yamaha_ls9_constants as MIDI_LS9
+from midi_nrpn import NrpnDecoder, RawMidiOut, FrameWatchdog
+from midi_nrpn import NRPN_RESYNC_INTERVAL, NRPN_CACHE_MAX_AGE, NRPN_COALESCE_MAX_RATE, NRPN_FRAME_BYTES, MIDI_WIRE_RATE
+from midi_pipeline import MidiPipeline
+from midi_logging import setup_logging
+from midi_ports import open_midi_port
+from midi_event_queue import MidiEventRing, MidiInputWorker, MIDI_QUEUE_SIZE, OVERFLOW_DROP_OLDEST, OVERFLOW_POLICIES
+from yamaha_ls9_automations import load_automations, DEFAULT_AUTOMATIONS_FILE
+from midi_metrics import MetricsRegistry, MetricsServer, METRICS_PORT_AUTOMATIONS
+from midi_profile import SamplingProfiler, PROFILE_SECONDS
+from midi_output_scheduler import OUTPUT_BURST
+from yamaha_ls9_scenes import load_scenes, DEFAULT_SCENES_FILE
+
+
+# this is a small tool to echo any NRPN-formatted CC commands. with capture, every CC received is
+# also saved to that file, to be replayed later with midi_capture.py
+def midi_console(midi_port, console, capture=None):
+    decoder = NrpnDecoder()
+    # timeout is set to 250ms
+    def on_frame_timeout():
+        if decoder.pending:
+            logging.warning('Timeout on midi input buffer! Incomplete NRPN frame dropped')
+            decoder.clear_pending()
+    frame_watchdog = FrameWatchdog(0.25, on_frame_timeout)
+    # print a blank line after 1s without any message, to separate bursts of messages
+    idle_watchdog = FrameWatchdog(1.0, print, name='console-idle-watchdog')
+
+    # console mode only, not imported by the automations
+    from midi_capture import CaptureWriter
+    capture_writer = None if capture is None else CaptureWriter(capture)
 
-
-def is_valid_nrpn_message(msg):
-    if int(msg[0][1]) != MIDI_LS9.NRPN_BYTE_1 or int(msg[1][1]) != MIDI_LS9.NRPN_BYTE_2 or \
-       int(msg[2][1]) != MIDI_LS9.NRPN_BYTE_3 or int(msg[3][1]) != MIDI_LS9.NRPN_BYTE_4:
-        raise ValueError(f'Invalid NRPN MIDI data sequence! MIDI Message Dump: {msg}')
-    return True
-
-def is_on_off_operation(msg):
-    # Since the bidict below contains all of the on/off channels, we can take message and check
-    #   if it matches a value in the ON_OFF_CONTROLLERS mapping to find out if this
-    #   message is an on/off operation.
-    # We use inverse() as the mapping is <ch_name> -> <controller_number> (we want to find ch_name)
-    if get_nrpn_ctlr(msg) in MIDI_LS9.ON_OFF_CTLRS.inverse:
-        return True
-    return False
-
-def is_fade_operation(msg):
-    if get_nrpn_ctlr(msg) in MIDI_LS9.FADER_CTLRS.inverse:
-        return True
-    return False
-
-#returns a string corresponding to the channel (or mix/mt) of the message
-def get_channel(msg):
-    if is_fade_operation(msg):
-        return MIDI_LS9.FADER_CTLRS.inv[get_nrpn_ctlr(msg)]
-
-    if is_on_off_operation(msg):
-        return MIDI_LS9.ON_OFF_CTLRS.inv[get_nrpn_ctlr(msg)]
-    return None
-
-#we need these in the midi message interpretation
-def combine_bytes(msb, lsb):
-    msb = int(msb); lsb = int(lsb)
-    # & 0b1111111 to mask out the 8th bit (MIDI data is 7 bits)
-    return ((msb & 0b1111111) << 7) | (lsb & 0b1111111)
-
-#returns multiple values!
-def split_bytes(combined):
-    combined = int(combined)
-    msb = (combined >> 7) & 0b1111111
-    lsb = combined & 0b1111111
-    return msb, lsb
-
-#this returns the nrpn controller. this is passed through one of the bidicts to return a string
-def get_nrpn_ctlr(msg):
-    return combine_bytes(msg[0][2], msg[1][2])
-
-#return midi NRPN data
-def get_nrpn_data(msg):
-    return combine_bytes(msg[2][2], msg[3][2])
-
-#returns the state on the on/off button press, True = OFF->ON, False = ON->OFF
-def get_on_off_data(msg):
-    if not is_on_off_operation(msg):
-        raise ValueError('Message is not an ON/OFF operation!')
-
-    data = get_nrpn_data(msg)
-    if data == MIDI_LS9.CH_OFF_VALUE:
-        return False
-    if data == MIDI_LS9.CH_ON_VALUE:
-        return True
-
-def send_nrpn(midi_output, controller, data):
-    controller1, controller2 = split_bytes(controller)
-    data1, data2 = split_bytes(data)
-
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_1,  controller1])
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_2,  controller2])
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_3,  data1])
-    midi_output.send_message([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_4,  data2])
-
-#these global vars holds the first 14 channel's on/off state (based on fader level)
-#it is needed for fader muting/unmuting
-channel_states = {
-    'CH01': 'OFF',  'CH02': 'OFF',  'CH03': 'OFF',  'CH04': 'OFF',  'CH05': 'OFF',
-    'CH06': 'OFF',  'CH07': 'OFF',  'CH08': 'OFF',  'CH09': 'OFF',  'CH10': 'OFF',
-    'CH11': 'OFF',  'CH12': 'OFF',  'CH13': 'OFF',  'CH14': 'OFF'
-}
-wltbk_state = 'OFF'
-
-# Process the 4 collected CC messages
-def process_midi_messages(messages, midi_out):
-    global channel_states
-    global wltbk_state
-    channel = get_channel(messages) #i.e. the NRPN controller
-    # Processing for Fade operations
-    if is_fade_operation(messages):
-        data = get_nrpn_data(messages)
-        # Mute the send of a vocal mic to MIX1,2 (for lead and chorus) if fader drops below -60dB
-        # we also use the channel_states dict to keep track of which channels have already been
-        # lowered (else we would have multiple triggers when the fader moves in b/w -inf to -60dB)
-        if channel in MIDI_LS9.CHORUS_TO_LEAD_MAPPING:
-            lead_ch = MIDI_LS9.CHORUS_TO_LEAD_MAPPING[channel]
-            if data < MIDI_LS9.FADE_60DB_VALUE and channel_states[channel] == 'ON':
-                channel_states[channel] = 'OFF'
-                out_data = MIDI_LS9.FADE_NEGINF_VALUE
-                logging.debug(f'MIXER IN: {channel} fade below -60dB')
-                logging.info(f'MIDI OUT: {channel}, {lead_ch} Send to MIX1,2 @ -inf dB')
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel], out_data)
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[lead_ch], out_data)
-            #fade back up to 0dB only if above -50dB, hence it is a software schmitt trigger
-            elif data > MIDI_LS9.FADE_50DB_VALUE and channel_states[channel] == 'OFF':
-                channel_states[channel] = 'ON'
-                out_data = MIDI_LS9.FADE_0DB_VALUE
-                logging.debug(f'MIXER IN: {channel} fade above -50dB')
-                logging.info(f'MIDI OUT: {channel}, {lead_ch} Send to MIX1,2 @ 0 dB')
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel], out_data)
-                send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[lead_ch], out_data)
-        elif channel == 'CH18':
-            #we map the input data range [0,16383] to [4096, 12288]
-            mapped_data = ((data-0)/(16383.0)*(12288-4096)+4096)
-            #logging.info(int(mapped_data))
-            send_nrpn(midi_out, MIDI_LS9.TABLA1_PEQ1, mapped_data)
-            send_nrpn(midi_out, MIDI_LS9.TABLA2_PEQ1, mapped_data)
-#! this section is actually not needed
-#        elif channel in MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING and channel_states[channel] == 'ON':
-#            channel_states[channel] = 'OFF'
-#            wl_chr_ch =  MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING[channel]
-#            wl_lead_ch = MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING[channel]
-#            if data < MIDI_LS9.FADE_60DB_VALUE:
-#                out_data = MIDI_LS9.FADE_NEGINF_VALUE
-#                logging.debug(f'MIXER IN: {channel} fade below -60dB')
-#                logging.info(f'MIDI OUT: {channel}, {wl_chr_ch}, {wl_lead_ch} Send to MIX1,2 @ -inf dB')
-#            elif data > MIDI_LS9.FADE_50DB_VALUE:
-#                out_data = MIDI_LS9.FADE_0DB_VALUE
-#                logging.debug(f'MIXER IN: {channel} fade above -50dB')
-#                logging.info(f'MIDI OUT: {channel}, {wl_chr_ch}, {wl_lead_ch} Send to MIX1,2 @ 0dB')
-#            send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[channel],    out_data)
-#            send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[wl_chr_ch],  out_data)
-#            send_nrpn(midi_out, MIDI_LS9.MIX1_SOF_CTLRS[wl_lead_ch], out_data)
-
-    # Processing for ON/OFF message operations
-    if is_on_off_operation(messages):
-        data = get_on_off_data(messages)
-    #### Automation for CH01-CH10 switched ON/OFF (switch OFF/ON alt_channel)
-        # if the channel is in the forward values of this mapping, it's one of the original channels
-        if channel in MIDI_LS9.CHORUS_TO_LEAD_MAPPING:
-            alt_channel = MIDI_LS9.CHORUS_TO_LEAD_MAPPING[channel]
-            if data is True:
-                out_data = MIDI_LS9.CH_OFF_VALUE
-                logging.debug(f'MIXER IN: {channel} switched ON')
-                logging.info(f'MIDI OUT: {alt_channel} OFF')
-            else:
-                out_data = MIDI_LS9.CH_ON_VALUE
-                logging.debug(f'MIXER IN: {channel} switched OFF')
-                logging.info(f'MIDI OUT: {alt_channel} ON')
-            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[alt_channel], out_data)
-
-        #if the channel is part of the inverse bidict, it is a duplicate channel (i.e. CH33-CH42)
-        elif channel in MIDI_LS9.CHORUS_TO_LEAD_MAPPING.inv:
-            alt_channel = MIDI_LS9.CHORUS_TO_LEAD_MAPPING.inv[channel]
-            if data is True:
-                out_data = MIDI_LS9.CH_OFF_VALUE
-                logging.debug(f'MIXER IN: {channel} switched ON')
-                logging.info(f'MIDI OUT: {alt_channel} OFF')
-            else:
-                out_data = MIDI_LS9.CH_ON_VALUE
-                logging.debug(f'MIXER IN: {channel} switched OFF')
-                logging.info(f'MIDI OUT: {alt_channel} ON')
-            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[alt_channel], out_data)
-       
-        #elif channel in MIDI_LS9.FADER_CTLRS["CH18"]:
-        
-
-    #### Automation for Wireless Mics switched ON/OFF
-    #    elif channel in MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING:
-    #        logging.info(f'{wltbk_state=}')
-    #        # If Wireless MC CH N switched ON, then turn off WLCHR N & LEADWL N
-    #        if data is True:
-    #            #we disable toggling of this channel if wltbk_state is ON and the current channel is 13 or 14
-    #            if wltbk_state == 'OFF' or (wltbk_state=='ON' and channel!='CH13' and channel!='CH14'):
-    #                chr_channel =  MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING[channel]
-    #                lead_channel = MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING[channel]
-    #                #logging.info(f'MIDI OUT: {lead_channel} OFF & CH {chr_channel} OFF')
-    #                #send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel],  MIDI_LS9.CH_OFF_VALUE)
-    #                #send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_OFF_VALUE)
-    #            #if a channel that is WLTBK is switched ON while in WLTBK mode,
-    #            # we need to turn it back off.
-    #            elif wltbk_state == 'ON':
-    #                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[channel],  MIDI_LS9.CH_OFF_VALUE)
-    #        else:
-    #            chr_channel =  MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING[channel]
-    #            lead_channel = MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING[channel]
-    #            logging.info(f'MIDI OUT: {chr_channel} ON & CH {lead_channel} OFF')
-    #            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel],  MIDI_LS9.CH_ON_VALUE)
-    #            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_OFF_VALUE)
-    #
-    #    elif channel in MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING.inv:
-    #        # If LEADWL CH N switched ON, then turn off WLCHR N & WLMC N
-    #        if data is True:
-    #            if wltbk_state == 'OFF' or (wltbk_state=='ON' and channel!='CH45' and channel!='CH46'):
-    #                mc_channel =  MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING.inv[channel]
-    #                chr_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING.inv[channel]
-    #                logging.info(f'MIDI OUT: {chr_channel} OFF & CH {mc_channel} OFF')
-    #                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel], MIDI_LS9.CH_OFF_VALUE)
-    #                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],  MIDI_LS9.CH_OFF_VALUE)
-    #            elif wltbk_state == 'ON':
-    #                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[channel],  MIDI_LS9.CH_OFF_VALUE)
-    #        else:
-    #            mc_channel =  MIDI_LS9.WIRELESS_MC_TO_LEAD_MAPPING.inv[channel]
-    #            chr_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING.inv[channel]
-    #            logging.info(f'MIDI OUT: {chr_channel} ON & CH {mc_channel} OFF')
-    #            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[chr_channel], MIDI_LS9.CH_ON_VALUE)
-    #            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],  MIDI_LS9.CH_OFF_VALUE)
-    #
-    #    elif channel in MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING:
-    #        # If WLCHR CH N switched ON, then turn off LEADWL N & WLMC N
-    #        if data is True:
-    #            if wltbk_state == 'OFF' or (wltbk_state=='ON' and channel!='CH49' and channel!='CH50'):
-    #                mc_channel =   MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING.inv[channel]
-    #                lead_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING[channel]
-    #                logging.info(f'MIDI OUT: {mc_channel} OFF & CH {lead_channel} OFF')
-    #                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],   MIDI_LS9.CH_OFF_VALUE)
-    #                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_OFF_VALUE)
-    #            elif wltbk_state == 'ON':
-    #                send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[channel],  MIDI_LS9.CH_OFF_VALUE)
-    #        else:
-    #            mc_channel =   MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING.inv[channel]
-    #            lead_channel = MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING[channel]
-    #            logging.info(f'MIDI OUT: {lead_channel} ON & CH {mc_channel} OFF')
-    #            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[lead_channel], MIDI_LS9.CH_ON_VALUE)
-    #            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS[mc_channel],   MIDI_LS9.CH_OFF_VALUE)
-
-    #### Automation for MIX1 or MIX2 switched ON (switch ON ST LR)
-        elif channel == 'MIX1' or channel == 'MIX2' and data is True:
-            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['ST LR'], MIDI_LS9.CH_ON_VALUE)
-    #### Automation for ST L/R switched OFF (switch OFF MIX1 as well)
-        elif channel == 'ST LR' and data is False:
-            send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['MIX1'], MIDI_LS9.CH_OFF_VALUE)
-
-    #### Automation for PC IN2 routing to BASMNT
-        elif channel == 'ST-IN2':
-            if data is True:
-                logging.info('MIDI OUT: PC IN2 -> BASMNT')
-                out_data_mix16 = MIDI_LS9.FADE_0DB_VALUE
-                out_data_mono =  MIDI_LS9.FADE_NEGINF_VALUE
-            else:
-                logging.info('MIDI OUT: STREAM -> BASMNT')
-                out_data_mix16 = MIDI_LS9.FADE_NEGINF_VALUE
-                out_data_mono =  MIDI_LS9.FADE_0DB_VALUE
-            send_nrpn(midi_out, MIDI_LS9.MIX16_SEND_TO_MT1, out_data_mix16)
-            send_nrpn(midi_out, MIDI_LS9.MONO_SEND_TO_MT1,  out_data_mono)
-
-    #### Automation for PC IN2 routing to LOBBY
-        elif channel == 'ST-IN3':
-            if data is True:
-                logging.info('MIDI OUT: PC IN2 -> LOBBY')
-                out_data_mix16 = MIDI_LS9.FADE_0DB_VALUE
-                out_data_stlr =  MIDI_LS9.FADE_NEGINF_VALUE
-            else:
-                logging.info('MIDI OUT: ST L/R -> LOBBY')
-                out_data_mix16 = MIDI_LS9.FADE_NEGINF_VALUE
-                out_data_stlr =  MIDI_LS9.FADE_0DB_VALUE
-            send_nrpn(midi_out, MIDI_LS9.MIX16_SEND_TO_MT2, MIDI_LS9.FADE_NEGINF_VALUE)
-            send_nrpn(midi_out, MIDI_LS9.STLR_SEND_TO_MT2,  MIDI_LS9.FADE_0DB_VALUE)
-
-    #### Automation for LOUNGE toggle between MONO and ST LR (ST-IN3 switched ON)
-        elif channel == 'ST-IN1':
-            # if ON, route MONO to LOUNGE
-            if data is True:
-                logging.info('MIDI OUT: MONO -> LOUNGE')
-                out_data_mono = MIDI_LS9.FADE_0DB_VALUE
-                out_data_stlr = MIDI_LS9.FADE_NEGINF_VALUE
-            # if OFF, route ST LR to LOUNGE
-            else:
-                logging.info('MIDI OUT: ST L/R -> LOUNGE')
-                out_data_mono = MIDI_LS9.FADE_NEGINF_VALUE
-                out_data_stlr = MIDI_LS9.FADE_0DB_VALUE
-            send_nrpn(midi_out, MIDI_LS9.MONO_SEND_TO_MT3,  out_data_mono)
-            send_nrpn(midi_out, MIDI_LS9.ST_LR_SEND_TO_MT3, out_data_stlr)
-
-    #### Automation for toggling WLTBK 3 & 4 ON/OFF
-        #elif channel == 'ST-IN3':
-        #    if data is True:
-        #        logging.info('MIDI OUT: WLTBK3 & WLTBK4 ON')
-        #        wltbk_state = 'ON' # we need this global var to disable WL MC/CHR/LEAD toggling
-        #        out_data = MIDI_LS9.CH_OFF_VALUE
-        #    else:
-        #        logging.info('MIDI OUT: WLTBK3 & WLTBK4 OFF')
-        #        wltbk_state = 'OFF'
-        #        #turn on only MC channels (and turn off all alt channels below)
-        #        out_data = MIDI_LS9.CH_ON_VALUE
-
-        #    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH13'], out_data)
-        #    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH14'], out_data)
-        #    #turn off all alt channels for wireless mics 3 & 4; as they all route to ST L/R
-        #    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH45'], MIDI_LS9.CH_OFF_VALUE)
-        #    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH46'], MIDI_LS9.CH_OFF_VALUE)
-        #    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH49'], MIDI_LS9.CH_OFF_VALUE)
-        #    send_nrpn(midi_out, MIDI_LS9.ON_OFF_CTLRS['CH50'], MIDI_LS9.CH_OFF_VALUE)
-
-
-# this is a small tool to echo any NRPN-formatted CC commands
-def midi_console(midi_port, console):
-    midi_nrpn_console_messages = []
-    # using a list because lists are mutable, and so their values will change in the parent function
-    # if changed in a child function.
-    timeout_counter = [0]
     def midi_nrpn_callback(event, unused):
         message, timestamp = event
-
-        if message[0] == MIDI_LS9.CC_CMD_BYTE:
-            midi_nrpn_console_messages.append(message)
-        if len(midi_nrpn_console_messages) == 4:
-            controller = get_nrpn_ctlr(midi_nrpn_console_messages)
-            data =       get_nrpn_data(midi_nrpn_console_messages)
-            logging.info(f'NRPN Message    Controller  {hex(controller)}\tData  {hex(data)}')
-            midi_nrpn_console_messages.clear()
-            timeout_counter[0] = 0
+        if message[0] != MIDI_LS9.CC_CMD_BYTE:
+            return
+        if capture_writer is not None:
+            capture_writer.write(message, timestamp)
+        with frame_watchdog.lock:
+            # timestamp is the delta time since the previous message
+            if decoder.pending and timestamp > frame_watchdog.timeout:
+                on_frame_timeout()
+            if decoder.feed(message):
+                logging.info('NRPN Message    Controller  %#x\tData  %#x', decoder.controller, decoder.data)
+            if decoder.pending:
+                frame_watchdog.arm()
+            else:
+                frame_watchdog.disarm()
+        idle_watchdog.arm()
 
     def midi_cc_callback(event, unused):
         message, timestamp = event
         if message[0] == MIDI_LS9.CC_CMD_BYTE:
-            logging.info(f'CC Message    {message[0]}\t{message[1]}\t{message[2]}')
+            if capture_writer is not None:
+                capture_writer.write(message, timestamp)
+            logging.info('CC Message    %d\t%d\t%d', message[0], message[1], message[2])
+            idle_watchdog.arm()
 
-    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    setup_logging(logging.INFO, '%(asctime)s %(message)s')
     midi_in = rtmidi.MidiIn()
-    midi_in.open_port(midi_port)
+    open_midi_port(midi_in, midi_port)
 
     if console == 'CC':
         logging.info('MIDI CC Console. Echoing all incoming MIDI CC messages (3 byte packets)')
@@ -425,94 +168,121 @@ def midi_console(midi_port, console):
         logging.info('MIDI NRPN Console. Echoing all incoming MIDI NRPN messages (controller+data)')
         logging.info('Press CTRL+C to exit')
         midi_in.set_callback(midi_nrpn_callback)
+    if capture_writer is not None:
+        logging.info('Saving every CC message received to %s', capture)
 
     try:
-        while True:
-            time.sleep(0.05)
-            timeout_counter[0] += 1
-            # every 1s print a blank line
-            if timeout_counter[0] == 20:
-                print()
-                timeout_counter[0] = 0
-            #if timeout_counter overflows, check if input buffer data is incomplete (>0, <4) & reset
-            #timeout is set to 250ms
-            if timeout_counter[0] > 5:
-                if len(midi_nrpn_console_messages) > 0 and len(midi_nrpn_console_messages) < 4:
-                    logging.warning(f'Timeout on midi input buffer! data: {midi_nrpn_console_messages}')
-                    midi_nrpn_console_messages.clear()
-                    timeout_counter[0] = 0
+        # nothing to do on this thread, the callbacks & watchdogs do all of the work
+        threading.Event().wait()
     except KeyboardInterrupt:
         print('Exiting...')
     finally:
         midi_in.close_port()
+        if capture_writer is not None:
+            capture_writer.close()
+            logging.info('%d CC messages saved to %s', capture_writer.records, capture)
         sys.exit()
 
 @click.command()
 @click.option('-v', '--verbose', is_flag=True, default=False, help='Set logging level to DEBUG')
 @click.option('-c', '--console', default=None, type=click.Choice(['CC', 'NRPN'], case_sensitive=False), help='Run in console mode')
-@click.option('-p', '--port', default=0, metavar='PORT', show_default=True, type=int, help='Specify MIDI port number')
-
-def main(port, console, verbose):
+@click.option('--capture', default=None, metavar='PATH', type=click.Path(dir_okay=False), help='Console mode: also save every CC received to a capture file (replay it with midi_capture.py)')
+@click.option('-p', '--port', default='0', metavar='PORT', show_default=True, help='Specify MIDI port number, or part of the port name (i.e. UM-ONE)')
+@click.option('--rawmidi', default=None, metavar='DEVICE', type=click.Path(), help='Send MIDI output to an ALSA rawmidi device (i.e. /dev/snd/midiC1D0) instead of PORT, one write per NRPN')
+@click.option('--resync', default=NRPN_RESYNC_INTERVAL, metavar='SECONDS', show_default=True, type=float, help='Re-send an unchanged NRPN address at least this often (0 = always)')
+@click.option('--cache-max-age', default=NRPN_CACHE_MAX_AGE, metavar='SECONDS', show_default=True, type=float, help='Drop sends of values the console held less than this long ago (0 = never drop)')
+@click.option('--max-rate', default=NRPN_COALESCE_MAX_RATE, metavar='HZ', show_default=True, type=float, help='Max update rate of parameters linked to a fader (i.e. CH18 -> tabla PEQ)')
+@click.option('-a', '--automations', default=DEFAULT_AUTOMATIONS_FILE, metavar='PATH', show_default=True, type=click.Path(exists=True, dir_okay=False), help='Automation rules file')
+@click.option('--queue-size', default=MIDI_QUEUE_SIZE, metavar='N', show_default=True, type=click.IntRange(min=1), help='Number of incoming CC messages buffered for the automations')
+@click.option('--overflow', default=OVERFLOW_DROP_OLDEST, show_default=True, type=click.Choice(OVERFLOW_POLICIES), help='What to do with incoming MIDI when the buffer is full')
+@click.option('--metrics-port', default=METRICS_PORT_AUTOMATIONS, metavar='PORT', show_default=True, type=click.IntRange(min=0, max=65535), help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (0 = disabled)')
+@click.option('--profile', default=None, metavar='PATH', type=click.Path(dir_okay=False), help='Profile the MIDI path, write the collapsed stacks (flamegraph) to PATH & a per-function summary to PATH.txt')
+@click.option('--profile-seconds', default=PROFILE_SECONDS, metavar='SECONDS', show_default=True, type=click.FloatRange(min=0, min_open=True), help='Length of the profiling window')
+@click.option('--scenes', default=DEFAULT_SCENES_FILE, metavar='PATH', show_default=True, type=click.Path(exists=True, dir_okay=False), help='Scene file, for the scene_recall automations & --scene')
+@click.option('--scene', default=None, metavar='NAME', help='Recall a scene on startup (only the values that differ from the known console state are sent)')
+@click.option('--scene-rate', default=MIDI_WIRE_RATE, metavar='BYTES/S', show_default=True, type=click.FloatRange(min=0), help='Pace scene recalls to this many bytes/sec (31.25 kbaud MIDI, 0 = unpaced)')
+@click.option('--output-rate', default=MIDI_WIRE_RATE, metavar='BYTES/S', show_default=True, type=click.FloatRange(min=0), help='Limit the MIDI output to this many bytes/sec (31.25 kbaud MIDI, 0 = no limit); on/off switches go out ahead of fader-linked updates')
+@click.option('--output-burst', default=OUTPUT_BURST, metavar='BYTES', show_default=True, type=click.IntRange(min=NRPN_FRAME_BYTES), help='Bytes sent back to back before --output-rate applies')
+def main(port, console, capture, verbose, rawmidi, resync, cache_max_age, max_rate, automations, queue_size, overflow, metrics_port, profile, profile_seconds, scenes, scene, scene_rate, output_rate, output_burst):
     #if the console flag was passed, run one of the mini-tools instead of the main program (automations)
-    if console is not None:
-        midi_console(port, console)
+    if console is not None or capture is not None:
+        midi_console(port, console or 'NRPN', capture)
 
     if verbose is True:
         log_level = logging.DEBUG
     else:
         log_level = logging.INFO
     # time is given in ISO8601 date format
-    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=log_level)
+    # records are written by a background thread, see midi_logging.py
+    setup_logging(log_level)
+    # the rules are loaded before opening any port, so a broken rules file fails right away
+    rules = load_automations(automations)
+    logging.info('Loaded %d automations from %s', len(rules), automations)
+    scene_list = load_scenes(scenes)
+    logging.info('Loaded %d scenes from %s', len(scene_list), scenes)
+    # like the rules, a mistyped --scene fails before any port is opened
+    scene_names = [scene_spec.name for scene_spec in scene_list]
+    if scene is not None and scene not in scene_names:
+        raise click.BadParameter(f'unknown scene {scene!r}, expected one of {", ".join(scene_names)}', param_hint='--scene')
     logging.info('MIDI LS9 Automations. Waiting for incoming MIDI NRPN messages...')
 
     # Setup the MIDI input & output
     midi_in =  rtmidi.MidiIn()
-    midi_in.open_port(port)
-    midi_out = rtmidi.MidiOut()
-    midi_out.open_port(port)
-
-    midi_messages = []
-    timeout_counter = [0]
+    open_midi_port(midi_in, port)
+    if rawmidi is None:
+        midi_out = rtmidi.MidiOut()
+        open_midi_port(midi_out, port)
+    else:
+        midi_out = RawMidiOut(rawmidi)
+    # decoder -> automations -> output scheduler -> encoder, see midi_pipeline.py
+    pipeline = MidiPipeline(midi_out, rules, scene_list, resync_interval=resync, cache_max_age=cache_max_age,
+                            max_rate=max_rate, output_rate=output_rate, output_burst=output_burst, scene_rate=scene_rate)
+
+    # the rtmidi thread only queues the message, decoding, automations & output run on midi_worker.
+    # the arrival times of the messages are only taken for the latency metric
+    midi_queue = MidiEventRing(queue_size, overflow, arrivals=metrics_port > 0)
+    metrics = MetricsRegistry()
+    pipeline.register_metrics(metrics, midi_queue)
+
+    midi_worker = MidiInputWorker(midi_queue, pipeline.process_cc_message)
     def main_midi_callback(event, unused):
         messages, timestamp = event
         # Filter out everything but CC (Control Change) commands
         if messages[0] == MIDI_LS9.CC_CMD_BYTE:
-            midi_messages.append(messages)
-            logging.debug(f'Received CC command {messages}')
-        # Once we have 4 CC messages, process them
-        if len(midi_messages) == 4:
-            try:
-                process_midi_messages(midi_messages, midi_out)
-            # we will catch all exceptions to make this system a big more rugged.
-            except Exception as e:
-                error_message = traceback.format_exc()
-                logging.error(error_message)
-                logging.error(str(e))
-            finally:
-                midi_messages.clear()  # Clear the list for the next batch of 4 messages
-                timeout_counter[0] = 0
+            midi_queue.put(messages, timestamp)
 
     #set_callback needs to be after the function above, and the callback function needs to know
     # about midi_out
     midi_in.set_callback(main_midi_callback)
+    metrics_server = None
+    if metrics_port > 0:
+        metrics_server = MetricsServer(metrics, port=metrics_port)
+        logging.info('Serving metrics on http://127.0.0.1:%d/metrics', metrics_server.port)
+    # samples the threads of the MIDI path for profile_seconds, see midi_profile.py
+    profiler = SamplingProfiler(profile, profile_seconds).start() if profile is not None else None
+    if scene is not None:
+        pipeline.scene_recaller.recall(scene)
 
-    while True:
-        try:
-            #delay is necessary to not overload the CPU or RAM
-            time.sleep(0.005)
-            # if there is an incomplete packet in the buffer, increase the timeout
-            if len(midi_messages) > 0:
-                timeout_counter[0] += 1
-            #if counter exceeds 0.005 * 20 = 100ms
-            if timeout_counter[0] > 20:
-                midi_messages.clear()
-                timeout_counter[0] = 0
-                logging.warning('Timeout! Resetting MIDI input buffer')
-        except KeyboardInterrupt:
-            logging.warning('CTRL+C pressed. Exiting...')
-            midi_in.close_port()
-            midi_out.close_port()
-            sys.exit()
+    try:
+        # block until CTRL+C. incoming MIDI is handled on the rtmidi thread and timeouts on the
+        # watchdog thread, so there is no need to wake up this thread periodically
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        logging.warning('CTRL+C pressed. Exiting...')
+    finally:
+        # whatever stopped the main thread, the queued outputs are still sent & the ports closed
+        midi_in.close_port()
+        if profiler is not None:
+            profiler.stop()
+        midi_worker.stop()
+        pipeline.stop()
+        midi_out.close_port()
+        if metrics_server is not None:
+            metrics_server.stop()
+        logging.info(midi_queue.summary())
+        for summary in pipeline.summaries():
+            logging.info(summary)
+    sys.exit()
 
 if __name__ == '__main__':
     main()
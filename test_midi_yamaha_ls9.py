@@ -1,5 +1,1484 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+
+from click.testing import CliRunner
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+import yamaha_ls9_constants as MIDI_LS9
+from yamaha_ls9_state import ConsoleState
+from midi_nrpn import NrpnDecoder, NrpnEncoder, NrpnValueCache, NrpnCoalescer, NrpnFanIn, RawMidiOut, FrameWatchdog, LoopFrameWatchdog
+from midi_nrpn import DATA_INCREMENT, DATA_DECREMENT, RPN_BYTE_1, NRPN_FRAME_TIMEOUT
+from midi_event_queue import MidiEventRing, MidiInputWorker, MidiLoopInput
+from midi_logging import RateLimitFilter, setup_logging
+from midi_capture import CaptureWriter, CaptureReader, replay, cli as capture_cli
+from midi_ws_sender import WebsocketSender
+from midi_ws_protocol import WS_SUBPROTOCOLS, WS_BINARY_SUBPROTOCOLS, select_ws_subprotocol
+from midi_ws_protocol import encode_cc_batch, decode_cc_batch, encode_cc_csv, decode_cc_csv, WS_BINARY_VERSION, WS_CC_RECORD
+from midi_ws_protocol import WS_STATE_DELTA, encode_state_frame, decode_state_frame
+from midi_ws_state import StatePublisher, WS_STATE_CONTROLLERS
+from yamaha_ls9_automations import AutomationEngine, load_automations, parse_automations, SERVER_AUTOMATIONS_FILE
+from yamaha_ls9_usb_cc import UsbCcRouter, USB_CC_DESTINATIONS, USB_CC_NO_DESTINATION, build_fader_law
+from midi_metrics import MetricsRegistry, MetricsServer, register_output_metrics, METRICS_CONTENT_TYPE
+from midi_profile import SamplingProfiler
+from yamaha_ls9_scenes import SceneRecaller, load_scenes, parse_scenes, DEFAULT_SCENES_FILE
+from midi_pipeline import MidiPipeline
+from midi_output_scheduler import MidiOutputScheduler, LANE_CONTROL, LANE_CONTINUOUS, LANE_BULK
+from midi_ports import find_midi_port, open_midi_port
+
+
+def nrpn_frame(controller, data, status=MIDI_LS9.CC_CMD_BYTE):
+    return [[status, MIDI_LS9.NRPN_BYTE_1, controller >> 7],
+            [status, MIDI_LS9.NRPN_BYTE_2, controller & 0x7F],
+            [status, MIDI_LS9.NRPN_BYTE_3, data >> 7],
+            [status, MIDI_LS9.NRPN_BYTE_4, data & 0x7F]]
+
+# in-memory stand-in for rtmidi.MidiOut
+class FakeMidiOut:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, message):
+        self.messages.append(list(message))
+
+
+class TestCtlrDispatch(unittest.TestCase):
+    def test_table_covers_every_controller(self):
+        self.assertEqual(len(MIDI_LS9.CTLR_DISPATCH), MIDI_LS9.NRPN_CTLR_COUNT)
+
+    def test_matches_bidicts(self):
+        for controller in range(MIDI_LS9.NRPN_CTLR_COUNT):
+            kind, channel, _ = MIDI_LS9.classify_nrpn_ctlr(controller)
+            if controller in MIDI_LS9.FADER_CTLRS.inverse:
+                self.assertEqual(kind, MIDI_LS9.CTLR_KIND_FADER)
+                self.assertEqual(channel, MIDI_LS9.FADER_CTLRS.inv[controller])
+            elif controller in MIDI_LS9.ON_OFF_CTLRS.inverse:
+                self.assertEqual(kind, MIDI_LS9.CTLR_KIND_ON_OFF)
+                self.assertEqual(channel, MIDI_LS9.ON_OFF_CTLRS.inv[controller])
+            else:
+                self.assertEqual((kind, channel), (MIDI_LS9.CTLR_KIND_NONE, None))
+
+    def test_handler_groups(self):
+        self.assertEqual(MIDI_LS9.classify_nrpn_ctlr(MIDI_LS9.ON_OFF_CTLRS['CH01'])[2], MIDI_LS9.HANDLER_CHORUS)
+        self.assertEqual(MIDI_LS9.classify_nrpn_ctlr(MIDI_LS9.FADER_CTLRS['CH01'])[2],  MIDI_LS9.HANDLER_CHORUS)
+        self.assertEqual(MIDI_LS9.classify_nrpn_ctlr(MIDI_LS9.ON_OFF_CTLRS['CH33'])[2], MIDI_LS9.HANDLER_LEAD)
+        self.assertEqual(MIDI_LS9.classify_nrpn_ctlr(MIDI_LS9.ON_OFF_CTLRS['CH11'])[2], MIDI_LS9.HANDLER_WL_MC)
+        self.assertEqual(MIDI_LS9.classify_nrpn_ctlr(MIDI_LS9.ON_OFF_CTLRS['CH47'])[2], MIDI_LS9.HANDLER_WL_CHR)
+        self.assertEqual(MIDI_LS9.classify_nrpn_ctlr(MIDI_LS9.ON_OFF_CTLRS['CH43'])[2], MIDI_LS9.HANDLER_WL_LEAD)
+        self.assertEqual(MIDI_LS9.classify_nrpn_ctlr(MIDI_LS9.ON_OFF_CTLRS['ST LR'])[2], MIDI_LS9.HANDLER_NONE)
+
+    def test_mappings(self):
+        self.assertIs(MIDI_LS9.CHORUS_TO_LEAD_MAPPING.inverse.inverse, MIDI_LS9.CHORUS_TO_LEAD_MAPPING)
+        self.assertEqual(MIDI_LS9.CHORUS_TO_LEAD_MAPPING.inv['CH33'], 'CH01')
+        with self.assertRaises(TypeError):
+            MIDI_LS9.ON_OFF_CTLRS['CH01'] = 0
+        with self.assertRaises(TypeError):
+            MIDI_LS9.ON_OFF_CTLRS.inverse.update({0: 'CH01'})
+        with self.assertRaises(ValueError):
+            MIDI_LS9.bidict({'CH01': 1, 'CH02': 1})
+
+
+class TestNrpnDecoder(unittest.TestCase):
+    def feed_all(self, decoder, messages):
+        events = []
+        for message in messages:
+            if decoder.feed(message):
+                events.append((decoder.controller, decoder.data))
+        return events
+
+    def test_full_frame(self):
+        decoder = NrpnDecoder()
+        frame = nrpn_frame(MIDI_LS9.FADER_CTLRS['CH05'], MIDI_LS9.FADE_0DB_VALUE)
+        self.assertEqual([decoder.feed(message) for message in frame], [False, False, False, True])
+        self.assertEqual((decoder.controller, decoder.data),
+                         (MIDI_LS9.FADER_CTLRS['CH05'], MIDI_LS9.FADE_0DB_VALUE))
+        self.assertFalse(decoder.pending)
+
+    def test_data_only_update_reuses_address(self):
+        decoder = NrpnDecoder()
+        controller = MIDI_LS9.FADER_CTLRS['CH18']
+        messages = nrpn_frame(controller, 0x100) + nrpn_frame(controller, 0x1234)[2:]
+        self.assertEqual(self.feed_all(decoder, messages), [(controller, 0x100), (controller, 0x1234)])
+        self.assertEqual(decoder.data_only_frames, 1)
+
+    def test_partial_frame_does_not_corrupt_next_frame(self):
+        decoder = NrpnDecoder()
+        controller = MIDI_LS9.ON_OFF_CTLRS['CH01']
+        messages = nrpn_frame(0x1234, 0x10)[:2] + nrpn_frame(controller, MIDI_LS9.CH_ON_VALUE)
+        self.assertEqual(self.feed_all(decoder, messages), [(controller, MIDI_LS9.CH_ON_VALUE)])
+
+    def test_lost_address_byte_drops_the_frame(self):
+        fader = nrpn_frame(MIDI_LS9.FADER_CTLRS['CH01'], 0x100)
+        switch = nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['CH05'], MIDI_LS9.CH_ON_VALUE)
+        for lost in (0, 1):
+            with self.subTest(lost=lost):
+                decoder = NrpnDecoder()
+                messages = fader + switch[:lost] + switch[lost + 1:] + switch
+                # not a mix of the two addresses (i.e. 0x1d00, the CH51 fader)
+                self.assertEqual(self.feed_all(decoder, messages),
+                                 [(MIDI_LS9.FADER_CTLRS['CH01'], 0x100), (MIDI_LS9.ON_OFF_CTLRS['CH05'], MIDI_LS9.CH_ON_VALUE)])
+                self.assertEqual(decoder.invalid, 2)
+
+    def test_pending_and_clear(self):
+        decoder = NrpnDecoder()
+        frame = nrpn_frame(MIDI_LS9.FADER_CTLRS['CH01'], 0x2000)
+        self.feed_all(decoder, frame[:3])
+        self.assertTrue(decoder.pending)
+        decoder.clear_pending()
+        self.assertFalse(decoder.pending)
+        self.assertFalse(decoder.feed(frame[3]))
+
+    def test_invalid_data_is_counted(self):
+        decoder = NrpnDecoder()
+        frame = nrpn_frame(MIDI_LS9.FADER_CTLRS['CH01'], 0x2000)
+        # data without an address, then a data LSB without its MSB
+        self.assertEqual(self.feed_all(decoder, frame[2:] + frame[:2] + frame[3:]), [])
+        self.assertEqual(decoder.invalid, 3)
+        self.assertEqual(decoder.frames, 0)
+
+    def test_increment_and_decrement(self):
+        decoder = NrpnDecoder()
+        controller = MIDI_LS9.FADER_CTLRS['CH02']
+        messages = nrpn_frame(controller, 0x3FFE) + [[0xB0, DATA_INCREMENT, 0]] * 2 + \
+                   [[0xB0, DATA_DECREMENT, 0]]
+        self.assertEqual([data for _, data in self.feed_all(decoder, messages)],
+                         [0x3FFE, 0x3FFF, 0x3FFF, 0x3FFE])
+
+    def test_rpn_invalidates_address(self):
+        decoder = NrpnDecoder()
+        frame = nrpn_frame(MIDI_LS9.FADER_CTLRS['CH02'], 0x100)
+        messages = frame + [[0xB0, RPN_BYTE_1, 0]] + frame[2:]
+        self.assertEqual(len(self.feed_all(decoder, messages)), 1)
+
+    def test_channels_are_independent(self):
+        decoder = NrpnDecoder()
+        first, second = nrpn_frame(0x100, 0x10, 0xB0), nrpn_frame(0x200, 0x20, 0xB1)
+        messages = [first[0], second[0], first[1], second[1], first[2], second[2], first[3], second[3]]
+        self.assertEqual(self.feed_all(decoder, messages), [(0x100, 0x10), (0x200, 0x20)])
+
+
+
+class TestFrameWatchdog(unittest.TestCase):
+    def test_fires_once_when_armed(self):
+        fired = threading.Event()
+        watchdog = FrameWatchdog(0.01, fired.set)
+        self.addCleanup(watchdog.stop)
+        watchdog.arm()
+        self.assertTrue(fired.wait(1.0))
+        self.assertEqual(watchdog.timeouts, 1)
+
+    def test_disarm_cancels_timeout(self):
+        fired = threading.Event()
+        watchdog = FrameWatchdog(0.05, fired.set)
+        self.addCleanup(watchdog.stop)
+        watchdog.arm()
+        watchdog.disarm()
+        self.assertFalse(fired.wait(0.15))
+        self.assertEqual(watchdog.timeouts, 0)
+
+    def test_rearm_extends_deadline(self):
+        fired = threading.Event()
+        watchdog = FrameWatchdog(0.1, fired.set)
+        self.addCleanup(watchdog.stop)
+        for _ in range(5):
+            watchdog.arm()
+            self.assertFalse(fired.wait(0.05))
+        self.assertTrue(fired.wait(1.0))
+
+
+
+class TestNrpnEncoder(unittest.TestCase):
+    def test_first_frame_sends_address(self):
+        midi_out = FakeMidiOut()
+        NrpnEncoder(midi_out).send_nrpn(0x1b0b, 0x3FFF)
+        self.assertEqual(midi_out.messages, nrpn_frame(0x1b0b, 0x3FFF))
+
+    def test_unchanged_address_is_skipped(self):
+        midi_out = FakeMidiOut()
+        encoder = NrpnEncoder(midi_out, resync_interval=60)
+        encoder.send_nrpn(0x829, 0x1000)
+        encoder.send_nrpn(0x829, 0x1001)
+        encoder.send_nrpn(0x8a9, 0x1002)
+        self.assertEqual(midi_out.messages, nrpn_frame(0x829, 0x1000) + nrpn_frame(0x829, 0x1001)[2:] +
+                                            nrpn_frame(0x8a9, 0x1002))
+        self.assertEqual(encoder.bytes_saved, 6)
+
+    def test_resync(self):
+        midi_out = FakeMidiOut()
+        encoder = NrpnEncoder(midi_out, resync_interval=0)
+        encoder.send_nrpn(0x829, 0x1000)
+        encoder.send_nrpn(0x829, 0x1001)
+        self.assertEqual(len(midi_out.messages), 8)
+        encoder.resync_interval = 60
+        encoder.resync()
+        encoder.send_nrpn(0x829, 0x1002)
+        self.assertEqual(len(midi_out.messages), 12)
+
+    def test_rawmidi_running_status(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'midi')
+            midi_out = RawMidiOut(path)
+            encoder = NrpnEncoder(midi_out, resync_interval=60)
+            encoder.send_nrpn(0x829, 0x1000)
+            encoder.send_nrpn(0x829, 0x1001)
+            midi_out.close_port()
+            with open(path, 'rb') as midi_file:
+                written = midi_file.read()
+        self.assertEqual(written, bytes([0xB0, 0x62, 0x10, 0x63, 0x29, 0x06, 0x20, 0x26, 0x00,
+                                         0xB0, 0x06, 0x20, 0x26, 0x01]))
+        self.assertEqual(encoder.writes, 2)
+
+    def test_macro(self):
+        outputs = ((0x829, 0x1000), (0x1b0b, MIDI_LS9.CH_ON_VALUE))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'midi')
+            midi_out = RawMidiOut(path)
+            encoder = NrpnEncoder(midi_out, resync_interval=60)
+            macro = encoder.compile_macro(outputs)
+            self.assertTrue(encoder.send_macro(macro))
+            # the next frame to the macro's last controller skips the address
+            encoder.send_nrpn(0x1b0b, MIDI_LS9.CH_OFF_VALUE)
+            midi_out.close_port()
+            with open(path, 'rb') as midi_file:
+                written = midi_file.read()
+        self.assertEqual(written, bytes([0xB0, 0x62, 0x10, 0x63, 0x29, 0x06, 0x20, 0x26, 0x00,
+                                               0x62, 0x36, 0x63, 0x0b, 0x06, 0x7F, 0x26, 0x7F,
+                                         0xB0, 0x06, 0x00, 0x26, 0x00]))
+        self.assertEqual((encoder.writes, encoder.frames), (2, 3))
+
+        midi_out = FakeMidiOut()
+        encoder = NrpnEncoder(midi_out, channel=2, cache=NrpnValueCache())
+        macro = encoder.compile_macro(outputs)
+        self.assertTrue(encoder.send_macro(macro))
+        self.assertEqual(midi_out.messages, [message for controller, data in outputs
+                                             for message in nrpn_frame(controller, data, 0xB2)])
+        # the console holds every value of the macro already
+        self.assertFalse(encoder.send_macro(macro))
+        with self.assertRaises(ValueError):
+            encoder.compile_macro([(0x829, 0x4000)])
+
+
+
+class TestNrpnValueCache(unittest.TestCase):
+    def test_redundant_send_is_dropped(self):
+        midi_out = FakeMidiOut()
+        encoder = NrpnEncoder(midi_out, cache=NrpnValueCache())
+        self.assertTrue(encoder.send_nrpn(0x1b0b, MIDI_LS9.CH_OFF_VALUE))
+        self.assertFalse(encoder.send_nrpn(0x1b0b, MIDI_LS9.CH_OFF_VALUE))
+        self.assertTrue(encoder.send_nrpn(0x1b0b, MIDI_LS9.CH_ON_VALUE))
+        self.assertEqual((encoder.cache.hits, encoder.cache.misses), (1, 2))
+        self.assertEqual(len(midi_out.messages), 6)
+
+    def test_received_value_counts_as_known(self):
+        encoder = NrpnEncoder(FakeMidiOut(), cache=NrpnValueCache())
+        encoder.note_received(0x2b0b, MIDI_LS9.CH_OFF_VALUE)
+        self.assertFalse(encoder.send_nrpn(0x2b0b, MIDI_LS9.CH_OFF_VALUE))
+
+    def test_force_and_expiry(self):
+        encoder = NrpnEncoder(FakeMidiOut(), cache=NrpnValueCache(max_age=0.02))
+        encoder.send_nrpn(0x1b0b, 0)
+        self.assertTrue(encoder.send_nrpn(0x1b0b, 0, force=True))
+        time.sleep(0.03)
+        self.assertIsNone(encoder.cache.get(0x1b0b))
+        self.assertTrue(encoder.send_nrpn(0x1b0b, 0))
+
+    def test_invalidate(self):
+        cache = NrpnValueCache()
+        cache.update(0x100, 5)
+        cache.update(0x200, 6)
+        cache.invalidate(0x100)
+        self.assertEqual((cache.get(0x100), cache.get(0x200)), (None, 6))
+        cache.invalidate()
+        self.assertIsNone(cache.get(0x200))
+        self.assertEqual((cache._times[0x100], cache._times[0x200]), (0.0, 0.0))
+
+    def test_failed_write_is_not_cached(self):
+        class FailingMidiOut(FakeMidiOut):
+            fail = True
+
+            def send_message(self, message):
+                if self.fail and message[1] == MIDI_LS9.NRPN_BYTE_4:
+                    raise OSError('MIDI device unplugged')
+                super().send_message(message)
+
+        midi_out = FailingMidiOut()
+        state = ConsoleState()
+        controller = MIDI_LS9.ON_OFF_CTLRS['CH01']
+        encoder = NrpnEncoder(midi_out, resync_interval=60, cache=NrpnValueCache(), state=state)
+        encoder.note_received(controller, MIDI_LS9.CH_OFF_VALUE)
+        with self.assertRaises(OSError):
+            encoder.send_nrpn(controller, MIDI_LS9.CH_ON_VALUE)
+        self.assertIsNone(encoder.cache.get(controller))
+        self.assertEqual(state.get(controller), MIDI_LS9.CH_OFF_VALUE)
+        macro = encoder.compile_macro([(controller, MIDI_LS9.CH_ON_VALUE)])
+        with self.assertRaises(OSError):
+            encoder.send_macro(macro)
+        self.assertEqual(state.get(controller), MIDI_LS9.CH_OFF_VALUE)
+        # the retry is not dropped as redundant, and goes out with its address
+        midi_out.fail = False
+        midi_out.messages.clear()
+        self.assertTrue(encoder.send_nrpn(controller, MIDI_LS9.CH_ON_VALUE))
+        self.assertEqual(midi_out.messages, nrpn_frame(controller, MIDI_LS9.CH_ON_VALUE))
+        self.assertEqual(state.get(controller), MIDI_LS9.CH_ON_VALUE)
+
+
+
+class TestConsoleState(unittest.TestCase):
+    def test_unknown_until_updated(self):
+        state = ConsoleState()
+        self.assertIsNone(state.fader('CH01'))
+        self.assertIsNone(state.is_on('CH01'))
+
+    def test_queries_by_name(self):
+        state = ConsoleState()
+        state.update(MIDI_LS9.FADER_CTLRS['CH64'], MIDI_LS9.FADE_0DB_VALUE)
+        state.update(MIDI_LS9.ON_OFF_CTLRS['ST LR'], MIDI_LS9.CH_ON_VALUE)
+        state.update(MIDI_LS9.MIX1_SOF_CTLRS['CH02'], MIDI_LS9.FADE_NEGINF_VALUE)
+        state.update(MIDI_LS9.MT6_SOF_CTRLS['MIX1'], 0x100)
+        self.assertEqual(state.fader('CH64'), MIDI_LS9.FADE_0DB_VALUE)
+        self.assertIs(state.is_on('ST LR'), True)
+        self.assertEqual(state.mix1_send('CH02'), MIDI_LS9.FADE_NEGINF_VALUE)
+        self.assertEqual(state.mt6_send('MIX1'), 0x100)
+        self.assertEqual(state.updates, 4)
+        state.clear()
+        self.assertIsNone(state.fader('CH64'))
+
+    def test_unmirrored_controller_is_ignored(self):
+        state = ConsoleState()
+        state.update(MIDI_LS9.TABLA1_PEQ1, 0x1000)
+        self.assertIsNone(state.get(MIDI_LS9.TABLA1_PEQ1))
+        self.assertEqual(state.updates, 0)
+
+    def test_encoder_keeps_state(self):
+        state = ConsoleState()
+        encoder = NrpnEncoder(FakeMidiOut(), state=state)
+        encoder.send_nrpn(MIDI_LS9.ON_OFF_CTLRS['CH33'], MIDI_LS9.CH_OFF_VALUE)
+        encoder.note_received(MIDI_LS9.FADER_CTLRS['CH01'], 0x200)
+        self.assertIs(state.is_on('CH33'), False)
+        self.assertEqual(state.fader('CH01'), 0x200)
+
+
+
+class TestNrpnCoalescer(unittest.TestCase):
+    def test_keeps_latest_value_per_controller(self):
+        midi_out = FakeMidiOut()
+        coalescer = NrpnCoalescer(NrpnEncoder(midi_out, resync_interval=0), max_rate=10)
+        # the first value is flushed straight away, the next ones wait for the following flush
+        for data in range(100):
+            coalescer.send_nrpn(MIDI_LS9.TABLA1_PEQ1, data)
+            coalescer.send_nrpn(MIDI_LS9.TABLA2_PEQ1, data)
+        coalescer.stop()
+        sent = [message[2] for message in midi_out.messages if message[1] == MIDI_LS9.NRPN_BYTE_4]
+        self.assertLess(len(sent), 10)
+        self.assertEqual(sent[-2:], [99, 99])
+        self.assertEqual(coalescer.submitted, 200)
+        self.assertEqual(coalescer.dropped + len(sent), 200)
+
+    def test_rate_limit(self):
+        midi_out = FakeMidiOut()
+        coalescer = NrpnCoalescer(NrpnEncoder(midi_out), max_rate=20)
+        start = time.monotonic()
+        while time.monotonic() - start < 0.2:
+            coalescer.send_nrpn(MIDI_LS9.TABLA1_PEQ1, 1)
+            time.sleep(0.001)
+        coalescer.stop()
+        self.assertLessEqual(coalescer.flushes, 6)
+
+
+# records the (controller, data) pairs sent by the automations
+class FakeNrpnOut:
+    def __init__(self):
+        self.sent = []
+
+    def send_nrpn(self, controller, data, force=False):
+        self.sent.append((controller, data))
+        return True
+
+
+class TestAutomationEngine(unittest.TestCase):
+    def setUp(self):
+        self.midi_out = FakeNrpnOut()
+        self.continuous_out = FakeNrpnOut()
+        self.engine = AutomationEngine(load_automations(), self.midi_out, self.continuous_out)
+
+    def test_mute_interlock(self):
+        self.engine.process(MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE)
+        self.engine.process(MIDI_LS9.ON_OFF_CTLRS['CH33'], MIDI_LS9.CH_OFF_VALUE)
+        self.assertEqual(self.midi_out.sent, [(MIDI_LS9.ON_OFF_CTLRS['CH33'], MIDI_LS9.CH_OFF_VALUE),
+                                              (MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE)])
+
+    def test_send_mute_hysteresis(self):
+        fader = MIDI_LS9.FADER_CTLRS['CH02']
+        sends = (MIDI_LS9.MIX1_SOF_CTLRS['CH02'], MIDI_LS9.MIX1_SOF_CTLRS['CH34'])
+        # between the two thresholds nothing happens, whichever way the fader moves
+        for data in (MIDI_LS9.FADE_60DB_VALUE + 1, MIDI_LS9.FADE_50DB_VALUE):
+            self.engine.process(fader, data)
+        self.assertEqual(self.midi_out.sent, [])
+        self.engine.process(fader, MIDI_LS9.FADE_50DB_VALUE + 1)
+        self.engine.process(fader, MIDI_LS9.FADE_0DB_VALUE)
+        self.engine.process(fader, MIDI_LS9.FADE_60DB_VALUE)
+        self.engine.process(fader, MIDI_LS9.FADE_60DB_VALUE - 1)
+        self.assertEqual(self.midi_out.sent, [(sends[0], MIDI_LS9.FADE_0DB_VALUE), (sends[1], MIDI_LS9.FADE_0DB_VALUE),
+                                              (sends[0], MIDI_LS9.FADE_NEGINF_VALUE), (sends[1], MIDI_LS9.FADE_NEGINF_VALUE)])
+
+    def test_on_off(self):
+        self.engine.process(MIDI_LS9.ON_OFF_CTLRS['ST-IN3'], MIDI_LS9.CH_ON_VALUE)
+        self.engine.process(MIDI_LS9.ON_OFF_CTLRS['MIX1'], MIDI_LS9.CH_OFF_VALUE)
+        self.engine.process(MIDI_LS9.ON_OFF_CTLRS['MIX2'], MIDI_LS9.CH_ON_VALUE)
+        self.assertEqual(self.midi_out.sent, [(MIDI_LS9.MIX16_SEND_TO_MT2, MIDI_LS9.FADE_0DB_VALUE),
+                                              (MIDI_LS9.STLR_SEND_TO_MT2, MIDI_LS9.FADE_NEGINF_VALUE),
+                                              (MIDI_LS9.ON_OFF_CTLRS['ST LR'], MIDI_LS9.CH_ON_VALUE)])
+
+    def test_outputs_per_rule(self):
+        self.assertTrue(self.engine.process(MIDI_LS9.ON_OFF_CTLRS['ST-IN3'], MIDI_LS9.CH_ON_VALUE))
+        self.assertFalse(self.engine.process(0x3FFF, 0))
+        outputs = {rule.name: count for rule, count in zip(self.engine.rules, self.engine.outputs) if count}
+        self.assertEqual(sum(outputs.values()), len(self.midi_out.sent))
+        self.assertEqual(len(outputs), 1)
+
+    def test_macros_on_the_wire(self):
+        # with an NrpnEncoder, the outputs go out as pre-encoded macros. decoded, they are the same
+        midi_out = FakeMidiOut()
+        engine = AutomationEngine(load_automations(), NrpnEncoder(midi_out))
+        engine.process(MIDI_LS9.ON_OFF_CTLRS['ST-IN3'], MIDI_LS9.CH_ON_VALUE)
+        engine.process(MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE)
+        decoder = NrpnDecoder()
+        decoded = [(decoder.controller, decoder.data) for message in midi_out.messages if decoder.feed(message)]
+        self.assertEqual(decoded, [(MIDI_LS9.MIX16_SEND_TO_MT2, MIDI_LS9.FADE_0DB_VALUE),
+                                   (MIDI_LS9.STLR_SEND_TO_MT2, MIDI_LS9.FADE_NEGINF_VALUE),
+                                   (MIDI_LS9.ON_OFF_CTLRS['CH33'], MIDI_LS9.CH_OFF_VALUE)])
+
+    def test_linear_link(self):
+        self.engine.process(MIDI_LS9.FADER_CTLRS['CH18'], 0)
+        self.engine.process(MIDI_LS9.FADER_CTLRS['CH18'], MIDI_LS9.CH_ON_VALUE)
+        self.assertEqual(self.midi_out.sent, [])
+        self.assertEqual(self.continuous_out.sent, [(MIDI_LS9.TABLA1_PEQ1, 4096), (MIDI_LS9.TABLA2_PEQ1, 4096),
+                                                    (MIDI_LS9.TABLA1_PEQ1, 12288), (MIDI_LS9.TABLA2_PEQ1, 12288)])
+
+    def test_unbound_controller(self):
+        self.engine.process(MIDI_LS9.FADER_CTLRS['CH40'], MIDI_LS9.FADE_0DB_VALUE)
+        self.assertEqual(self.midi_out.sent + self.continuous_out.sent, [])
+
+    def test_invalid_rules(self):
+        invalid = [{'type': 'no_such_rule'},
+                   {'type': 'on_off', 'channels': ['CH01'], 'onn': []},
+                   {'type': 'on_off', 'channels': ['CH01'], 'on': [['NO_SUCH_CONSTANT', 0]]},
+                   {'type': 'on_off', 'channels': ['CH99'], 'on': []},
+                   {'type': 'linear_link', 'source': 'FADER_CTLRS[CH18]', 'targets': [], 'out_min': 0, 'out_max': 1},
+                   {'type': 'on_off', 'channels': ['CH13'], 'on': [['ON_OFF_CTLRS[CH49]', 0]], 'inhibited_on': []},
+                   {'type': 'on_off', 'channels': ['CH13'], 'on': [['ON_OFF_CTLRS[CH49]', 0]], 'inhibited_by': 'ST-IN9'}]
+        for rule in invalid:
+            with self.subTest(rule=rule), self.assertRaises(ValueError):
+                parse_automations({'rules': [rule]})
+
+    def test_trigger_kind(self):
+        # the controllers of the rules are classified through CTLR_DISPATCH
+        for rule in ({'type': 'linear_link', 'source': 'ON_OFF_CTLRS[CH18]', 'targets': ['TABLA1_PEQ1'],
+                      'out_min': 0, 'out_max': 1},
+                     {'type': 'linear_link', 'source': 'TABLA2_PEQ1', 'targets': ['TABLA1_PEQ1'],
+                      'out_min': 0, 'out_max': 1}):
+            with self.subTest(rule=rule), self.assertRaisesRegex(ValueError, 'not a fader controller'):
+                AutomationEngine(parse_automations({'rules': [rule]}), FakeNrpnOut())
+
+    def test_invalid_json(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'automations.json')
+            with open(path, 'w') as rules_file:
+                rules_file.write('{"rules": [')
+            with self.assertRaises(ValueError):
+                load_automations(path)
+
+
+# the rules of midi_server_websockets.py, as its process_midi_messages() ran them
+class TestServerAutomations(unittest.TestCase):
+    def setUp(self):
+        self.midi_out = FakeNrpnOut()
+        self.engine = AutomationEngine(load_automations(SERVER_AUTOMATIONS_FILE), self.midi_out)
+
+    def switch(self, channel, on):
+        del self.midi_out.sent[:]
+        self.engine.process(MIDI_LS9.ON_OFF_CTLRS[channel], MIDI_LS9.CH_ON_VALUE if on else MIDI_LS9.CH_OFF_VALUE)
+        return [(MIDI_LS9.ON_OFF_CTLRS.inv.get(controller, controller), data) for controller, data in self.midi_out.sent]
+
+    def test_rule_set(self):
+        self.assertEqual([rule.name for rule in self.engine.rules],
+                         ['CHR <-> LEAD ON/OFF toggling', 'Monitor mute vocal mic on fader drop'] +
+                         [f'Wireless {n} {role} ON/OFF' for role in ('MC', 'LEAD', 'CHR') for n in range(1, 5)] +
+                         ['MIX1 or MIX2 switched ON switches ON ST LR', 'ST LR switched OFF switches OFF MIX1',
+                          'PC IN2 routing to BASMNT', 'PC IN2 routing to LOBBY', 'LOUNGE toggle between MONO and ST LR',
+                          'WLTBK3 & WLTBK4 toggle'])
+        # the channel of the tabla PEQ link is not used that way on this console
+        self.assertNotIn(MIDI_LS9.FADER_CTLRS['CH18'], self.engine.bound_controllers())
+
+    def test_st_in_routing(self):
+        self.assertEqual(self.switch('ST-IN1', True), [(MIDI_LS9.MIX16_SEND_TO_MT1, MIDI_LS9.FADE_0DB_VALUE),
+                                                      (MIDI_LS9.MONO_SEND_TO_MT1, MIDI_LS9.FADE_NEGINF_VALUE)])
+        self.assertEqual(self.switch('ST-IN2', False), [(MIDI_LS9.MIX16_SEND_TO_MT2, MIDI_LS9.FADE_NEGINF_VALUE),
+                                                       (MIDI_LS9.STLR_SEND_TO_MT2, MIDI_LS9.FADE_0DB_VALUE)])
+        self.assertEqual(self.switch('ST-IN3', True), [(MIDI_LS9.MONO_SEND_TO_MT3, MIDI_LS9.FADE_0DB_VALUE),
+                                                      (MIDI_LS9.ST_LR_SEND_TO_MT3, MIDI_LS9.FADE_NEGINF_VALUE)])
+
+    def test_wireless_interlocks(self):
+        off, on = MIDI_LS9.CH_OFF_VALUE, MIDI_LS9.CH_ON_VALUE
+        for n, (mc, chorus, lead) in enumerate(zip(MIDI_LS9.WIRELESS_MC_TO_CHR_MAPPING, MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING,
+                                                   MIDI_LS9.WIRELESS_CHR_TO_LEAD_MAPPING.values()), 1):
+            with self.subTest(wireless=n):
+                self.assertEqual(self.switch(mc, True), [(chorus, off), (lead, off)])
+                self.assertEqual(self.switch(mc, False), [(chorus, on), (lead, off)])
+                self.assertEqual(self.switch(lead, True), [(chorus, off), (mc, off)])
+                self.assertEqual(self.switch(lead, False), [(chorus, on), (mc, off)])
+                self.assertEqual(self.switch(chorus, True), [(mc, off), (lead, off)])
+                self.assertEqual(self.switch(chorus, False), [(lead, on), (mc, off)])
+
+    def test_wltbk(self):
+        off, on = MIDI_LS9.CH_OFF_VALUE, MIDI_LS9.CH_ON_VALUE
+        self.assertEqual(self.switch('ST-IN4', True), [('CH13', off), ('CH14', off), ('CH46', off), ('CH47', off),
+                                                      ('CH49', off), ('CH50', off)])
+        # in WLTBK mode wireless mics 3 & 4 are held OFF, whichever of their channels is switched ON
+        for channel in ('CH13', 'CH14', 'CH45', 'CH46', 'CH49', 'CH50'):
+            self.assertEqual(self.switch(channel, True), [(channel, off)])
+        self.assertEqual(self.switch('CH11', True), [('CH47', off), ('CH43', off)])
+        self.assertEqual(self.switch('ST-IN4', False), [('CH13', on), ('CH14', on), ('CH46', off), ('CH47', off),
+                                                       ('CH49', off), ('CH50', off)])
+        self.assertEqual(self.switch('CH13', True), [('CH49', off), ('CH45', off)])
+
+
+class TestMidiEventRing(unittest.TestCase):
+    def fill(self, ring, count):
+        for i in range(count):
+            ring.put([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_4, i], i / 1000)
+
+    def drain(self, ring):
+        values = []
+        while len(ring):
+            values.append(ring.get()[0][2])
+        return values
+
+    def test_fifo(self):
+        ring = MidiEventRing(8)
+        self.fill(ring, 5)
+        self.assertEqual(ring.get(), ([MIDI_LS9.CC_CMD_BYTE, MIDI_LS9.NRPN_BYTE_4, 0], 0.0, None))
+        self.assertEqual(self.drain(ring), [1, 2, 3, 4])
+        self.assertEqual(ring.high_water, 5)
+        self.assertIsNone(ring.get(timeout=0.01))
+
+    def test_drop_oldest(self):
+        ring = MidiEventRing(4, 'drop-oldest')
+        self.fill(ring, 6)
+        self.assertEqual(self.drain(ring), [2, 3, 4, 5])
+        self.assertEqual((ring.overflows, ring.high_water), (2, 4))
+
+    def test_drop_newest(self):
+        ring = MidiEventRing(4, 'drop-newest')
+        self.fill(ring, 6)
+        self.assertEqual(self.drain(ring), [0, 1, 2, 3])
+        self.assertEqual(ring.overflows, 2)
+
+    def test_block(self):
+        ring = MidiEventRing(2, 'block')
+        producer = threading.Thread(target=self.fill, args=(ring, 4))
+        producer.start()
+        values = [ring.get(timeout=1)[0][2] for _ in range(4)]
+        producer.join()
+        self.assertEqual(values, [0, 1, 2, 3])
+        self.assertGreaterEqual(ring.overflows, 1)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            MidiEventRing(4, 'drop-all')
+
+    def test_worker(self):
+        received = []
+        def process(message, timestamp, arrival):
+            if message[2] == 1:
+                raise RuntimeError('automation failed')
+            received.append(message[2])
+        ring = MidiEventRing(16)
+        worker = MidiInputWorker(ring, process)
+        self.fill(ring, 4)
+        # stop() processes every queued message before returning
+        worker.stop()
+        self.assertEqual(received, [0, 2, 3])
+        self.assertEqual((worker.processed, worker.errors), (4, 1))
+        self.assertFalse(ring.put([MIDI_LS9.CC_CMD_BYTE, 0, 0], 0))
+
+
+class TestMidiLoopInput(unittest.IsolatedAsyncioTestCase):
+    async def test_put_from_thread(self):
+        received = []
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        def process(message, timestamp, arrival):
+            received.append(message[2])
+            if len(received) == 100:
+                done.set_result(None)
+        # a batch smaller than the burst, the rest is processed by the next wakeups
+        midi_input = MidiLoopInput(MidiEventRing(256), loop, process, batch=16)
+        producer = threading.Thread(target=lambda: [midi_input.put([MIDI_LS9.CC_CMD_BYTE, 0, i], 0.0) for i in range(100)])
+        producer.start()
+        await asyncio.wait_for(done, 1.0)
+        producer.join()
+        self.assertEqual(received, list(range(100)))
+        self.assertLess(midi_input.wakeups, 100)
+        self.assertEqual(len(midi_input.latencies), midi_input.wakeups)
+        midi_input.stop()
+        self.assertFalse(midi_input.put([MIDI_LS9.CC_CMD_BYTE, 0, 0], 0.0))
+
+    async def test_frame_watchdog(self):
+        timeouts = []
+        watchdog = LoopFrameWatchdog(asyncio.get_running_loop(), 0.03, lambda: timeouts.append(time.monotonic()))
+        start = time.monotonic()
+        watchdog.arm()
+        await asyncio.sleep(0.02)
+        # re-arming moves the deadline
+        watchdog.arm()
+        await asyncio.sleep(0.02)
+        self.assertEqual(timeouts, [])
+        await asyncio.sleep(0.03)
+        self.assertEqual(len(timeouts), 1)
+        self.assertGreaterEqual(timeouts[0] - start, 0.05)
+        watchdog.arm()
+        watchdog.disarm()
+        await asyncio.sleep(0.05)
+        self.assertEqual(watchdog.timeouts, 1)
+        watchdog.stop()
+
+
+class TestMidiLogging(unittest.TestCase):
+    def record(self, msg, *args, level=logging.WARNING):
+        return logging.LogRecord('test', level, __file__, 0, msg, args, None)
+
+    def test_rate_limit(self):
+        rate_limit = RateLimitFilter(interval=0.05)
+        self.assertTrue(rate_limit.filter(self.record('Timeout! %s', 1)))
+        self.assertFalse(rate_limit.filter(self.record('Timeout! %s', 2)))
+        self.assertFalse(rate_limit.filter(self.record('Timeout! %s', 3)))
+        # other messages & lower levels are not limited
+        self.assertTrue(rate_limit.filter(self.record('Other warning')))
+        self.assertTrue(rate_limit.filter(self.record('Timeout! %s', 4, level=logging.INFO)))
+        time.sleep(0.06)
+        record = self.record('Timeout! %s', 5)
+        self.assertTrue(rate_limit.filter(record))
+        self.assertEqual(record.getMessage(), 'Timeout! 5 (2 similar messages suppressed)')
+        self.assertEqual(rate_limit.suppressed, 2)
+
+    def test_queued_output(self):
+        root = logging.getLogger()
+        saved = root.handlers[:], root.level
+        stream = io.StringIO()
+        try:
+            listener = setup_logging(logging.INFO, '%(levelname)s %(message)s', stream=stream)
+            logging.debug('hidden %s', 1)
+            logging.info('shown %#x', 255)
+            logging.warning('repeated')
+            logging.warning('repeated')
+            listener.stop()
+        finally:
+            root.handlers[:], level = saved
+            root.setLevel(level)
+        self.assertEqual(stream.getvalue(), 'INFO shown 0xff\nWARNING repeated\n')
+
+
+class TestMidiCapture(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'service.ls9cap')
+        self.messages = nrpn_frame(MIDI_LS9.FADER_CTLRS['CH01'], 0x1234) + nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['CH33'], 0)
+        writer = CaptureWriter(self.path)
+        for i, message in enumerate(self.messages):
+            writer.write(message, i * 0.25)
+        writer.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        reader = CaptureReader(self.path)
+        self.assertEqual(len(reader), 8)
+        self.assertEqual(list(reader), [(message, i * 0.25) for i, message in enumerate(self.messages)])
+        self.assertEqual(reader.duration(), sum(i * 0.25 for i in range(1, 8)))
+        reader.close()
+
+    def test_partial_record_is_ignored(self):
+        with open(self.path, 'ab') as capture_file:
+            capture_file.write(b'\x00' * 5)
+        reader = CaptureReader(self.path)
+        self.assertEqual(len(reader), 8)
+        reader.close()
+
+    def test_not_a_capture(self):
+        for content in (b'', b'MThd\x00\x00\x00\x06'):
+            with open(self.path, 'wb') as capture_file:
+                capture_file.write(content)
+            with self.assertRaises(ValueError):
+                CaptureReader(self.path)
+
+    def test_replay_speed(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        sent = []
+        reader = CaptureReader(self.path)
+        replay(reader, lambda message, delta_time: sent.append(now[0]), speed=4, clock=lambda: now[0], sleep=sleep)
+        reader.close()
+        # at 4x, the 0.25s, 0.5s, ... gaps become 0.0625s, 0.125s, ...
+        self.assertEqual(sent, [sum(i * 0.0625 for i in range(1, n + 1)) for n in range(8)])
+
+    def test_replay_into_the_automations(self):
+        writer = CaptureWriter(self.path)
+        for message in nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE):
+            writer.write(message, 0.001)
+        # the last CC of the second frame comes after the frame timeout: it is dropped at any speed
+        for i, message in enumerate(nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['CH02'], MIDI_LS9.CH_ON_VALUE)):
+            writer.write(message, NRPN_FRAME_TIMEOUT + 0.1 if i == 3 else 0.001)
+        writer.close()
+        root = logging.getLogger()
+        saved = root.handlers[:], root.level
+        try:
+            result = CliRunner().invoke(capture_cli, ['replay', self.path, '--speed', '0', '--quiet', '--output-rate', '0'])
+        finally:
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            root.handlers[:], level = saved
+            root.setLevel(level)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('1 NRPN frames processed', result.output)
+        self.assertIn('1 incomplete frames timed out', result.output)
+        # the automation of the first frame went out through the output scheduler
+        self.assertIn('control lane: 1 values submitted, 1 sent', result.output)
+
+
+class TestWebsocketSender(unittest.IsolatedAsyncioTestCase):
+    # the server of the tests only knows the CSV format, like the ones older than the binary protocol
+    async def asyncSetUp(self):
+        self.received = []
+        async def listener(connection):
+            try:
+                async for message in connection:
+                    self.received.append(message)
+            # the senders are cancelled at the end of the tests, without a clean close
+            except ConnectionClosed:
+                pass
+        self.server = await serve(listener, 'localhost', 0)
+        self.uri = f'ws://localhost:{self.server.sockets[0].getsockname()[1]}'
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def run_sender(self, sender, until):
+        task = asyncio.create_task(sender.run())
+        try:
+            for _ in range(200):
+                if until():
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def test_one_connection_for_all_ccs(self):
+        sender = WebsocketSender(self.uri, asyncio.get_running_loop())
+        # submit() is called from the rtmidi thread
+        await asyncio.to_thread(lambda: [sender.submit(cc, cc * 2) for cc in range(10)])
+        await self.run_sender(sender, lambda: len(self.received) == 10)
+        self.assertEqual(self.received, [f'{cc},{cc * 2}' for cc in range(10)])
+        self.assertEqual((sender.sent, sender.connects), (10, 1))
+
+    async def test_reconnect(self):
+        sender = WebsocketSender(self.uri, asyncio.get_running_loop(), min_delay=0.01)
+        async def drop_connection_then_submit():
+            sender.submit(1, 1)
+            while len(self.received) < 1:
+                await asyncio.sleep(0.01)
+            # the server drops the connection, the same run() reconnects & carries on
+            for connection in self.server.connections:
+                await connection.close()
+            sender.submit(2, 2)
+        asyncio.create_task(drop_connection_then_submit())
+        await self.run_sender(sender, lambda: len(self.received) == 2)
+        self.assertEqual(self.received, ['1,1', '2,2'])
+        self.assertEqual(sender.connects, 2)
+
+    async def test_coalescing(self):
+        sender = WebsocketSender(self.uri, asyncio.get_running_loop(), flush_interval=0.05)
+        task = asyncio.create_task(sender.run())
+        await sender.connected.wait()
+        # a knob sweep on CC 1, with a few CC 2 in between
+        for data in range(100):
+            sender.submit(1, data)
+            if data % 25 == 0:
+                sender.submit(2, data)
+            await asyncio.sleep(0.001)
+        while sender.submitted > sender.sent + sender.coalesced:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        # the first CC goes out at once, the final positions are exact
+        self.assertEqual(self.received[0], '1,0')
+        last = dict(message.split(',') for message in self.received)
+        self.assertEqual(last, {'1': '99', '2': '75'})
+        self.assertLess(sender.sent, 20)
+        self.assertEqual(sender.sent + sender.coalesced, 104)
+
+    async def test_flush_once_the_knob_stops(self):
+        sender = WebsocketSender(self.uri, asyncio.get_running_loop(), flush_interval=5.0, quiet_gap=0.01)
+        task = asyncio.create_task(sender.run())
+        try:
+            await sender.connected.wait()
+            sender.submit(1, 0)
+            while len(self.received) < 1:
+                await asyncio.sleep(0.001)
+            # within the flush interval of the first CC, a short turn of the knob then nothing
+            for data in range(1, 4):
+                sender.submit(1, data)
+                await asyncio.sleep(0.001)
+            start = time.perf_counter()
+            while self.received[-1] != '1,3':
+                self.assertLess(time.perf_counter() - start, 1.0)
+                await asyncio.sleep(0.001)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self.assertEqual(self.received[0], '1,0')
+
+    async def test_oldest_dropped_while_disconnected(self):
+        sender = WebsocketSender(self.uri, asyncio.get_running_loop(), queue_size=3)
+        for data in range(5):
+            sender.submit(7, data)
+        await self.run_sender(sender, lambda: len(self.received) == 3)
+        self.assertEqual(self.received, ['7,2', '7,3', '7,4'])
+        self.assertEqual(sender.dropped, 2)
+
+
+class TestWebsocketProtocol(unittest.IsolatedAsyncioTestCase):
+    def test_batch_round_trip(self):
+        frame = encode_cc_batch([(1, 127, 0.0), (2, 0, 0.0015), (3, 64, 60.0)])
+        self.assertEqual(len(frame), 1 + 3 * 4)
+        self.assertEqual(list(decode_cc_batch(frame)), [(1, 127, 0), (2, 0, 15), (3, 64, 0xFFFF)])
+
+    def test_invalid_frames(self):
+        for frame in (b'', b'\x02\x01\x01\x00\x00', b'\x01\x01\x01\x00', '1,2'):
+            with self.subTest(frame=frame), self.assertRaises(ValueError):
+                decode_cc_batch(frame)
+        for message in ('1', '1,2,3', 'a,b', b'1,2'):
+            with self.subTest(message=message), self.assertRaises(ValueError):
+                decode_cc_csv(message)
+        for message in ('128,0', '1,-1', '1,300'):
+            with self.subTest(message=message), self.assertRaises(ValueError):
+                decode_cc_csv(message)
+        self.assertEqual(decode_cc_csv(encode_cc_csv(12, 100)), (12, 100))
+        for frame in (b'', b'\x03', b'\x02\x01\x00\x00', '1,2'):
+            with self.subTest(frame=frame), self.assertRaises(ValueError):
+                decode_state_frame(frame)
+
+    def test_state_round_trip(self):
+        kind, items = decode_state_frame(encode_state_frame(WS_STATE_DELTA, [(0x3c00, 0x3FFF), (1, 0)]))
+        self.assertEqual((kind, list(items)), (WS_STATE_DELTA, [(0x3c00, 0x3FFF), (1, 0)]))
+
+    async def test_negotiation(self):
+        received = []
+        async def listener(connection):
+            async for message in connection:
+                if connection.subprotocol in WS_BINARY_SUBPROTOCOLS:
+                    received.append([cc[:2] for cc in decode_cc_batch(message)])
+                else:
+                    received.append(decode_cc_csv(message))
+        async with serve(listener, 'localhost', 0, select_subprotocol=select_ws_subprotocol) as server:
+            uri = f'ws://localhost:{server.sockets[0].getsockname()[1]}'
+            for subprotocols in ([], WS_SUBPROTOCOLS):
+                sender = WebsocketSender(uri, asyncio.get_running_loop(), subprotocols=subprotocols)
+                for cc in range(3):
+                    sender.submit(cc, cc)
+                task = asyncio.create_task(sender.run())
+                while sender.sent < 3:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        # the CSV client sends one frame per CC, the binary one sends the 3 CCs in one frame
+        self.assertEqual(received, [(0, 0), (1, 1), (2, 2), [(0, 0), (1, 1), (2, 2)]])
+
+
+# time only moves forward when the code under test sleeps
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TestScenes(unittest.TestCase):
+    SCENE = {'scenes': [{'name': 'test',
+                         'on': {'CH01': True, 'CH02': False},
+                         'faders': {'CH01': 'FADE_0DB_VALUE', 'MT5': 0x1000},
+                         'mt5_sends': {'MIX1': 'FADE_NEGINF_VALUE'},
+                         'routing_sends': {'MONO to MT1': 'FADE_0DB_VALUE'},
+                         'outputs': [['TABLA1_PEQ1', 4096]]}]}
+
+    def decode(self, midi_out):
+        decoder = NrpnDecoder()
+        return [(decoder.controller, decoder.data) for message in midi_out.messages if decoder.feed(message)]
+
+    def test_default_scenes(self):
+        with open(DEFAULT_SCENES_FILE) as f:
+            specs = json.load(f)['scenes']
+        for spec, scene in zip(specs, load_scenes()):
+            switched_on =  [MIDI_LS9.ON_OFF_CTLRS[channel] for channel, on in spec['on'].items() if on]
+            switched_off = [MIDI_LS9.ON_OFF_CTLRS[channel] for channel, on in spec['on'].items() if not on]
+            # channels are switched OFF first & ON last, around the levels
+            self.assertEqual(scene.outputs[:len(switched_off)], tuple((c, MIDI_LS9.CH_OFF_VALUE) for c in switched_off))
+            self.assertEqual(scene.outputs[-len(switched_on):], tuple((c, MIDI_LS9.CH_ON_VALUE) for c in switched_on))
+
+    def test_default_scenes_only_switch_their_on_channels(self):
+        with open(DEFAULT_SCENES_FILE) as f:
+            specs = json.load(f)['scenes']
+        scenes = load_scenes()
+        for spec, scene in zip(specs, scenes):
+            with self.subTest(scene=scene.name):
+                midi_out = FakeMidiOut()
+                state = ConsoleState()
+                recaller = SceneRecaller(scenes, NrpnEncoder(midi_out, state=state), state, rate=0)
+                recaller.transfer(scene.name)
+                switched = {MIDI_LS9.ON_OFF_CTLRS.inv[controller] for controller, _ in self.decode(midi_out)
+                            if controller in MIDI_LS9.ON_OFF_CTLRS.inv}
+                self.assertEqual(switched, set(spec['on']))
+
+    def test_send_aliasing_a_switch_is_rejected(self):
+        # MT5_SOF_CTRLS['MIX8'] is the controller of ON_OFF_CTLRS['MIX8']
+        for section, key in (('mt5_sends', 'MIX8'), ('mt6_sends', 'MIX11')):
+            with self.subTest(section=section), self.assertRaisesRegex(ValueError, 'ON_OFF_CTLRS'):
+                parse_scenes({'scenes': [{'name': 'bad', section: {key: 'FADE_NEGINF_VALUE'}}]})
+
+    def test_minimal_diff(self):
+        scene, = parse_scenes(self.SCENE)
+        self.assertEqual(scene.outputs[0], (MIDI_LS9.ON_OFF_CTLRS['CH02'], MIDI_LS9.CH_OFF_VALUE))
+        self.assertEqual(scene.outputs[-1], (MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE))
+        state = ConsoleState()
+        state.update(MIDI_LS9.FADER_CTLRS['CH01'], MIDI_LS9.FADE_0DB_VALUE)
+        state.update(MIDI_LS9.ON_OFF_CTLRS['CH02'], MIDI_LS9.CH_ON_VALUE)
+        midi_out = FakeMidiOut()
+        clock = FakeClock()
+        recaller = SceneRecaller([scene], NrpnEncoder(midi_out, state=state), state, rate=0, clock=clock, sleep=clock.sleep)
+        transfer = recaller.transfer('test')
+        self.assertEqual((transfer.sent, transfer.skipped), (len(scene.outputs) - 1, 1))
+        self.assertEqual(self.decode(midi_out), [output for output in scene.outputs
+                                                 if output[0] != MIDI_LS9.FADER_CTLRS['CH01']])
+        self.assertEqual(clock.sleeps, [])
+        # the state follows what was sent. the unmirrored output (TABLA1_PEQ1) is always sent
+        transfer = recaller.transfer('test')
+        self.assertEqual((transfer.sent, transfer.skipped), (1, len(scene.outputs) - 1))
+
+    def test_pacing(self):
+        scene, = load_scenes()[:1]
+        state = ConsoleState()
+        clock = FakeClock()
+        encoder = NrpnEncoder(FakeMidiOut(), state=state)
+        recaller = SceneRecaller([scene], encoder, state, rate=1000, chunk=4, clock=clock, sleep=clock.sleep)
+        transfer = recaller.transfer(scene.name)
+        self.assertEqual(transfer.sent, len(scene.outputs))
+        self.assertEqual(transfer.bytes_sent, encoder.bytes_sent)
+        # one sleep between two chunks, none after the last one
+        self.assertEqual(len(clock.sleeps), (len(scene.outputs) - 1) // 4)
+        last_chunk = (len(scene.outputs) - 1) % 4 + 1
+        self.assertAlmostEqual(transfer.seconds, (encoder.bytes_sent - 12 * last_chunk) / 1000)
+
+    def test_invalid_scenes(self):
+        for scenes in ({'scenes': [{'name': 'a', 'on': {'CH01': 1}}]},
+                       {'scenes': [{'name': 'a', 'faders': {'CH99': 0}}]},
+                       {'scenes': [{'name': 'a', 'faders': {'CH01': 0x4000}}]},
+                       {'scenes': [{'name': 'a', 'mix1_sends': {'CH01': 0}, 'outputs': [['MIX1_SOF_CTLRS[CH01]', 0]]}]},
+                       {'scenes': [{'name': 'a', 'colour': 'red'}]},
+                       {'scenes': [{'name': 'a'}]},
+                       {'scenes': [{'name': 'a', 'on': {'CH01': True}}, {'name': 'a', 'on': {'CH01': True}}]}):
+            with self.subTest(scenes=scenes), self.assertRaises(ValueError):
+                parse_scenes(scenes)
+
+    def test_scene_recall_rule(self):
+        state = ConsoleState()
+        midi_out = FakeMidiOut()
+        encoder = NrpnEncoder(midi_out, state=state)
+        recaller = SceneRecaller(parse_scenes(self.SCENE), encoder, state, rate=0)
+        rules = parse_automations({'rules': [{'type': 'scene_recall', 'channels': ['ST-IN4'], 'scene': 'test'}]})
+        engine = AutomationEngine(rules, encoder, scenes=recaller)
+        engine.process(MIDI_LS9.ON_OFF_CTLRS['ST-IN4'], MIDI_LS9.CH_OFF_VALUE)
+        engine.process(MIDI_LS9.ON_OFF_CTLRS['ST-IN4'], MIDI_LS9.CH_ON_VALUE)
+        deadline = time.monotonic() + 5
+        while recaller.recalls == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        recaller.stop()
+        self.assertEqual(recaller.recalls, 1)
+        self.assertEqual(self.decode(midi_out), list(recaller.get('test').outputs))
+        # an unknown scene is caught when the engine is built
+        rules = parse_automations({'rules': [{'type': 'scene_recall', 'channels': ['ST-IN4'], 'scene': 'other'}]})
+        with self.assertRaises(ValueError):
+            AutomationEngine(rules, encoder, scenes=recaller)
+
+
+class TestUsbCcRouter(unittest.TestCase):
+    def test_destinations_match_mappings(self):
+        for cc_controller in range(128):
+            if cc_controller in MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS:
+                mix_name, matrix, sof_ctlrs = MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS[cc_controller], 'MT5', MIDI_LS9.MT5_SOF_CTRLS
+            elif cc_controller in MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS:
+                mix_name, matrix, sof_ctlrs = MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS[cc_controller], 'MT6', MIDI_LS9.MT6_SOF_CTRLS
+            else:
+                self.assertEqual(USB_CC_DESTINATIONS[cc_controller], USB_CC_NO_DESTINATION)
+                continue
+            expected = MIDI_LS9.FADER_CTLRS[matrix] if mix_name == matrix else sof_ctlrs[mix_name]
+            self.assertEqual(USB_CC_DESTINATIONS[cc_controller], expected)
+
+    def test_fader_laws(self):
+        linear = build_fader_law('linear')
+        self.assertEqual((linear[0], linear[127]), (MIDI_LS9.FADE_NEGINF_VALUE, MIDI_LS9.FADE_10DB_VALUE))
+        unity = build_fader_law('unity')
+        self.assertEqual((unity[0], unity[96], unity[127]),
+                         (MIDI_LS9.FADE_NEGINF_VALUE, MIDI_LS9.FADE_0DB_VALUE, MIDI_LS9.FADE_10DB_VALUE))
+        for law in (linear, unity):
+            self.assertEqual(list(law), sorted(law))
+            self.assertLessEqual(max(law), 0x3FFF)
+        with self.assertRaises(ValueError):
+            build_fader_law('log')
+
+    def test_process(self):
+        nrpn_out = FakeNrpnOut()
+        router = UsbCcRouter(nrpn_out, 'unity')
+        with self.assertLogs(level=logging.ERROR):
+            self.assertFalse(router.process(1, 64))
+        cc_controller = next(iter(MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS))
+        self.assertTrue(router.process(cc_controller, 96))
+        self.assertTrue(router.process(77, 127))
+        self.assertEqual(nrpn_out.sent, [(USB_CC_DESTINATIONS[cc_controller], MIDI_LS9.FADE_0DB_VALUE),
+                                         (MIDI_LS9.FADER_CTLRS['MT5'], MIDI_LS9.FADE_10DB_VALUE)])
+
+    def test_out_of_range(self):
+        nrpn_out = FakeNrpnOut()
+        router = UsbCcRouter(nrpn_out).for_output(nrpn_out)
+        # CC 130 is not CC 2, nor is data 200 data 72. the records are packed by hand, encode_cc_batch
+        # only makes valid ones
+        cc_controller = next(iter(MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS))
+        frame = bytes([WS_BINARY_VERSION]) + b''.join(WS_CC_RECORD.pack(*record) for record in
+                                                      ((cc_controller + 128, 64, 0), (cc_controller, 200, 0), (cc_controller, 127, 0)))
+        with self.assertLogs(level=logging.ERROR):
+            results = [router.process(cc, data) for cc, data, _ in decode_cc_batch(frame)]
+        self.assertEqual(results, [False, False, True])
+        self.assertEqual(router.out_of_range, 2)
+        self.assertEqual(nrpn_out.sent, [(USB_CC_DESTINATIONS[cc_controller], MIDI_LS9.FADE_10DB_VALUE)])
+
+
+class TestStatePublisher(unittest.IsolatedAsyncioTestCase):
+    async def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.005)
+        self.fail('timed out')
+
+    async def test_snapshot_then_deltas(self):
+        state = ConsoleState()
+        publisher = StatePublisher(state)
+        mt5, mt6 = MIDI_LS9.FADER_CTLRS['MT5'], MIDI_LS9.FADER_CTLRS['MT6']
+        send = MIDI_LS9.MT5_SOF_CTRLS['MIX3']
+        self.assertIn(send, WS_STATE_CONTROLLERS)
+        state.update(mt5, 100)
+        # not pushed to the clients
+        state.update(MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE)
+        subscribers = []
+        async def listener(connection):
+            subscribers.append(await publisher.subscribe(connection))
+            try:
+                async for _ in connection:
+                    pass
+            except ConnectionClosed:
+                pass
+            finally:
+                publisher.unsubscribe(connection)
+        async with serve(listener, 'localhost', 0, select_subprotocol=select_ws_subprotocol) as server:
+            sender = WebsocketSender(f'ws://localhost:{server.sockets[0].getsockname()[1]}', asyncio.get_running_loop())
+            task = asyncio.create_task(sender.run())
+            await self.wait_for(lambda: sender.state_frames == 1)
+            self.assertEqual(sender.mixer_state, {mt5: 100})
+
+            state.update(mt6, 200)
+            state.update(send, 1)
+            state.update(send, 2)
+            publisher.tick()
+            await self.wait_for(lambda: sender.state_frames == 2)
+            self.assertEqual(sender.mixer_state, {mt5: 100, mt6: 200, send: 2})
+            # unchanged values are not sent again
+            state.update(mt5, 100)
+            publisher.tick()
+            await asyncio.sleep(0.02)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self.assertEqual(sender.state_frames, 2)
+        self.assertEqual((subscribers[0].frames, subscribers[0].values_sent), (2, 3))
+        self.assertEqual(publisher.subscribers, {})
+
+
+# holds the writer thread on its first send until release is set
+class BlockingNrpnOut(FakeNrpnOut):
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def send_nrpn(self, controller, data, force=False):
+        self.started.set()
+        self.release.wait(1.0)
+        return super().send_nrpn(controller, data, force)
+
+
+class TestNrpnFanIn(unittest.TestCase):
+    def setUp(self):
+        self.encoder = BlockingNrpnOut()
+        self.fan_in = NrpnFanIn(self.encoder)
+        self.a = self.fan_in.client('a')
+        self.b = self.fan_in.client('b')
+
+    def tearDown(self):
+        self.encoder.release.set()
+        self.fan_in.stop()
+
+    def test_round_robin(self):
+        self.a.send_nrpn(1, 1)
+        self.assertTrue(self.encoder.started.wait(1.0))
+        for controller in (2, 3, 4):
+            self.a.send_nrpn(controller, controller)
+        for controller in (10, 11):
+            self.b.send_nrpn(controller, controller)
+        self.assertEqual((self.a.depth, self.b.depth), (3, 2))
+        self.encoder.release.set()
+        self.fan_in.stop()
+        self.assertEqual([controller for controller, _ in self.encoder.sent], [1, 2, 10, 3, 11, 4])
+        self.assertEqual((self.a.sent, self.b.sent, self.a.high_water), (4, 2, 3))
+
+    def test_last_writer_wins(self):
+        self.a.send_nrpn(1, 1)
+        self.assertTrue(self.encoder.started.wait(1.0))
+        self.a.send_nrpn(2, 10)
+        self.a.send_nrpn(3, 10)
+        self.a.send_nrpn(2, 20)
+        self.b.send_nrpn(3, 30)
+        self.a.close()
+        self.assertEqual(self.fan_in.clients, [self.b])
+        self.encoder.release.set()
+        self.fan_in.stop()
+        # a's queued value is still sent after it disconnected
+        self.assertEqual(self.encoder.sent, [(1, 1), (2, 20), (3, 30)])
+        self.assertEqual((self.a.coalesced, self.b.coalesced), (2, 0))
+        self.assertEqual(self.fan_in.frames, 3)
+
+    def test_back_pressure_from_the_lane(self):
+        midi_out = FakeMidiOut()
+        # one 12 byte frame every 20ms
+        scheduler = MidiOutputScheduler(NrpnEncoder(midi_out), rate=600, burst=12)
+        fan_in = NrpnFanIn(scheduler.lane(LANE_CONTINUOUS), max_depth=1)
+        a = fan_in.client('a')
+        b = fan_in.client('b')
+        for controller in (1, 2, 3, 4, 5):
+            a.send_nrpn(controller, controller)
+        time.sleep(0.005)
+        # a's values did not all go into the lane ahead of b's: b gets the next turn
+        b.send_nrpn(10, 10)
+        self.assertLessEqual(scheduler.lane(LANE_CONTINUOUS).depth, 1)
+        fan_in.stop()
+        scheduler.stop()
+        decoder = NrpnDecoder()
+        sent = [decoder.controller for message in midi_out.messages if decoder.feed(message)]
+        self.assertEqual(sorted(sent), [1, 2, 3, 4, 5, 10])
+        self.assertLess(sent.index(10), sent.index(4))
+
+
+class TestMidiOutputScheduler(unittest.TestCase):
+    def setUp(self):
+        self.midi_out = FakeMidiOut()
+        # one 12 byte frame every 20ms
+        self.scheduler = MidiOutputScheduler(NrpnEncoder(self.midi_out), rate=600, burst=12)
+        self.control = self.scheduler.lane(LANE_CONTROL)
+        self.continuous = self.scheduler.lane(LANE_CONTINUOUS)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def sent(self):
+        decoder = NrpnDecoder()
+        return [(decoder.controller, decoder.data) for message in self.midi_out.messages if decoder.feed(message)]
+
+    def test_control_preempts_continuous(self):
+        self.continuous.send_nrpn(1, 1)
+        for controller in (2, 3, 4):
+            self.continuous.send_nrpn(controller, 10)
+        self.scheduler.lane(LANE_BULK).send_nrpn(6, 60)
+        self.control.send_nrpn(5, 50)
+        self.scheduler.stop()
+        self.assertEqual(self.sent(), [(1, 1), (5, 50), (2, 10), (3, 10), (4, 10), (6, 60)])
+        self.assertEqual((self.scheduler.inline, self.continuous.high_water), (1, 3))
+        self.assertGreater(self.scheduler.throttled, 0.0)
+
+    def test_continuous_coalescing(self):
+        self.continuous.send_nrpn(1, 1)
+        self.continuous.send_nrpn(2, 10)
+        self.continuous.send_nrpn(3, 30)
+        self.continuous.send_nrpn(2, 20)
+        self.scheduler.stop()
+        # the newer value of 2 keeps the place of the older one
+        self.assertEqual(self.sent(), [(1, 1), (2, 20), (3, 30)])
+        self.assertEqual((self.continuous.submitted, self.continuous.sent, self.continuous.coalesced), (4, 3, 1))
+
+    def test_delay_metrics(self):
+        for controller in (1, 2, 3):
+            self.control.send_nrpn(controller, controller)
+        self.scheduler.stop()
+        self.assertEqual(self.control.delay.count, 3)
+        # the third frame waited for two frames of wire time
+        self.assertGreaterEqual(self.control.max_delay, 0.03)
+        registry = MetricsRegistry()
+        register_output_metrics(registry, self.scheduler)
+        lines = registry.render().splitlines()
+        self.assertIn('ls9_midi_output_queue_delay_seconds_count{lane="control"} 3', lines)
+        self.assertIn('ls9_midi_output_queue_delay_seconds_count{lane="bulk"} 0', lines)
+        self.assertIn('ls9_midi_output_sent_total{lane="control"} 3', lines)
+
+    def test_latency_until_written(self):
+        self.scheduler.received(time.perf_counter())
+        for controller in (1, 2, 3):
+            self.control.send_nrpn(controller, controller)
+        self.scheduler.received(None)
+        # not triggered by a received frame, not measured
+        self.control.send_nrpn(4, 4)
+        self.scheduler.stop()
+        self.assertEqual(self.scheduler.latency.count, 3)
+        # measured when written: the second & third values waited for one & two frames of wire time
+        self.assertGreaterEqual(self.scheduler.latency.sum, 0.06)
+
+    def test_send_after_stop(self):
+        self.control.send_nrpn(1, 1)
+        self.continuous.send_nrpn(2, 2)
+        self.scheduler.stop()
+        # nothing drains the lanes any more, the values are written at once
+        self.assertTrue(self.continuous.send_nrpn(3, 3))
+        self.assertTrue(self.control.send_nrpn(4, 4))
+        self.assertEqual(self.sent(), [(1, 1), (2, 2), (3, 3), (4, 4)])
+        self.assertEqual((self.continuous.depth, self.control.depth), (0, 0))
+        self.assertEqual((self.continuous.sent, self.control.sent), (2, 2))
+
+    def test_unknown_lane(self):
+        with self.assertRaises(ValueError):
+            self.scheduler.lane('fast')
+
+
+class TestMidiPipeline(unittest.TestCase):
+    def setUp(self):
+        self.midi_out = FakeMidiOut()
+        self.pipeline = MidiPipeline(self.midi_out, load_automations(), load_scenes(), watchdog=None)
+
+    def tearDown(self):
+        self.pipeline.stop()
+
+    def feed(self, messages, timestamp=0.001):
+        for message in messages:
+            self.pipeline.process_cc_message(message, timestamp)
+
+    def sent(self):
+        decoder = NrpnDecoder()
+        return [(decoder.controller, decoder.data) for message in self.midi_out.messages if decoder.feed(message)]
+
+    def test_automation_output(self):
+        self.feed(nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE))
+        self.pipeline.stop()
+        self.assertEqual(self.sent(), [(MIDI_LS9.ON_OFF_CTLRS['CH33'], MIDI_LS9.CH_OFF_VALUE)])
+        # both the received & the sent values are in the console state
+        self.assertEqual(self.pipeline.console_state.get(MIDI_LS9.ON_OFF_CTLRS['CH01']), MIDI_LS9.CH_ON_VALUE)
+        self.assertEqual(self.pipeline.console_state.get(MIDI_LS9.ON_OFF_CTLRS['CH33']), MIDI_LS9.CH_OFF_VALUE)
+
+    def test_frame_timeout_without_watchdog(self):
+        registry = MetricsRegistry()
+        self.pipeline.register_metrics(registry, MidiEventRing(8))
+        frame = nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['CH01'], MIDI_LS9.CH_ON_VALUE)
+        self.feed(frame[:3])
+        # the last CC comes after the timeout: the partial frame is dropped first
+        self.pipeline.process_cc_message(frame[3], NRPN_FRAME_TIMEOUT + 0.1)
+        self.assertEqual((self.pipeline.decoder.frames, self.pipeline.frame_timeouts.value), (0, 1))
+        self.pipeline.stop()
+        self.assertEqual(self.midi_out.messages, [])
+        self.assertIn('ls9_nrpn_frames_dropped_total{reason="timeout"} 1', registry.render().splitlines())
+
+
+# stand-in for rtmidi.MidiIn, named like it: the port cache is keyed by the class name
+class MidiIn:
+    def __init__(self, ports):
+        self.ports = ports
+        self.listed = 0
+        self.opened = None
+
+    def get_port_count(self):
+        return len(self.ports)
+
+    def get_port_name(self, number):
+        return self.ports[number]
+
+    def get_ports(self):
+        self.listed += 1
+        return list(self.ports)
+
+    def open_port(self, number):
+        self.opened = number
+
+
+class TestMidiPorts(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.cache_dir.name, 'ls9-midi', 'ports.json')
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_by_number(self):
+        midi_in = MidiIn(['Midi Through:Midi Through Port-0 14:0'])
+        self.assertEqual(open_midi_port(midi_in, '0', self.cache_path), 0)
+        self.assertEqual((midi_in.opened, midi_in.listed), (0, 0))
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_by_name_is_cached(self):
+        ports = ['Midi Through:Midi Through Port-0 14:0', 'UM-ONE:UM-ONE MIDI 1 24:0']
+        midi_in = MidiIn(ports)
+        self.assertEqual(open_midi_port(midi_in, 'um-one', self.cache_path), 1)
+        self.assertEqual(midi_in.listed, 1)
+        # the next start only checks the name of the cached port
+        midi_in = MidiIn(ports)
+        self.assertEqual(find_midi_port(midi_in, 'um-one', self.cache_path), 1)
+        self.assertEqual(midi_in.listed, 0)
+        # plugged in another order, the ports are listed again
+        midi_in = MidiIn(ports[::-1])
+        self.assertEqual(find_midi_port(midi_in, 'um-one', self.cache_path), 0)
+        self.assertEqual(midi_in.listed, 1)
+        with self.assertRaises(ValueError):
+            find_midi_port(MidiIn(ports[:1]), 'um-one', self.cache_path)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        frames = registry.counter('frames_total', 'Frames')
+        messages = registry.counter('messages_total', 'Messages', labels=('client',))
+        registry.gauge_func('depth', 'Depth', lambda: {('a"b',): 2}, labels=('client',))
+        frames.inc()
+        frames.inc(2)
+        messages.labels('10.0.0.2:5000').inc()
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP ls9_frames_total Frames', '# TYPE ls9_frames_total counter', 'ls9_frames_total 3',
+            '# HELP ls9_messages_total Messages', '# TYPE ls9_messages_total counter',
+            'ls9_messages_total{client="10.0.0.2:5000"} 1',
+            '# HELP ls9_depth Depth', '# TYPE ls9_depth gauge', 'ls9_depth{client="a\\"b"} 2'])
+        with self.assertRaises(ValueError):
+            registry.counter('frames_total', 'Frames')
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.001, 0.01))
+        for value in (0.0005, 0.001, 0.005, 1.0):
+            latency.observe(value)
+        lines = registry.render().splitlines()
+        self.assertEqual(lines[2:6], ['ls9_latency_seconds_bucket{le="0.001"} 2', 'ls9_latency_seconds_bucket{le="0.01"} 3',
+                                      'ls9_latency_seconds_bucket{le="+Inf"} 4', 'ls9_latency_seconds_sum 1.0065'])
+        self.assertEqual(lines[6], 'ls9_latency_seconds_count 4')
+
+    def test_midi_metrics(self):
+        ring = MidiEventRing(8, arrivals=True)
+        pipeline = MidiPipeline(FakeMidiOut(), load_automations(), watchdog=None)
+        registry = MetricsRegistry()
+        pipeline.register_metrics(registry, ring)
+        # a frame whose address was lost: both of its data bytes are dropped
+        for message in nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['ST-IN3'], MIDI_LS9.CH_ON_VALUE)[2:]:
+            pipeline.process_cc_message(message, 0.0)
+        before = time.perf_counter()
+        for message in nrpn_frame(MIDI_LS9.ON_OFF_CTLRS['ST-IN3'], MIDI_LS9.CH_ON_VALUE):
+            ring.put(message, 0.0)
+        while len(ring):
+            message, timestamp, arrival = ring.get()
+            self.assertGreaterEqual(arrival, before)
+            pipeline.process_cc_message(message, timestamp, arrival)
+        pipeline.stop()
+        pipeline.frame_timeouts.inc()
+        nrpn_out = pipeline.nrpn_out
+        text = registry.render()
+        self.assertIn('ls9_midi_cc_in_total 4\n', text)
+        self.assertIn('ls9_nrpn_frames_decoded_total 1\n', text)
+        self.assertIn('ls9_nrpn_frames_dropped_total{reason="timeout"} 1\n', text)
+        self.assertNotIn('reason="invalid"', text)
+        self.assertIn('ls9_nrpn_data_bytes_dropped_total 2\n', text)
+        self.assertIn(f'ls9_nrpn_frames_sent_total {nrpn_out.frames}\n', text)
+        # the outputs of the frame are one macro, written at once
+        self.assertIn('ls9_automation_latency_seconds_count 1\n', text)
+        # without arrival times, there is no latency to measure
+        registry = MetricsRegistry()
+        MidiPipeline(FakeMidiOut(), load_automations(), watchdog=None).register_metrics(registry, MidiEventRing(8))
+        self.assertNotIn('ls9_automation_latency_seconds', registry.render())
+
+    def test_server(self):
+        registry = MetricsRegistry()
+        registry.counter('frames_total', 'Frames').inc()
+        server = MetricsServer(registry, port=0)
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics', timeout=5) as response:
+                self.assertEqual(response.headers['Content-Type'], METRICS_CONTENT_TYPE)
+                self.assertIn(b'ls9_frames_total 1\n', response.read())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f'http://127.0.0.1:{server.port}/other', timeout=5)
+        finally:
+            server.stop()
+
+
+# the entry point of the MIDI path in the programs, as far as the profiler is concerned
+def process_cc_message(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+class TestSamplingProfiler(unittest.TestCase):
+    def test_window(self):
+        stop = threading.Event()
+        busy = threading.Thread(target=process_cc_message, args=(stop,), name='midi-worker')
+        idle = threading.Thread(target=stop.wait, name='idle')
+        busy.start()
+        idle.start()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'profile.folded')
+            profiler = SamplingProfiler(path, seconds=0.2, interval=0.001).start()
+            # the window ends by itself
+            profiler._thread.join(5)
+            stop.set()
+            busy.join()
+            idle.join()
+            self.assertFalse(profiler._thread.is_alive())
+            with open(path) as f:
+                lines = f.read().splitlines()
+            with open(path + '.txt') as f:
+                summary = f.read()
+        self.assertGreater(profiler.ticks, 0)
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            # cut at the focus function, the thread's run() & bootstrap are not in the profile
+            self.assertTrue(stack.startswith('midi-worker;test_midi_yamaha_ls9.py:process_cc_message'), stack)
+            self.assertGreater(int(count), 0)
+        name, _, total = profiler.functions()[0]
+        self.assertEqual((name, total), ('test_midi_yamaha_ls9.py:process_cc_message', sum(profiler.stacks.values())))
+        self.assertIn('test_midi_yamaha_ls9.py:process_cc_message', summary)
+        self.assertGreater(profiler.idle, 0)
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
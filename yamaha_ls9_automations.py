@@ -0,0 +1,421 @@
+####################################################################################################
+############################### Automation rules engine for Yamaha LS9 ##############################
+#### - Description:
+####   The automations are defined in a JSON file (automations.json by default). Each rule is
+####   validated and compiled once, when the file is loaded, into handlers that are stored in a
+####   table indexed by NRPN controller. Processing an incoming NRPN frame only runs the handlers
+####   bound to its controller, instead of walking a chain of if/elif for every frame.
+####
+#### - Rule file format:
+####   {"rules": [{"name": <str>, "type": <rule type>, <rule specific keys>}, ...]}
+####   Controllers & values are given as the name of a constant in yamaha_ls9_constants.py
+####   (i.e. "FADE_0DB_VALUE", "MONO_SEND_TO_MT3"), as "<MAPPING>[<KEY>]" (i.e. "ON_OFF_CTLRS[ST LR]")
+####   or as integers. Rule types:
+####   > mute_interlock:       two channels that are never ON together. switching one ON switches the
+####                           other OFF, switching it OFF switches the other back ON.
+####         "pairs": name of a mapping (i.e. "CHORUS_TO_LEAD_MAPPING") or a list of [ch, ch] pairs
+####   > send_mute_hysteresis: mute the sends of a channel & its linked channel when the channel's
+####                           fader drops below mute_below, unmute them once it is raised above
+####                           unmute_above (i.e. a software schmitt trigger)
+####         "pairs", "sends" (mapping of send controllers), "mute_below", "unmute_above",
+####         "muted_value", "unmuted_value"
+####   > on_off:               fixed outputs when a channel is switched ON and/or OFF
+####         "channels": list of channel names, "on"/"off": list of [controller, value] outputs,
+####         optional "log_on"/"log_off" messages
+####         optional "inhibited_by": a channel that, while it is ON, makes a switch ON send the
+####         "inhibited_on" outputs instead of "on" (i.e. the wireless mics in WLTBK mode)
+####   > linear_link:          map a fader linearly onto other parameters
+####         "source": fader controller, "targets": list of controllers, "out_min", "out_max"
+####         outputs go through the continuous (rate limited) output, if there is one
+####   > scene_recall:         recall a scene (see yamaha_ls9_scenes.py) when a channel is switched ON
+####         "channels": list of channel names, "scene": name of the scene
+####         the scene is sent by the engine's SceneRecaller, on its own thread
+####   The fixed outputs of a rule (i.e. everything on_off sends when a channel is switched ON) are
+####   encoded once, into an NrpnMacro per (rule, state), and sent with one write per trigger.
+####   Every controller a rule is bound to is classified through CTLR_DISPATCH when the engine is
+####   built: the ON/OFF rules only take ON/OFF controllers, the fader rules only fader controllers.
+import json
+import logging
+import os
+import re
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+from midi_nrpn import NrpnMacro
+
+DEFAULT_AUTOMATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'automations.json')
+# the automations of midi_server_websockets.py, which has its own ST-IN routing & WLTBK toggle
+SERVER_AUTOMATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'automations_server.json')
+
+# "<MAPPING>[<KEY>]"
+_MAPPING_REF = re.compile(r'^(\w+)\[(.+)\]$')
+
+
+# resolves a controller or value reference of the rule file to an int
+def resolve_constant(ref, where):
+    if isinstance(ref, int) and not isinstance(ref, bool):
+        return ref
+    if not isinstance(ref, str):
+        raise ValueError(f'{where}: expected a constant name or an integer, got {ref!r}')
+    match = _MAPPING_REF.match(ref)
+    if match:
+        mapping = get_mapping(match[1], where)
+        if match[2] not in mapping:
+            raise ValueError(f'{where}: {match[2]!r} is not in {match[1]}')
+        return mapping[match[2]]
+    value = getattr(MIDI_LS9, ref, None)
+    if not isinstance(value, int):
+        raise ValueError(f'{where}: unknown constant {ref!r}')
+    return value
+
+def get_mapping(name, where):
+    mapping = getattr(MIDI_LS9, name, None)
+    if not isinstance(mapping, MIDI_LS9.bidict):
+        raise ValueError(f'{where}: unknown mapping {name!r}')
+    return mapping
+
+# "pairs" is either the name of a channel -> channel mapping, or a list of [channel, channel]
+def resolve_pairs(ref, where):
+    if isinstance(ref, str):
+        return list(get_mapping(ref, where).items())
+    if not isinstance(ref, list) or not all(isinstance(pair, list) and len(pair) == 2 for pair in ref):
+        raise ValueError(f'{where}: pairs must be a mapping name or a list of [channel, channel] pairs')
+    return [tuple(pair) for pair in ref]
+
+def check_channel(channel, mapping, mapping_name, where):
+    if channel not in mapping:
+        raise ValueError(f'{where}: unknown channel {channel!r} (not in {mapping_name})')
+    return mapping[channel]
+
+def check_keys(spec, required, optional, where):
+    missing = [key for key in required if key not in spec]
+    if missing:
+        raise ValueError(f'{where}: missing {", ".join(missing)}')
+    unknown = [key for key in spec if key not in required and key not in optional]
+    if unknown:
+        raise ValueError(f'{where}: unknown {", ".join(unknown)}')
+
+
+#### Rule types
+# every rule is built from its name & the rest of its spec, and has bindings(engine), which yields
+# the (controller, handler) pairs of the rule. handlers are called with the NRPN data of their
+# controller, and send their outputs through the engine. TRIGGER_KIND is the CTLR_KIND_* of the
+# controllers the rule can be bound to.
+class MuteInterlock:
+    TRIGGER_KIND = MIDI_LS9.CTLR_KIND_ON_OFF
+
+    def __init__(self, name, spec, where):
+        check_keys(spec, ('pairs',), (), where)
+        self.name = name
+        self.pairs = resolve_pairs(spec['pairs'], where)
+        for pair in self.pairs:
+            for channel in pair:
+                check_channel(channel, MIDI_LS9.ON_OFF_CTLRS, 'ON_OFF_CTLRS', where)
+
+    def bindings(self, engine):
+        def interlock(channel, alt_channel):
+            alt_controller = MIDI_LS9.ON_OFF_CTLRS[alt_channel]
+            alt_off = engine.macro(((alt_controller, MIDI_LS9.CH_OFF_VALUE),))
+            alt_on =  engine.macro(((alt_controller, MIDI_LS9.CH_ON_VALUE),))
+            def handler(data):
+                if data == MIDI_LS9.CH_ON_VALUE:
+                    logging.debug('MIXER IN: %s switched ON', channel)
+                    logging.info('MIDI OUT: %s OFF', alt_channel)
+                    engine.send_macro(alt_off)
+                else:
+                    logging.debug('MIXER IN: %s switched OFF', channel)
+                    logging.info('MIDI OUT: %s ON', alt_channel)
+                    engine.send_macro(alt_on)
+            return handler
+        for channel, alt_channel in self.pairs:
+            yield MIDI_LS9.ON_OFF_CTLRS[channel], interlock(channel, alt_channel)
+            yield MIDI_LS9.ON_OFF_CTLRS[alt_channel], interlock(alt_channel, channel)
+
+
+class SendMuteHysteresis:
+    TRIGGER_KIND = MIDI_LS9.CTLR_KIND_FADER
+
+    def __init__(self, name, spec, where):
+        check_keys(spec, ('pairs', 'sends', 'mute_below', 'unmute_above', 'muted_value', 'unmuted_value'),
+                   (), where)
+        self.name = name
+        self.pairs = resolve_pairs(spec['pairs'], where)
+        self.sends = get_mapping(spec['sends'], where)
+        for channel, linked_channel in self.pairs:
+            check_channel(channel, MIDI_LS9.FADER_CTLRS, 'FADER_CTLRS', where)
+            check_channel(channel, self.sends, spec['sends'], where)
+            check_channel(linked_channel, self.sends, spec['sends'], where)
+        self.mute_below =    resolve_constant(spec['mute_below'], where)
+        self.unmute_above =  resolve_constant(spec['unmute_above'], where)
+        self.muted_value =   resolve_constant(spec['muted_value'], where)
+        self.unmuted_value = resolve_constant(spec['unmuted_value'], where)
+        if self.mute_below > self.unmute_above:
+            raise ValueError(f'{where}: mute_below must not be above unmute_above')
+
+    def bindings(self, engine):
+        def hysteresis(channel, linked_channel):
+            mute =   engine.macro(((self.sends[channel], self.muted_value),
+                                   (self.sends[linked_channel], self.muted_value)))
+            unmute = engine.macro(((self.sends[channel], self.unmuted_value),
+                                   (self.sends[linked_channel], self.unmuted_value)))
+            # the sends start out muted, so that raising the fader for the first time unmutes them
+            muted = [True]
+            def handler(data):
+                if data < self.mute_below and not muted[0]:
+                    muted[0] = True
+                    logging.debug('MIXER IN: %s fade below %#x', channel, self.mute_below)
+                    logging.info('MIDI OUT: %s, %s sends muted', channel, linked_channel)
+                    engine.send_macro(mute)
+                elif data > self.unmute_above and muted[0]:
+                    muted[0] = False
+                    logging.debug('MIXER IN: %s fade above %#x', channel, self.unmute_above)
+                    logging.info('MIDI OUT: %s, %s sends unmuted', channel, linked_channel)
+                    engine.send_macro(unmute)
+            return handler
+        for channel, linked_channel in self.pairs:
+            yield MIDI_LS9.FADER_CTLRS[channel], hysteresis(channel, linked_channel)
+
+
+class OnOff:
+    TRIGGER_KIND = MIDI_LS9.CTLR_KIND_ON_OFF
+
+    def __init__(self, name, spec, where):
+        check_keys(spec, ('channels',), ('on', 'off', 'log_on', 'log_off', 'inhibited_by', 'inhibited_on'), where)
+        self.name = name
+        if not isinstance(spec['channels'], list) or not spec['channels']:
+            raise ValueError(f'{where}: channels must be a list of channel names')
+        self.channels = spec['channels']
+        for channel in self.channels:
+            check_channel(channel, MIDI_LS9.ON_OFF_CTLRS, 'ON_OFF_CTLRS', where)
+        self.on =  self._outputs(spec.get('on', []),  f'{where} on')
+        self.off = self._outputs(spec.get('off', []), f'{where} off')
+        if not self.on and not self.off:
+            raise ValueError(f'{where}: needs on and/or off outputs')
+        self.log_on =  spec.get('log_on')
+        self.log_off = spec.get('log_off')
+        self.inhibited_by = spec.get('inhibited_by')
+        if self.inhibited_by is not None:
+            check_channel(self.inhibited_by, MIDI_LS9.ON_OFF_CTLRS, 'ON_OFF_CTLRS', f'{where} inhibited_by')
+        elif 'inhibited_on' in spec:
+            raise ValueError(f'{where}: inhibited_on needs inhibited_by')
+        self.inhibited_on = self._outputs(spec.get('inhibited_on', []), f'{where} inhibited_on')
+
+    @staticmethod
+    def _outputs(outputs, where):
+        if not isinstance(outputs, list) or \
+           not all(isinstance(output, list) and len(output) == 2 for output in outputs):
+            raise ValueError(f'{where}: outputs must be a list of [controller, value]')
+        return tuple((resolve_constant(controller, where), resolve_constant(value, where))
+                     for controller, value in outputs)
+
+    def bindings(self, engine):
+        on =  engine.macro(self.on) if self.on else None
+        off = engine.macro(self.off) if self.off else None
+        inhibited_on = engine.macro(self.inhibited_on) if self.inhibited_on else None
+        # the last ON/OFF of inhibited_by received from the console, OFF until then
+        inhibited = [False]
+        def handler(data):
+            if data == MIDI_LS9.CH_ON_VALUE:
+                if inhibited[0]:
+                    macro, message = inhibited_on, f'{self.name} inhibited by {self.inhibited_by}'
+                else:
+                    macro, message = on, self.log_on
+            elif data == MIDI_LS9.CH_OFF_VALUE:
+                macro, message = off, self.log_off
+            else:
+                return
+            if message:
+                logging.info('MIDI OUT: %s', message)
+            if macro is not None:
+                engine.send_macro(macro)
+        for channel in self.channels:
+            yield MIDI_LS9.ON_OFF_CTLRS[channel], handler
+        if self.inhibited_by is not None:
+            def follow_inhibited_by(data):
+                if data == MIDI_LS9.CH_ON_VALUE:
+                    inhibited[0] = True
+                elif data == MIDI_LS9.CH_OFF_VALUE:
+                    inhibited[0] = False
+            yield MIDI_LS9.ON_OFF_CTLRS[self.inhibited_by], follow_inhibited_by
+
+
+class LinearLink:
+    TRIGGER_KIND = MIDI_LS9.CTLR_KIND_FADER
+
+    def __init__(self, name, spec, where):
+        check_keys(spec, ('source', 'targets', 'out_min', 'out_max'), (), where)
+        self.name = name
+        self.source = resolve_constant(spec['source'], where)
+        if not isinstance(spec['targets'], list) or not spec['targets']:
+            raise ValueError(f'{where}: targets must be a list of controllers')
+        self.targets = tuple(resolve_constant(target, where) for target in spec['targets'])
+        self.out_min = resolve_constant(spec['out_min'], where)
+        self.out_max = resolve_constant(spec['out_max'], where)
+
+    def bindings(self, engine):
+        scale = (self.out_max - self.out_min) / float(MIDI_LS9.CH_ON_VALUE)
+        def handler(data):
+            #we map the input data range [0,16383] to [out_min, out_max]
+            mapped_data = int(data * scale + self.out_min)
+            for target in self.targets:
+                engine.send_continuous(target, mapped_data)
+        yield self.source, handler
+
+
+class SceneRecall:
+    TRIGGER_KIND = MIDI_LS9.CTLR_KIND_ON_OFF
+
+    def __init__(self, name, spec, where):
+        check_keys(spec, ('channels', 'scene'), (), where)
+        self.name = name
+        self.where = where
+        if not isinstance(spec['channels'], list) or not spec['channels']:
+            raise ValueError(f'{where}: channels must be a list of channel names')
+        self.channels = spec['channels']
+        for channel in self.channels:
+            check_channel(channel, MIDI_LS9.ON_OFF_CTLRS, 'ON_OFF_CTLRS', where)
+        if not isinstance(spec['scene'], str):
+            raise ValueError(f'{where}: scene must be the name of a scene')
+        self.scene = spec['scene']
+
+    def bindings(self, engine):
+        if engine.scenes is None:
+            logging.warning('%s: no scenes loaded, the rule is disabled', self.where)
+            return
+        # raises ValueError for an unknown scene, when the engine is built
+        engine.scenes.get(self.scene)
+        def handler(data):
+            if data == MIDI_LS9.CH_ON_VALUE:
+                logging.info('Recalling scene %s', self.scene)
+                engine.recall_scene(self.scene)
+        for channel in self.channels:
+            yield MIDI_LS9.ON_OFF_CTLRS[channel], handler
+
+
+_KIND_NAMES = {MIDI_LS9.CTLR_KIND_FADER: 'a fader', MIDI_LS9.CTLR_KIND_ON_OFF: 'an ON/OFF'}
+
+
+# Runs the compiled rules. midi_out is an NrpnEncoder (or anything with its send_nrpn()),
+# continuous_out is used for outputs that follow a fader (i.e. an NrpnCoalescer), if given.
+# scenes is the SceneRecaller of the scene_recall rules, if any
+class AutomationEngine:
+    def __init__(self, rules, midi_out, continuous_out=None, scenes=None):
+        self.rules = rules
+        self.midi_out = midi_out
+        self.continuous_out = midi_out if continuous_out is None else continuous_out
+        self.scenes = scenes
+        # number of NRPNs sent by each rule, in the order of rules
+        self.outputs = [0] * len(rules)
+        # controller -> tuple of handlers. most controllers have none
+        self._handlers = [()] * MIDI_LS9.NRPN_CTLR_COUNT
+        for index, rule in enumerate(rules):
+            for controller, handler in rule.bindings(_RuleOutput(self, index)):
+                kind, channel, _ = MIDI_LS9.classify_nrpn_ctlr(controller)
+                if kind != rule.TRIGGER_KIND:
+                    raise ValueError(f'{rule.name}: controller {controller:#x} ({channel or "unknown"}) is not '
+                                     f'{_KIND_NAMES[rule.TRIGGER_KIND]} controller')
+                self._handlers[controller] += (handler,)
+
+    # controllers that have at least one rule bound to them
+    def bound_controllers(self):
+        return [controller for controller, handlers in enumerate(self._handlers) if handlers]
+
+    # Process one decoded NRPN (controller, data) event. returns False if no rule is bound to it
+    def process(self, controller, data):
+        handlers = self._handlers[controller]
+        for handler in handlers:
+            handler(data)
+        return bool(handlers)
+
+    def send(self, controller, data):
+        self.midi_out.send_nrpn(controller, data)
+
+    # encodes a fixed set of (controller, data) outputs once, see NrpnMacro
+    def macro(self, outputs):
+        compile_macro = getattr(self.midi_out, 'compile_macro', None)
+        if compile_macro is None:
+            return NrpnMacro(outputs)
+        return compile_macro(outputs)
+
+    def send_macro(self, macro):
+        send_macro = getattr(self.midi_out, 'send_macro', None)
+        if send_macro is None:
+            # an output without macro support, i.e. a NrpnFanInClient
+            for controller, data in macro.outputs:
+                self.midi_out.send_nrpn(controller, data)
+        else:
+            send_macro(macro)
+
+    def send_continuous(self, controller, data):
+        self.continuous_out.send_nrpn(controller, data)
+
+    def recall_scene(self, name):
+        self.scenes.recall(name)
+
+
+# what the rules see as the engine: the same sends, counted in engine.outputs for the rule
+class _RuleOutput:
+    __slots__ = ('engine', 'index')
+
+    def __init__(self, engine, index):
+        self.engine = engine
+        self.index = index
+
+    def macro(self, outputs):
+        return self.engine.macro(outputs)
+
+    def send(self, controller, data):
+        self.engine.outputs[self.index] += 1
+        self.engine.send(controller, data)
+
+    def send_continuous(self, controller, data):
+        self.engine.outputs[self.index] += 1
+        self.engine.send_continuous(controller, data)
+
+    def send_macro(self, macro):
+        self.engine.outputs[self.index] += len(macro.outputs)
+        self.engine.send_macro(macro)
+
+    # the values of a scene are counted by the SceneRecaller, once they are diffed & sent
+    @property
+    def scenes(self):
+        return self.engine.scenes
+
+    def recall_scene(self, name):
+        self.engine.recall_scene(name)
+
+
+RULE_TYPES = {
+    'mute_interlock':       MuteInterlock,
+    'send_mute_hysteresis': SendMuteHysteresis,
+    'on_off':               OnOff,
+    'linear_link':          LinearLink,
+    'scene_recall':         SceneRecall,
+}
+
+
+# parses & validates a rule file. raises ValueError with the offending rule if anything is wrong
+def load_automations(path=DEFAULT_AUTOMATIONS_FILE):
+    with open(path) as rules_file:
+        try:
+            spec = json.load(rules_file)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'{path}: invalid JSON: {e}') from e
+    return parse_automations(spec, path)
+
+def parse_automations(spec, source='<automations>'):
+    if not isinstance(spec, dict) or not isinstance(spec.get('rules'), list):
+        raise ValueError(f'{source}: expected an object with a "rules" list')
+    rules = []
+    for i, rule_spec in enumerate(spec['rules']):
+        where = f'{source}: rule {i}'
+        if not isinstance(rule_spec, dict):
+            raise ValueError(f'{where}: expected an object')
+        rule_spec = dict(rule_spec)
+        name = rule_spec.pop('name', f'rule {i}')
+        rule_type = rule_spec.pop('type', None)
+        where = f'{source}: rule {i} ({name})'
+        if rule_type not in RULE_TYPES:
+            raise ValueError(f'{where}: unknown type {rule_type!r}, expected one of {", ".join(RULE_TYPES)}')
+        rules.append(RULE_TYPES[rule_type](name, rule_spec, where))
+    return rules
@@ -1,5 +1,31 @@
 # yamaha ls9 MIDI NRPN controller + data values. python constants file
-from bidict import bidict
+from array import array
+
+
+# Read-only two-way mapping, with the .inverse (or .inv) lookups of bidict. The inverse is built
+# with the mapping, and plain dict lookups are used both ways. This module is imported on every
+# start of the service, importing the bidict package (and the typing modules it pulls in) took
+# longer than building all of the tables below.
+class bidict(dict):
+    __slots__ = ('inverse',)
+
+    def __init__(self, mapping):
+        super().__init__(mapping)
+        inverse = dict.__new__(bidict)
+        dict.__init__(inverse, ((value, key) for key, value in self.items()))
+        if len(inverse) != len(self):
+            raise ValueError(f'A value is mapped to more than one key in {mapping}')
+        inverse.inverse = self
+        self.inverse = inverse
+
+    @property
+    def inv(self):
+        return self.inverse
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('MIDI_LS9 mappings are read-only')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
 
 #### Constants
 ON_OFF_CTLRS = bidict({
@@ -106,7 +132,8 @@ CH_ON_VALUE  = 0x3FFF
 CH_OFF_VALUE = 0x0000
 
 # relevant values for fader controlling
-FADE_10DB_VALUE = 0xFFFF ######################
+# NRPN data is 14 bits, the top of the fader travel is the largest value
+FADE_10DB_VALUE =   0x3FFF
 FADE_0DB_VALUE =    0x3370
 FADE_50DB_VALUE =   0xad0
 FADE_60DB_VALUE =   0x7b0
@@ -121,6 +148,13 @@ MIX16_SEND_TO_MT1 = 0x68a
 STLR_SEND_TO_MT2  = 0x140a
 MIX16_SEND_TO_MT2 = 0x118a
 
+# the routing sends above, by name (i.e. for the scenes, see yamaha_ls9_scenes.py)
+MT_ROUTING_SEND_CTLRS = bidict({
+    "MIX16 to MT1" : MIX16_SEND_TO_MT1, "MONO to MT1"  : MONO_SEND_TO_MT1,
+    "MIX16 to MT2" : MIX16_SEND_TO_MT2, "ST LR to MT2" : STLR_SEND_TO_MT2,
+    "MONO to MT3"  : MONO_SEND_TO_MT3,  "ST LR to MT3" : ST_LR_SEND_TO_MT3
+})
+
 # Mappings for chorus <-> lead automations. WL Mics cycle between 3 states: M.C., chorus & lead
 CHORUS_TO_LEAD_MAPPING = bidict({
     "CH01" : "CH33",  "CH02" : "CH34",  "CH03" : "CH35",  "CH04" : "CH36",  "CH05" : "CH37",
@@ -146,6 +180,63 @@ NRPN_BYTE_2 = 0x63
 NRPN_BYTE_3 = 0x06
 NRPN_BYTE_4 = 0x26
 
+NRPN_CTLR_COUNT = 0x4000 # controllers are 14 bits wide
+
+####################################################################################################
+# Controller dispatch table
+# Every 14-bit NRPN controller number indexes one 16-bit entry of CTLR_DISPATCH, packed as:
+#   bits 15-12: kind of operation (CTLR_KIND_*)
+#   bits 11-8:  automation handler group (HANDLER_*)
+#   bits 7-0:   channel index into CHANNEL_NAMES (index 0 is None, i.e. unknown controller)
+# Classifying a message is therefore one combine_bytes() plus one index into the table, instead of
+# several bidict .inverse lookups. The table is built once, when this module is imported.
+CTLR_KIND_NONE   = 0
+CTLR_KIND_FADER  = 1
+CTLR_KIND_ON_OFF = 2
+
+HANDLER_NONE    = 0
+HANDLER_CHORUS  = 1 # CH01-CH10, keys of CHORUS_TO_LEAD_MAPPING
+HANDLER_LEAD    = 2 # CH33-CH42, values of CHORUS_TO_LEAD_MAPPING
+HANDLER_WL_MC   = 3 # keys of WIRELESS_MC_TO_CHR_MAPPING
+HANDLER_WL_CHR  = 4 # keys of WIRELESS_CHR_TO_LEAD_MAPPING
+HANDLER_WL_LEAD = 5 # values of WIRELESS_MC_TO_LEAD_MAPPING
+
+CTLR_KIND_SHIFT    = 12
+CTLR_HANDLER_SHIFT = 8
+CTLR_HANDLER_MASK  = 0xF
+CTLR_CHANNEL_MASK  = 0xFF
+
+CHANNEL_NAMES = (None,) + tuple(FADER_CTLRS)
+
+def _build_ctlr_dispatch():
+    handlers = {}
+    for channel_names, handler in ((CHORUS_TO_LEAD_MAPPING.keys(),        HANDLER_CHORUS),
+                                   (CHORUS_TO_LEAD_MAPPING.values(),      HANDLER_LEAD),
+                                   (WIRELESS_MC_TO_CHR_MAPPING.keys(),    HANDLER_WL_MC),
+                                   (WIRELESS_CHR_TO_LEAD_MAPPING.keys(),  HANDLER_WL_CHR),
+                                   (WIRELESS_MC_TO_LEAD_MAPPING.values(), HANDLER_WL_LEAD)):
+        for channel in channel_names:
+            handlers[channel] = handler
+
+    table = array('H', bytes(2 * NRPN_CTLR_COUNT))
+    for kind, mapping in ((CTLR_KIND_FADER, FADER_CTLRS), (CTLR_KIND_ON_OFF, ON_OFF_CTLRS)):
+        for channel, controller in mapping.items():
+            if table[controller] != 0:
+                raise ValueError(f'NRPN controller {hex(controller)} ({channel}) is mapped twice!')
+            table[controller] = (kind << CTLR_KIND_SHIFT) | \
+                                (handlers.get(channel, HANDLER_NONE) << CTLR_HANDLER_SHIFT) | \
+                                CHANNEL_NAMES.index(channel)
+    return table
+
+CTLR_DISPATCH = _build_ctlr_dispatch()
+
+#returns (kind, channel, handler) of an NRPN controller with a single CTLR_DISPATCH lookup
+# kind is one of CTLR_KIND_*, handler one of HANDLER_*, channel is a str or None
+def classify_nrpn_ctlr(controller):
+    entry = CTLR_DISPATCH[controller]
+    return entry >> CTLR_KIND_SHIFT, CHANNEL_NAMES[entry & CTLR_CHANNEL_MASK], \
+           (entry >> CTLR_HANDLER_SHIFT) & CTLR_HANDLER_MASK
+
 ####################################################################################################
 # NPRN message structure for Yamaha LS9 (messages are 7 bits):
 # CC cmd #   Byte 1   Byte 2   Byte 3
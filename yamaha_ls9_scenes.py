@@ -0,0 +1,269 @@
+####################################################################################################
+################################# Scene recall for the Yamaha LS9 ##################################
+#### - Description:
+####   A scene is a named preset of console values, defined in a JSON file (scenes.json by default).
+####   Recalling a scene compares it with the last known console values (ConsoleState) and only
+####   sends the controllers that differ, or whose value is unknown. The values are sent in chunks
+####   of SCENE_CHUNK outputs (one NrpnMacro, i.e. a single write on rawmidi), paced so the average
+####   output rate stays at the DIN MIDI wire rate: sent any faster (USB MIDI interfaces accept data
+####   much faster than 31.25 kbaud), a whole scene overruns the console's MIDI input buffer.
+####   Channels switched OFF by the scene are sent first and channels switched ON last, so a channel
+####   is never ON with the levels of the previous scene.
+####
+#### - Scene file format:
+####   {"scenes": [{"name": <str>, <section>: {<name>: <value>, ...}, ...}, ...]}
+####   Sections, by the mapping of yamaha_ls9_constants.py their names are looked up in:
+####   > "on":             ON_OFF_CTLRS, true/false
+####   > "faders":         FADER_CTLRS
+####   > "mix1_sends":     MIX1_SOF_CTLRS
+####   > "mt5_sends":      MT5_SOF_CTRLS
+####   > "mt6_sends":      MT6_SOF_CTRLS
+####   A send whose controller is also an ON/OFF or fader controller is rejected: the MT5/MT6 sends of
+####   MIX3-MIX16 (and MIX1/MIX2 for MT6) are copies of the MIX ON/OFF controllers in
+####   yamaha_ls9_constants.py, so a level for them would switch the MIX on or off instead
+####   > "routing_sends":  MT_ROUTING_SEND_CTLRS (the ST-IN routing sends to MT1/MT2/MT3)
+####   > "outputs":        list of [controller, value] for anything else (always sent)
+####   Levels are given like in the automations: a constant name (i.e. "FADE_0DB_VALUE") or an int
+import json
+import logging
+import os
+import threading
+import time
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+from midi_nrpn import NRPN_FRAME_BYTES, NRPN_DATA_MAX, MIDI_WIRE_RATE
+from yamaha_ls9_automations import resolve_constant, check_channel, check_keys
+
+DEFAULT_SCENES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenes.json')
+
+# outputs sent at once, ~30ms of wire time at MIDI_WIRE_RATE
+SCENE_CHUNK = 8
+
+# scene file section -> (mapping name, mapping)
+SCENE_SECTIONS = {
+    'faders':        ('FADER_CTLRS', MIDI_LS9.FADER_CTLRS),
+    'mix1_sends':    ('MIX1_SOF_CTLRS', MIDI_LS9.MIX1_SOF_CTLRS),
+    'mt5_sends':     ('MT5_SOF_CTRLS', MIDI_LS9.MT5_SOF_CTRLS),
+    'mt6_sends':     ('MT6_SOF_CTRLS', MIDI_LS9.MT6_SOF_CTRLS),
+    'routing_sends': ('MT_ROUTING_SEND_CTLRS', MIDI_LS9.MT_ROUTING_SEND_CTLRS),
+}
+
+
+# controller -> (mapping name, channel) of the ON/OFF & fader controllers, which a send must not be
+def _build_switch_and_fader_ctlrs():
+    controllers = {}
+    for mapping_name, mapping in (('FADER_CTLRS', MIDI_LS9.FADER_CTLRS), ('ON_OFF_CTLRS', MIDI_LS9.ON_OFF_CTLRS)):
+        for channel, controller in mapping.items():
+            controllers[controller] = (mapping_name, channel)
+    return controllers
+
+SWITCH_AND_FADER_CTLRS = _build_switch_and_fader_ctlrs()
+
+
+class Scene:
+    def __init__(self, name, spec, where):
+        check_keys(spec, (), ('on',) + tuple(SCENE_SECTIONS) + ('outputs',), where)
+        self.name = name
+        switched_on = []
+        switched_off = []
+        levels = []
+        for channel, on in self._section(spec, 'on', where).items():
+            if not isinstance(on, bool):
+                raise ValueError(f'{where}: on: {channel} must be true or false')
+            controller = check_channel(channel, MIDI_LS9.ON_OFF_CTLRS, 'ON_OFF_CTLRS', f'{where}: on')
+            if on:
+                switched_on.append((controller, MIDI_LS9.CH_ON_VALUE))
+            else:
+                switched_off.append((controller, MIDI_LS9.CH_OFF_VALUE))
+        for section, (mapping_name, mapping) in SCENE_SECTIONS.items():
+            for key, value in self._section(spec, section, where).items():
+                controller = check_channel(key, mapping, mapping_name, f'{where}: {section}')
+                if section != 'faders' and controller in SWITCH_AND_FADER_CTLRS:
+                    other_mapping, channel = SWITCH_AND_FADER_CTLRS[controller]
+                    raise ValueError(f'{where}: {section}: {mapping_name}[{key!r}] is {controller:#x}, the controller of '
+                                     f'{other_mapping}[{channel!r}], not a send')
+                levels.append((controller, self._level(value, f'{where}: {section}: {key}')))
+        outputs = spec.get('outputs', [])
+        if not isinstance(outputs, list) or \
+           not all(isinstance(output, list) and len(output) == 2 for output in outputs):
+            raise ValueError(f'{where}: outputs must be a list of [controller, value]')
+        for controller, value in outputs:
+            levels.append((self._level(controller, f'{where}: outputs'), self._level(value, f'{where}: outputs')))
+        # (controller, data) in the order they are sent
+        self.outputs = tuple(switched_off + levels + switched_on)
+        # i.e. the same controller listed in "outputs" & in a section
+        controllers = set()
+        for controller, _ in self.outputs:
+            if controller in controllers:
+                raise ValueError(f'{where}: controller {controller:#x} is set more than once')
+            controllers.add(controller)
+        if not self.outputs:
+            raise ValueError(f'{where}: the scene is empty')
+
+    @staticmethod
+    def _section(spec, section, where):
+        values = spec.get(section, {})
+        if not isinstance(values, dict):
+            raise ValueError(f'{where}: {section} must be an object')
+        return values
+
+    @staticmethod
+    def _level(ref, where):
+        value = resolve_constant(ref, where)
+        if not 0 <= value <= NRPN_DATA_MAX:
+            raise ValueError(f'{where}: {value:#x} is out of the NRPN range')
+        return value
+
+
+# What one recall did
+class SceneTransfer:
+    __slots__ = ('name', 'sent', 'skipped', 'bytes_sent', 'seconds', 'cancelled')
+
+    def __init__(self, name, skipped):
+        self.name = name
+        self.sent = 0
+        # values the console already held
+        self.skipped = skipped
+        self.bytes_sent = 0
+        self.seconds = 0.0
+        self.cancelled = False
+
+    def summary(self):
+        return f'Scene {self.name}: {self.sent} values sent, {self.skipped} unchanged skipped, ' \
+               f'{self.bytes_sent} bytes in {self.seconds:.3f}s' + (' (cancelled)' if self.cancelled else '')
+
+
+# Sends scenes to midi_out (an NrpnEncoder, or anything with its send_nrpn()), diffed against state
+# (the ConsoleState the encoder updates). rate is the average output rate in bytes/sec, 0 = unpaced.
+# transfer() sends on the calling thread; recall() queues a scene for the recaller's own thread, so
+# that a recall triggered by an automation does not hold up the MIDI input for its whole transfer.
+class SceneRecaller:
+    def __init__(self, scenes, midi_out, state, rate=MIDI_WIRE_RATE, chunk=SCENE_CHUNK,
+                 clock=time.perf_counter, sleep=time.sleep, name='scene-recaller'):
+        self.scenes = {scene.name: scene for scene in scenes}
+        self.midi_out = midi_out
+        self.state = state
+        self.rate = rate
+        self.chunk = chunk
+        self.clock = clock
+        self.sleep = sleep
+        self.name = name
+        self.recalls = 0
+        self.sent = 0
+        self.skipped = 0
+        self._pending = None
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    # outputs of scene the console does not hold yet, and the number of the ones it does
+    def diff(self, scene):
+        get = self.state.get
+        changed = [(controller, data) for controller, data in scene.outputs if get(controller) != data]
+        return changed, len(scene.outputs) - len(changed)
+
+    def transfer(self, scene, cancel=None):
+        if isinstance(scene, str):
+            scene = self.get(scene)
+        changed, skipped = self.diff(scene)
+        transfer = SceneTransfer(scene.name, skipped)
+        compile_macro = getattr(self.midi_out, 'compile_macro', None)
+        bytes_before = getattr(self.midi_out, 'bytes_sent', None)
+        start = self.clock()
+        for i in range(0, len(changed), self.chunk):
+            if cancel is not None and cancel():
+                transfer.cancelled = True
+                break
+            outputs = changed[i:i + self.chunk]
+            if compile_macro is not None:
+                # the diff decided what to send, the encoder's cache must not drop any of it
+                self.midi_out.send_macro(compile_macro(outputs), force=True)
+            else:
+                for controller, data in outputs:
+                    self.midi_out.send_nrpn(controller, data, force=True)
+            transfer.sent += len(outputs)
+            # everything the encoder wrote in the meantime (i.e. automations) is on the same wire
+            if bytes_before is None:
+                transfer.bytes_sent = transfer.sent * NRPN_FRAME_BYTES
+            else:
+                transfer.bytes_sent = self.midi_out.bytes_sent - bytes_before
+            # the next chunk goes out once the bytes sent so far would have left the wire
+            if self.rate > 0 and i + self.chunk < len(changed):
+                remaining = start + transfer.bytes_sent / self.rate - self.clock()
+                if remaining > 0:
+                    self.sleep(remaining)
+        transfer.seconds = self.clock() - start
+        self.recalls += 1
+        self.sent += transfer.sent
+        self.skipped += transfer.skipped
+        logging.info('%s', transfer.summary())
+        return transfer
+
+    def get(self, name):
+        scene = self.scenes.get(name)
+        if scene is None:
+            raise ValueError(f'Unknown scene {name!r}, expected one of {", ".join(self.scenes)}')
+        return scene
+
+    # recall on the recaller's thread. a recall still in progress stops after its current chunk,
+    # the values it did not send are diffed again as part of the new scene
+    def recall(self, name):
+        scene = self.get(name)
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._pending = scene
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                scene = self._pending
+                self._pending = None
+            try:
+                self.transfer(scene, cancel=lambda: self._pending is not None or self._stopped)
+            except Exception as e:
+                logging.exception('Scene recall failed: %s', e)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self):
+        return f'Scenes: {self.recalls} recalls, {self.sent} values sent, {self.skipped} unchanged skipped'
+
+
+# parses & validates a scene file. raises ValueError with the offending scene if anything is wrong
+def load_scenes(path=DEFAULT_SCENES_FILE):
+    with open(path) as scenes_file:
+        try:
+            spec = json.load(scenes_file)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'{path}: invalid JSON: {e}') from e
+    return parse_scenes(spec, path)
+
+def parse_scenes(spec, source='<scenes>'):
+    if not isinstance(spec, dict) or not isinstance(spec.get('scenes'), list):
+        raise ValueError(f'{source}: expected an object with a "scenes" list')
+    scenes = []
+    names = set()
+    for i, scene_spec in enumerate(spec['scenes']):
+        where = f'{source}: scene {i}'
+        if not isinstance(scene_spec, dict) or not isinstance(scene_spec.get('name'), str):
+            raise ValueError(f'{where}: expected an object with a "name"')
+        scene_spec = dict(scene_spec)
+        name = scene_spec.pop('name')
+        if name in names:
+            raise ValueError(f'{where}: scene {name!r} is defined twice')
+        names.add(name)
+        scenes.append(Scene(name, scene_spec, f'{source}: scene {i} ({name})'))
+    return scenes
@@ -0,0 +1,85 @@
+####################################################################################################
+############################### Shadow copy of the Yamaha LS9 state ################################
+#### - Description:
+####   Mirrors every controller listed in ON_OFF_CTLRS, FADER_CTLRS, MIX1_SOF_CTLRS, MT5_SOF_CTRLS,
+####   MT6_SOF_CTRLS & MT_ROUTING_SEND_CTLRS, from the NRPN frames received from the console and the
+####   ones sent to it.
+####   Automations can then check the current state of any channel without asking the console.
+from array import array
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+
+MIRRORED_MAPPINGS = (MIDI_LS9.ON_OFF_CTLRS, MIDI_LS9.FADER_CTLRS, MIDI_LS9.MIX1_SOF_CTLRS,
+                     MIDI_LS9.MT5_SOF_CTRLS, MIDI_LS9.MT6_SOF_CTRLS, MIDI_LS9.MT_ROUTING_SEND_CTLRS)
+
+# controller number -> slot in ConsoleState's value arrays. slot 0 means "not mirrored".
+# some controllers appear in more than one mapping and share one slot. This is a known defect of
+# yamaha_ls9_constants.py, not a property of the console: the MIX3-MIX16 entries of MT5_SOF_CTRLS &
+# MT6_SOF_CTRLS are copy/pasted from the MIX ON/OFF controllers (and MT5 "MIX5": 0xd0 is a typo).
+# Do not rely on the aliasing, it goes away once those tables are corrected
+def _build_slots():
+    slots = array('H', bytes(2 * MIDI_LS9.NRPN_CTLR_COUNT))
+    count = 1
+    for mapping in MIRRORED_MAPPINGS:
+        for controller in mapping.values():
+            if slots[controller] == 0:
+                slots[controller] = count
+                count += 1
+    return slots, count
+
+CTLR_SLOTS, SLOT_COUNT = _build_slots()
+
+
+class ConsoleState:
+    __slots__ = ('_values', '_known', 'updates')
+
+    def __init__(self):
+        self._values = array('H', bytes(2 * SLOT_COUNT))
+        # 1 once a value has been received or sent for the slot
+        self._known =  array('B', bytes(SLOT_COUNT))
+        self.updates = 0
+
+    # O(1) update from a decoded or sent NRPN frame. controllers that are not mirrored are ignored
+    def update(self, controller, data):
+        slot = CTLR_SLOTS[controller]
+        if slot:
+            self._values[slot] = data
+            self._known[slot] = 1
+            self.updates += 1
+
+    # forget every value, i.e. after the console was power cycled
+    def clear(self):
+        for slot in range(SLOT_COUNT):
+            self._known[slot] = 0
+
+    # last known data of any controller, None if unknown (or not mirrored)
+    def get(self, controller):
+        slot = CTLR_SLOTS[controller]
+        if slot and self._known[slot]:
+            return self._values[slot]
+        return None
+
+    # fader level of a channel/mix/matrix by name, i.e. fader('CH01')
+    def fader(self, channel):
+        return self.get(MIDI_LS9.FADER_CTLRS[channel])
+
+    # True/False for a channel switched ON/OFF, None if unknown
+    def is_on(self, channel):
+        data = self.get(MIDI_LS9.ON_OFF_CTLRS[channel])
+        if data is None:
+            return None
+        return data != MIDI_LS9.CH_OFF_VALUE
+
+    def mix1_send(self, channel):
+        return self.get(MIDI_LS9.MIX1_SOF_CTLRS[channel])
+
+    def mt5_send(self, mix):
+        return self.get(MIDI_LS9.MT5_SOF_CTRLS[mix])
+
+    def mt6_send(self, mix):
+        return self.get(MIDI_LS9.MT6_SOF_CTRLS[mix])
+
+    # number of bytes used by the state arrays
+    def memory_size(self):
+        return self._values.itemsize * len(self._values) + self._known.itemsize * len(self._known)
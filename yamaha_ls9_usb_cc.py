@@ -0,0 +1,103 @@
+####################################################################################################
+############################ USB keyboard CC -> LS9 NRPN lookup tables #############################
+#### - Description:
+####   The knobs of the USB MIDI keyboard (see midi_client_websockets.py) set the sends on fader of
+####   MT5/MT6, and the MT5/MT6 faders. USB_MIDI_MT5_SOF_CC_CTLRS & USB_MIDI_MT6_SOF_CC_CTLRS are
+####   compiled once into a table of the NRPN controller for every CC number, and the fader law into
+####   a table of the NRPN data for every CC number & value, so a CC is handled with two lookups.
+####
+####   Fader laws, the knob position (0-127) -> NRPN data curve:
+####   > linear: -inf to +10dB, evenly spread over the knob
+####   > unity:  0dB at 3/4 of the knob (CC value 96), for finer control around unity gain
+import logging
+from array import array
+
+#my constants
+import yamaha_ls9_constants as MIDI_LS9
+
+USB_CC_COUNT = 128
+# destination of the CC numbers that are not mapped. NRPN controllers are 14 bits, this is not one
+USB_CC_NO_DESTINATION = 0xFFFF
+
+# (CC value, NRPN data) points of each fader law, the values in between are interpolated linearly
+FADER_LAWS = {
+    'linear': ((0, MIDI_LS9.FADE_NEGINF_VALUE), (127, MIDI_LS9.FADE_10DB_VALUE)),
+    'unity':  ((0, MIDI_LS9.FADE_NEGINF_VALUE), (96, MIDI_LS9.FADE_0DB_VALUE), (127, MIDI_LS9.FADE_10DB_VALUE)),
+}
+DEFAULT_FADER_LAW = 'linear'
+
+
+# CC number -> NRPN controller, and CC number -> log label (i.e. 'MIX3 Send to MT5')
+def _build_usb_cc_destinations():
+    destinations = array('H', [USB_CC_NO_DESTINATION] * USB_CC_COUNT)
+    labels = [None] * USB_CC_COUNT
+    for cc_mapping, matrix, sof_ctlrs in ((MIDI_LS9.USB_MIDI_MT5_SOF_CC_CTLRS, 'MT5', MIDI_LS9.MT5_SOF_CTRLS),
+                                          (MIDI_LS9.USB_MIDI_MT6_SOF_CC_CTLRS, 'MT6', MIDI_LS9.MT6_SOF_CTRLS)):
+        for cc_controller, mix_name in cc_mapping.items():
+            if destinations[cc_controller] != USB_CC_NO_DESTINATION:
+                raise ValueError(f'USB MIDI CC {cc_controller} is mapped twice')
+            # the knob named after the matrix itself is its fader
+            if mix_name == matrix:
+                destinations[cc_controller] = MIDI_LS9.FADER_CTLRS[matrix]
+            else:
+                destinations[cc_controller] = sof_ctlrs[mix_name]
+            labels[cc_controller] = f'{mix_name} Send to {matrix}'
+    return destinations, labels
+
+USB_CC_DESTINATIONS, USB_CC_LABELS = _build_usb_cc_destinations()
+
+# CC value -> NRPN data for a fader law
+def build_fader_law(name=DEFAULT_FADER_LAW):
+    if name not in FADER_LAWS:
+        raise ValueError(f'Unknown fader law {name!r}, expected one of {", ".join(FADER_LAWS)}')
+    points = FADER_LAWS[name]
+    table = array('H', bytes(2 * USB_CC_COUNT))
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        for cc_data in range(x0, x1 + 1):
+            table[cc_data] = round(y0 + (y1 - y0) * (cc_data - x0) / (x1 - x0))
+    return table
+
+
+# Routes the CCs of the USB keyboard to the LS9. midi_output is an NrpnEncoder
+# CCs outside of 0-127 (the binary protocol has a byte for each) are dropped & counted in .out_of_range
+class UsbCcRouter:
+    __slots__ = ('midi_output', 'fader_law', 'values', 'out_of_range')
+
+    def __init__(self, midi_output, fader_law=DEFAULT_FADER_LAW):
+        self.midi_output = midi_output
+        self.fader_law = fader_law
+        # (cc_controller << 7 | cc_data) -> NRPN data. a row per CC number, so every mapping could
+        # have its own law; both MT5 & MT6 use fader_law for now
+        law = build_fader_law(fader_law)
+        self.values = array('H', bytes(2 * USB_CC_COUNT * USB_CC_COUNT))
+        for cc_controller in range(USB_CC_COUNT):
+            if USB_CC_DESTINATIONS[cc_controller] != USB_CC_NO_DESTINATION:
+                self.values[cc_controller << 7:(cc_controller + 1) << 7] = law
+        self.out_of_range = 0
+
+    # a router sending to another output, sharing the tables of this one
+    def for_output(self, midi_output):
+        router = UsbCcRouter.__new__(UsbCcRouter)
+        router.midi_output = midi_output
+        router.fader_law = self.fader_law
+        router.values = self.values
+        router.out_of_range = 0
+        return router
+
+    # returns False if cc_controller is not mapped to anything, or the CC is out of range
+    def process(self, cc_controller, cc_data):
+        logging.debug('cc_controller=%s\tcc_data=%s', cc_controller, cc_data)
+        # masking would turn i.e. CC 130 into CC 2, a knob that was not touched
+        if not 0 <= cc_controller < USB_CC_COUNT or not 0 <= cc_data < USB_CC_COUNT:
+            self.out_of_range += 1
+            logging.error('The CC command received from USB keyboard is out of range! cc_controller=%s cc_data=%s',
+                          cc_controller, cc_data)
+            return False
+        controller = USB_CC_DESTINATIONS[cc_controller]
+        if controller == USB_CC_NO_DESTINATION:
+            logging.error('The CC command received from USB keyboard is invalid! cc_controller=%s', cc_controller)
+            return False
+        data = self.values[(cc_controller << 7) | cc_data]
+        logging.info('MIDI OUT: %s @ %#x dB', USB_CC_LABELS[cc_controller], data)
+        self.midi_output.send_nrpn(controller, data)
+        return True